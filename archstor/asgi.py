@@ -0,0 +1,10 @@
+"""
+The ASGI entry point, for running archstor under an ASGI server:
+
+    uvicorn archstor.asgi:app
+"""
+from . import app as wsgi_app
+from .blueprint.asgi import ASGIApplication
+
+
+app = ASGIApplication(wsgi_app)
@@ -2,45 +2,31 @@
 archstor
 """
 import logging
-from os import makedirs, remove
+from os import fstat
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from abc import ABCMeta, abstractmethod
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from itertools import chain, islice
+from datetime import datetime, timezone
+
+from uuid import uuid4
+import json
 
 from werkzeug.datastructures import FileStorage
+from werkzeug.http import http_date, quote_etag
 from werkzeug.utils import secure_filename
-from flask import Blueprint, jsonify, Response, stream_with_context
-from flask_restful import Resource, Api, reqparse
-
-try:
-    import boto3
-    import botocore
-except ImportError:
-    # Hope we're not using the s3 backend
-    pass
-
-try:
-    from pymongo import MongoClient, ASCENDING
-    from gridfs import GridFS
-except ImportError:
-    # Hope we're not using a mongo backend
-    pass
-
-try:
-    from pypairtree.utils import identifier_to_path
-except ImportError:
-    # Hope we're not using a file system backend
-    pass
-
-try:
-    import swiftclient
-    import swiftclient.service
-    from swiftclient.exceptions import ClientException
-except ImportError:
-    # Hope we're not using a swift backend
-    pass
-
+from werkzeug.wsgi import wrap_file
+from flask import Blueprint, jsonify, request, Response, stream_with_context, \
+    got_request_exception
+from flask_restful import Resource, Api, reqparse, inputs
+
+from .parallel import ReadAheadReader
+from .sizing import ChunkSizing
+from .archive import generate_tar, generate_zip, tar_length
+from .fixity import DigestingReader, parse_digest_headers, DEFAULT_ALGORITHMS
 from .exceptions import Error, ObjectNotFoundError, \
-    ObjectAlreadyExistsError, FunctionalityOmittedError, UserError
+    FunctionalityOmittedError, UserError, RangeNotSatisfiableError
 
 
 __author__ = "Brian Balsamo"
@@ -63,15 +49,101 @@ log = logging.getLogger(__name__)
 def handle_errors(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
+    if isinstance(error, RangeNotSatisfiableError) and error.length is not None:
+        response.headers['Content-Range'] = "bytes */{}".format(error.length)
+    return response
+
+
+@BLUEPRINT.before_request
+def before_request():
+    metrics = BLUEPRINT.config.get('metrics')
+    if metrics is not None:
+        metrics.before_request()
+
+
+@BLUEPRINT.after_request
+def after_request(response):
+    metrics = BLUEPRINT.config.get('metrics')
+    if metrics is not None:
+        return metrics.after_request(response)
     return response
 
 
+def count_exception(sender, exception, **extra):
+    metrics = BLUEPRINT.config.get('metrics')
+    if metrics is not None:
+        metrics.on_exception(sender, exception, **extra)
+
+
+got_request_exception.connect(count_exception)
+
+
 def check_limit(x):
+    # A page of nothing can't move a listing on, so following its cursor
+    # would never end
+    if x < 1:
+        raise UserError("limit must be at least 1")
     if x > BLUEPRINT.config.get("MAX_LIMIT", 1000):
         return BLUEPRINT.config.get("MAX_LIMIT", 1000)
     return x
 
 
+def check_batch(ids):
+    # Unlike listings, a batch can't be silently truncated
+    max_batch = BLUEPRINT.config.get("BATCH_MAX", 1000)
+    if len(ids) > max_batch:
+        raise UserError("Batches are limited to {} identifiers".format(str(max_batch)))
+    for id in ids:
+        check_id(id)
+
+
+def fixity_algorithms():
+    algorithms = BLUEPRINT.config.get("FIXITY_ALGORITHMS", DEFAULT_ALGORITHMS)
+    if isinstance(algorithms, str):
+        algorithms = [x.strip().lower() for x in algorithms.split(",") if x.strip()]
+    return tuple(algorithms)
+
+
+def digesting(content):
+    # Digests are computed as the content is streamed into a backend, rather
+    # than by reading it back afterwards
+    return DigestingReader.wrap(content, fixity_algorithms())
+
+
+def declared_digests(content):
+    # Out: the digests content is checked against as it's read (those the
+    # client sent), if they cover every digest computed, else None. Those
+    # can go along with the write up front, as the write fails if they're
+    # wrong.
+    expected = getattr(content, "expected", None) or {}
+    algorithms = set(content.hexdigests())
+    if algorithms and algorithms <= set(expected):
+        return dict((x, expected[x].lower()) for x in algorithms)
+    return None
+
+
+def forward_digests(reader, src):
+    # Readers layered over content on its way into a backend expose the
+    # digests src is computing (see digesting), so the wrapped backend
+    # doesn't hash the content a second time, and those it's checked
+    # against, which backends can declare before they've read it
+    if hasattr(src, "hexdigests"):
+        reader.hexdigests = src.hexdigests
+    if hasattr(src, "expected"):
+        reader.expected = src.expected
+
+
+def fan_out(func, ids):
+    # In: single identifier function + iterable of identifiers
+    # Out: dict of identifier -> result, calls made concurrently
+    ids = list(ids)
+    if not ids:
+        return {}
+    workers = min(BLUEPRINT.config.get("BATCH_WORKERS", 8), len(ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(ids, executor.map(func, ids)))
+
+
 def check_id(id):
     if id != secure_filename(id):
         log.critical(
@@ -80,13 +152,199 @@ def check_id(id):
         raise UserError("Insecure identifier!")
 
 
+def encode_cursor(last_id):
+    # Opaque listing cursors carry the last identifier of the previous page,
+    # so backends can resume with a range scan rather than an offset
+    return "k" + urlsafe_b64encode(last_id.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    # In: cursor str
+    # Out: (offset int, last_id str) - exactly one of which is meaningful
+    # Numeric cursors are the legacy offset style, and are still honored.
+    if cursor is None or cursor == "":
+        return 0, None
+    if cursor.isdigit():
+        return int(cursor), None
+    if not cursor.startswith("k"):
+        raise UserError("Malformed cursor!")
+    encoded = cursor[1:]
+    try:
+        last_id = urlsafe_b64decode(
+            encoded + "=" * (-len(encoded) % 4)
+        ).decode("utf-8")
+    except (ValueError, UnicodeDecodeError):
+        raise UserError("Malformed cursor!")
+    return 0, last_id
+
+
+def prefix_upper_bound(prefix):
+    # The smallest string greater than every string starting with prefix,
+    # or None if there isn't one
+    while prefix:
+        if ord(prefix[-1]) < 0x10FFFF:
+            return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def resolve_range(start, stop, length):
+    # In: werkzeug style range bounds (a negative start is a suffix length,
+    # stop is exclusive or None) + the total object length
+    # Out: absolute (start, stop) tuple, stop exclusive
+    if start < 0:
+        if length == 0:
+            raise RangeNotSatisfiableError(length=length)
+        return max(length + start, 0), length
+    if start >= length:
+        raise RangeNotSatisfiableError(length=length)
+    if stop is None or stop > length:
+        stop = length
+    return start, stop
+
+
+def range_header_value(start, stop):
+    # The inverse of werkzeug's range parsing, for backends that take a
+    # Range header of their own
+    if start < 0:
+        return "bytes={}".format(start)
+    if stop is None:
+        return "bytes={}-".format(start)
+    return "bytes={}-{}".format(start, stop - 1)
+
+
+def object_etag(stat):
+    # Backends which record a digest get a strong ETag, everyone else gets
+    # a weak one derived from the size and modification time
+    if stat.get("digest"):
+        return stat["digest"], False
+    return "{:x}-{:x}".format(
+        stat["size"], int(stat["last_modified"].timestamp())
+    ), True
+
+
+def is_not_modified(stat, if_none_match, if_modified_since):
+    # In: stat dict (or None) + werkzeug ETags + datetime (or None)
+    # If-None-Match takes precedence over If-Modified-Since, RFC 7232 3.3
+    if stat is None:
+        return False
+    if if_none_match:
+        etag, _ = object_etag(stat)
+        return if_none_match.contains_weak(etag)
+    if if_modified_since is not None:
+        return stat['last_modified'].replace(microsecond=0) <= \
+            as_utc(if_modified_since)
+    return False
+
+
+def if_range_holds(stat, if_range):
+    # In: stat dict (or None) + werkzeug IfRange
+    # Out: whether a Range should be honored, RFC 7233 3.2
+    if if_range.etag is None and if_range.date is None:
+        return True
+    if stat is None:
+        return False
+    if if_range.etag is not None:
+        etag, weak = object_etag(stat)
+        return not weak and if_range.etag == etag
+    return stat['last_modified'].replace(microsecond=0) == \
+        as_utc(if_range.date)
+
+
+def as_utc(dt):
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def chunk_size(sizing, length=None):
+    # In: ChunkSizing (or None for BUFF sized chunks) + the length of the
+    # object, if known
+    if sizing is None:
+        return BLUEPRINT.config['BUFF']
+    return sizing.size_for(length)
+
+
+def content_length(content):
+    # The length of an upload, if the client said (Content-Length)
+    return getattr(content, "content_length", None) or None
+
+
+def copy_stream(src, dst, size=None):
+    # In: readable file like object + writable file like object + chunk size
+    # Out: The number of bytes copied
+    # Only ever holds one chunk (BUFF sized by default) in memory
+    if size is None:
+        size = BLUEPRINT.config['BUFF']
+    copied = 0
+    data = src.read(size)
+    while data:
+        dst.write(data)
+        copied += len(data)
+        data = src.read(size)
+    return copied
+
+
+class RangedReader:
+    # Exposes at most length bytes of an already positioned file like object
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        if hasattr(self.f, "close"):
+            self.f.close()
+
+
 class IStorageBackend(metaclass=ABCMeta):
+    # How many chunks of an object Object.get keeps read ahead of the
+    # client, on a background thread, 0 for none
+    read_ahead = 0
+    # ChunkSizings for streaming objects out (read_chunks) and in
+    # (upload_chunks), None for BUFF sized chunks
+    read_chunks = None
+    upload_chunks = None
+
+    def read_chunk_size(self, length=None):
+        return chunk_size(self.read_chunks, length)
+
+    def upload_chunk_size(self, length=None):
+        return chunk_size(self.upload_chunks, length)
+
     @abstractmethod
-    def get_object_id_list(self, cursor, limit):
-        # In: offset and limit ints
-        # Out: List of strs
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        # In: cursor str (see decode_cursor), limit int, optional prefix str
+        # Out: (next cursor str or None, List of strs)
         pass
 
+    def iter_object_ids(self, prefix=None, start_after=None, page_size=1000):
+        # In: optional prefix str, optional (exclusive) identifier to start
+        # after + how many identifiers to fetch from the backend at a time
+        # Out: generator of every identifier, in order
+        # Pages through get_object_id_list, backends should override this
+        # with their native listing, which can start after an identifier
+        # rather than skipping up to it
+        cursor = "0"
+        while cursor is not None:
+            if prefix:
+                cursor, ids = self.get_object_id_list(cursor, page_size, prefix=prefix)
+            else:
+                cursor, ids = self.get_object_id_list(cursor, page_size)
+            for id in ids:
+                if start_after is None or id > start_after:
+                    yield id
+
     @abstractmethod
     def check_object_exists(self, id):
         # In: id str
@@ -99,10 +357,37 @@ class IStorageBackend(metaclass=ABCMeta):
         # Out: File like object
         pass
 
+    def get_object_range(self, id, start, stop):
+        # In: str + werkzeug style range bounds (see resolve_range)
+        # Out: (File like object, (start, stop) absolute, total length)
+        # Optional, backends which can't seek fall back to a full response
+        raise FunctionalityOmittedError(
+            "Ranged reads are not available while using this storage backend"
+        )
+
+    def stat_object(self, id):
+        # In: str
+        # Out: dict with "size" (int), "last_modified" (tz aware datetime),
+        # "digest" (str or None) and "digests" (dict of algorithm -> hex
+        # digest, recorded at ingest) keys
+        raise FunctionalityOmittedError(
+            "Object metadata is not available while using this storage backend"
+        )
+
+    def get_object_digests(self, id):
+        # In: str
+        # Out: dict of algorithm -> hex digest, recorded at ingest
+        # Those stat_object has, unless the backend keeps some of them
+        # somewhere dearer to reach, which it then only fetches for the
+        # callers that ask for them (fixity audits, migrations)
+        return self.stat_object(id).get("digests") or {}
+
     @abstractmethod
     def set_object(self, id, content):
-        # In: str + flask.FileStorage
-        # Out: None
+        # In: str + readable file like object (a flask.FileStorage, or the
+        # raw request stream)
+        # Out: dict of algorithm -> hex digest, computed while storing
+        # the content and persisted alongside it
         pass
 
     @abstractmethod
@@ -111,238 +396,81 @@ class IStorageBackend(metaclass=ABCMeta):
         # Out: bool
         pass
 
-
-class MongoStorageBackend(IStorageBackend):
-    def __init__(self, db_host, db_port=None, db_name=None):
-        if db_port is None:
-            db_port = 27017
-        if db_name is None:
-            db_name = "lts"
-
-        self.db = MongoClient(db_host, db_port)[db_name]
-
-        self.fs = GridFS(
-            MongoClient(db_host, db_port)[db_name]
-        )
-
-    def get_object_id_list(self, cursor, limit):
-        def peek(cursor, limit):
-            if len([x._id for x in self.fs.find().sort('_id', ASCENDING).skip(cursor + limit)]) > 0:
-                return str(cursor + limit)
-            return None
-        cursor = int(cursor)
-        results = [x._id for x in self.fs.find().sort('_id', ASCENDING).skip(cursor).limit(limit)]
-        next_cursor = peek(cursor, limit)
-        return next_cursor, results
-
-    def check_object_exists(self, id):
-        if self.fs.find_one({"_id": id}):
+    # Batch operations, backends which can do better than one request per
+    # identifier (fanned out over a thread pool) should override these
+
+    def check_objects_exist(self, ids):
+        # In: list of strs
+        # Out: dict of str -> bool
+        return fan_out(self.check_object_exists, ids)
+
+    def stat_objects(self, ids):
+        # In: list of strs
+        # Out: dict of str -> stat dict (see stat_object) or None if missing
+        def stat_or_none(id):
+            try:
+                return self.stat_object(id)
+            except ObjectNotFoundError:
+                return None
+        return fan_out(stat_or_none, ids)
+
+    def del_objects(self, ids):
+        # In: list of strs
+        # Out: dict of str -> bool
+        def delete(id):
+            self.del_object(id)
             return True
-        return False
-
-    def get_object(self, id):
-        gr_entry = self.fs.find_one({"_id": id})
-        if gr_entry is None:
-            raise ObjectNotFoundError(str(id))
-        return gr_entry
-
-    def set_object(self, id, content):
-        if self.check_object_exists(id):
-            raise ObjectAlreadyExistsError(str(id))
-        content_target = self.fs.new_file(_id=id)
-        content.save(content_target)
-        content_target.close()
-
-    def del_object(self, id):
-        return self.fs.delete(id)
+        return fan_out(delete, ids)
 
 
-class FileSystemStorageBackend(IStorageBackend):
-    def __init__(self, lts_root):
-        self.lts_root = Path(lts_root)
+class WrappingStorageBackend(IStorageBackend):
+    """
+    A backend layered over another (self.backend), which streams in the
+    wrapped backend's chunk sizes and lists what it lists, unless it
+    overrides these
+    """
+    def __init__(self, backend):
+        self.backend = backend
 
-    def get_object_id_list(self, cursor, limit):
-        raise FunctionalityOmittedError(
-            "This functionality is not available while using this storage backend"
-        )
-
-    def get_object(self, id):
-        content_path = Path(
-            self.lts_root, identifier_to_path(id), "arf", "content.file"
-        )
-        if not content_path.is_file():
-            raise ObjectNotFoundError(str(id))
-        return open(str(content_path))
+    @property
+    def read_ahead(self):
+        return self.backend.read_ahead
 
-    def check_object_exists(self, id):
-        content_path = Path(
-            self.lts_root, identifier_to_path(id), "arf", "content.file"
-        )
-        return content_path.is_file()
+    def read_chunk_size(self, length=None):
+        return self.backend.read_chunk_size(length)
 
-    def set_object(self, id, content):
-        content_path = Path(
-            self.lts_root, identifier_to_path(id), "arf", "content.file"
-        )
-        if self.check_object_exists(id):
-            raise ObjectAlreadyExistsError(str(id))
-        makedirs(str(content_path.parent), exist_ok=True)
-        content.save(str(content_path))
+    def upload_chunk_size(self, length=None):
+        return self.backend.upload_chunk_size(length)
 
-    def del_object(self, id):
-        content_path = Path(
-            self.lts_root, identifier_to_path(id), "arf", "content.file"
-        )
-        if not content_path.exists():
-            return True
-        remove(str(content_path))
-        return True
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        if prefix:
+            return self.backend.get_object_id_list(cursor, limit, prefix=prefix)
+        return self.backend.get_object_id_list(cursor, limit)
 
+    def iter_object_ids(self, prefix=None, start_after=None, page_size=1000):
+        return self.backend.iter_object_ids(prefix=prefix, start_after=start_after,
+                                            page_size=page_size)
 
-class S3StorageBackend(IStorageBackend):
-    # NOTE: THIS IS ENTIRELY UNTESTED
-    # IT IS PRETTY MUCH A ROUGH DRAFT
-    def __init__(self, bucket_name, region_name=None, aws_access_key_id=None,
-                 aws_secret_access_key=None):
-        # Helper init for inheriting classes.
-        self.s3 = boto3.client(
-            's3', region_name=region_name, aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key
-        )
-        self.bucket = bucket_name
-        exists = True
-        try:
-            self.s3.head_bucket(Bucket=bucket_name)
-        except botocore.exceptions.ClientError as e:
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                exists = False
-        if not exists:
-            # Init the bucket
-            self.s3.create_bucket(Bucket=bucket_name)
-
-    def get_object_id_list(self, offset, limit):
-        # TODO: Actually use api implementations of item queries
-        return self.s3.list_objects(Bucket=self.bucket)[offset:offset + limit]
+    def get_object_digests(self, id):
+        return self.backend.get_object_digests(id)
 
-    def get_object(self, id):
-        obj = self.s3.get_object(Bucket=BLUEPRINT.config['storage'].name, Key=id)
-        return obj['Body']
 
-    def check_object_exists(self, id):
-        try:
-            self.s3.head_object(Bucket=self.bucket)
-            return True
-        except botocore.exceptions.ClientError as e:
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                return False
+# Where each storage backend is, imported on first use, so that only the
+# configured backend's client library is loaded
+BACKEND_MODULES = {
+    "MongoStorageBackend": ".mongo",
+    "FileSystemStorageBackend": ".filesystem",
+    "S3StorageBackend": ".s3",
+    "SwiftStorageBackend": ".swift"
+}
 
-    def set_object(self, id, content):
-        self.s3.Object(BLUEPRINT.config['storage'].name, id).put(Body=content)
-
-
-class SwiftStorageBackend(IStorageBackend):
-    def __init__(self,
-                 auth_url,
-                 auth_version,
-                 user,
-                 key,
-                 tenant_name,
-                 os_options={},
-                 container_name="lts"):
-        self.auth_url = auth_url
-        self.auth_version = auth_version
-        self.user = user
-        self.key = key
-        self.tenant_name = tenant_name
-        self.os_options = os_options
-        self.container_name = container_name
-        self._opts = {'auth': self.auth_url, 'user': self.user, 'key': self.key,
-                      'use_slo': True, 'segment_size': BLUEPRINT.config['BUFF'],
-                      'auth_version': self.auth_version}
-        self._opts = dict(
-            swiftclient.service._default_global_options,
-            **dict(swiftclient.service._default_local_options, **self._opts)
-        )
-        swiftclient.service.process_options(self._opts)
-        # Check to be sure our LTS container exists
-        conn = self.create_connection()
-        try:
-            conn.head_container(self.container_name)
-        except ClientException as e:
-            if e.http_status == 404:
-                conn.put_container(self.container_name)
-        conn.close()
-
-    def create_connection(self):
-        return swiftclient.service.get_conn(self._opts)
-
-    def get_object_id_list(self, cursor, limit):
-        if cursor is "0":
-            cursor = None
-        conn = self.create_connection()
-        results = []
-        listing = True
-        while listing:
-            headers, listing = conn.get_container(self.container_name, marker=cursor, limit=limit)
-            for x in listing:
-                results.append(x['name'])
-            if not listing:
-                cursor = None
-                break
-            cursor = listing[-1].get('name', listing[-1].get('subdir'))
-            if limit is not None and len(listing) >= limit:
-                break
-        conn.close()
-
-        return cursor, results
 
-    def get_object(self, id):
-        try:
-            conn = self.create_connection()
-            headers, contents = conn.get_object(
-                self.container_name, id, resp_chunk_size=BLUEPRINT.config['BUFF'])
-            conn.close()
-            return contents
-        except ClientException as e:
-            if e.http_status == 404:
-                conn.close()
-                raise ObjectNotFoundError()
-            conn.close()
-
-    def check_object_exists(self, id):
-        conn = self.create_connection()
-        try:
-            conn.head_object(self.container_name, id)
-            conn.close()
-            return True
-        except ClientException as e:
-            if e.http_status == 404:
-                conn.close()
-                return False
-            conn.close()
-            raise
-
-    def set_object(self, id, content):
-        if self.check_object_exists(id):
-            raise ObjectAlreadyExistsError()
-        conn = self.create_connection()
-        conn.put_object(self.container_name, id, contents=content,
-                        chunk_size=BLUEPRINT.config['BUFF'])
-        conn.close()
-
-    def del_object(self, id):
-        try:
-            conn = self.create_connection()
-            conn.delete_object(self.container_name, id)
-            conn.close()
-        except ClientException as e:
-            if e.http_status == 404:
-                conn.close()
-                return
-            conn.close()
-            raise
+def __getattr__(name):
+    # archstor.blueprint.SwiftStorageBackend and so on, as they were before
+    # they had modules of their own
+    if name in BACKEND_MODULES:
+        return getattr(import_module(BACKEND_MODULES[name], __name__), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class Root(Resource):
@@ -350,12 +478,20 @@ class Root(Resource):
         parser = reqparse.RequestParser()
         parser.add_argument("cursor", type=str, default="0")
         parser.add_argument("limit", type=int, default=1000)
+        parser.add_argument("prefix", type=str, default=None)
         args = parser.parse_args()
         args['limit'] = check_limit(args['limit'])
-        next_cursor, result = BLUEPRINT.config['storage'].get_object_id_list(
-            args['cursor'],
-            args['limit']
-        )
+        if args['prefix']:
+            next_cursor, result = BLUEPRINT.config['storage'].get_object_id_list(
+                args['cursor'],
+                args['limit'],
+                prefix=args['prefix']
+            )
+        else:
+            next_cursor, result = BLUEPRINT.config['storage'].get_object_id_list(
+                args['cursor'],
+                args['limit']
+            )
         return {
             "objects": [
                 {"identifier": x, "_link": API.url_for(Object, id=x)} for x
@@ -364,6 +500,7 @@ class Root(Resource):
             "pagination": {
                 "limit": args['limit'],
                 "cursor": args['cursor'],
+                "prefix": args['prefix'],
                 "next_cursor": next_cursor
             },
             "_self": {
@@ -373,23 +510,182 @@ class Root(Resource):
         }
 
 
+def added(id, digests):
+    # With write behind ingest the object is only staged so far, the client
+    # can follow it to the backend through the status link
+    if BLUEPRINT.config.get('ingest') is None:
+        return {'identifier': id, "added": True, "digests": digests}
+    return {'identifier': id, "added": True, "queued": True, "digests": digests,
+            "_link": API.url_for(Ingest, id=id)}, 202
+
+
 class Object(Resource):
-    def get(self, id):
+    @staticmethod
+    def stat(id):
+        # Out: the backend's stat dict, or None if it can't provide one
+        try:
+            return BLUEPRINT.config['storage'].stat_object(id)
+        except FunctionalityOmittedError:
+            return None
+
+    @staticmethod
+    def stat_headers(stat):
+        if stat is None:
+            return {}
+        etag, weak = object_etag(stat)
+        return {
+            "ETag": quote_etag(etag, weak),
+            "Last-Modified": http_date(stat['last_modified']),
+            "Accept-Ranges": "bytes"
+        }
+
+    @staticmethod
+    def not_modified(stat):
+        return is_not_modified(stat, request.if_none_match, request.if_modified_since)
+
+    @staticmethod
+    def if_range_matches(stat):
+        return if_range_holds(stat, request.if_range)
+
+    @staticmethod
+    def file_response(e, headers):
+        # Real files are handed to the server's wsgi.file_wrapper, which can
+        # sendfile(2) them rather than copying them through python
+        # Out: Response, or None if e isn't backed by a file descriptor
+        try:
+            size = fstat(e.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            return None
+        headers['Content-Length'] = str(size - e.tell())
+        return Response(
+            wrap_file(
+                request.environ, e, BLUEPRINT.config['storage'].read_chunk_size(size)
+            ),
+            headers=headers,
+            direct_passthrough=True
+        )
+
+    def head(self, id):
+        check_id(id)
+        stat = self.stat(id)
+        if stat is None:
+            if not BLUEPRINT.config['storage'].check_object_exists(id):
+                raise ObjectNotFoundError(str(id))
+            return Response()
+        headers = self.stat_headers(stat)
+        if self.not_modified(stat):
+            return Response(status=304, headers=headers)
+        headers['Content-Length'] = str(stat['size'])
+        return Response(headers=headers)
 
-        def generate(e):
-            data = e.read(BLUEPRINT.config['BUFF'])
-            while data:
-                yield data
-                data = e.read(BLUEPRINT.config['BUFF'])
+    def get(self, id):
+        storage = BLUEPRINT.config['storage']
+
+        def generate(e, length=None):
+            size = storage.read_chunk_size(length)
+            if storage.read_ahead and (length is None or length > size):
+                # Objects that fit in one chunk have nothing to gain
+                e = ReadAheadReader(e, size, storage.read_ahead)
+            try:
+                data = e.read(size)
+                while data:
+                    yield data
+                    data = e.read(size)
+            finally:
+                # Also runs if the client goes away mid stream
+                if hasattr(e, "close"):
+                    e.close()
+
+        def generate_multipart(first, ranges, boundary):
+            # multipart/byteranges, see RFC 7233 Appendix A
+            for byte_range in ranges:
+                if first is not None:
+                    e, (start, stop), length = first
+                    first = None
+                else:
+                    try:
+                        e, (start, stop), length = storage.get_object_range(id, *byte_range)
+                    except RangeNotSatisfiableError:
+                        # Unsatisfiable members of a range set are skipped
+                        continue
+                yield "--{}\r\nContent-Type: application/octet-stream\r\n" \
+                    "Content-Range: bytes {}-{}/{}\r\n\r\n".format(
+                        boundary, start, stop - 1, length
+                    ).encode("ascii")
+                yield from generate(e, stop - start)
+                yield b"\r\n"
+            yield "--{}--\r\n".format(boundary).encode("ascii")
 
         check_id(id)
+        stat = self.stat(id)
+        headers = self.stat_headers(stat)
+        if self.not_modified(stat):
+            return Response(status=304, headers=headers)
+        byte_ranges = request.range
+        if byte_ranges is not None and byte_ranges.units == "bytes" and \
+                self.if_range_matches(stat):
+            try:
+                e, (start, stop), length = storage.get_object_range(
+                    id, *byte_ranges.ranges[0]
+                )
+            except FunctionalityOmittedError:
+                # Servers are free to ignore Range, so just send everything
+                log.debug("Backend can't serve ranges, sending whole object")
+            else:
+                headers['Accept-Ranges'] = "bytes"
+                if len(byte_ranges.ranges) == 1:
+                    headers['Content-Range'] = "bytes {}-{}/{}".format(
+                        start, stop - 1, length
+                    )
+                    headers['Content-Length'] = str(stop - start)
+                    return Response(
+                        stream_with_context(generate(e, stop - start)),
+                        status=206,
+                        headers=headers
+                    )
+                boundary = uuid4().hex
+                return Response(
+                    stream_with_context(generate_multipart(
+                        (e, (start, stop), length), byte_ranges.ranges, boundary
+                    )),
+                    status=206,
+                    content_type="multipart/byteranges; boundary={}".format(boundary),
+                    headers=headers
+                )
+        e = storage.get_object(id)
+        response = self.file_response(e, headers)
+        if response is not None:
+            return response
+        length = None
+        if stat is not None:
+            length = stat['size']
+            headers['Content-Length'] = str(length)
         return Response(
-            stream_with_context(
-                generate(BLUEPRINT.config['storage'].get_object(id))
-            )
+            stream_with_context(generate(e, length)),
+            headers=headers
+        )
+
+    @staticmethod
+    def content(stream):
+        # Client supplied digests (Content-MD5, Digest) are verified as the
+        # upload is read, failing it before the backend commits anything
+        reader = DigestingReader(
+            stream, fixity_algorithms(), parse_digest_headers(request.headers)
         )
+        if reader.content_length is None:
+            # For a form that's the length of all of it, near enough
+            reader.content_length = request.content_length
+        return reader
 
     def put(self, id):
+        if request.mimetype not in ("multipart/form-data",
+                                    "application/x-www-form-urlencoded"):
+            # Raw request bodies go straight to the backend, without being
+            # spooled to a temporary file by the form parser first
+            check_id(id)
+            digests = BLUEPRINT.config['storage'].set_object(id, self.content(request.stream))
+            return added(id, digests)
+
         parser = reqparse.RequestParser()
         parser.add_argument(
             "object",
@@ -400,32 +696,266 @@ class Object(Resource):
         args = parser.parse_args()
         check_id(id)
 
-        BLUEPRINT.config['storage'].set_object(id, args['object'])
-        return {'identifier': id, "added": True}
+        digests = BLUEPRINT.config['storage'].set_object(id, self.content(args['object']))
+        return added(id, digests)
 
     def delete(self, id):
         BLUEPRINT.config['storage'].del_object(id)
         return {"identifier": id, "deleted": True}
 
 
+def parse_batch():
+    parser = reqparse.RequestParser()
+    parser.add_argument(
+        "identifiers",
+        required=True,
+        type=str,
+        action="append",
+        location="json"
+    )
+    args = parser.parse_args()
+    check_batch(args['identifiers'])
+    return args['identifiers']
+
+
+class BatchExists(Resource):
+    def post(self):
+        ids = parse_batch()
+        results = BLUEPRINT.config['storage'].check_objects_exist(ids)
+        return {
+            "objects": [
+                {"identifier": x, "exists": results[x], "_link": API.url_for(Object, id=x)}
+                for x in ids
+            ]
+        }
+
+
+class BatchStat(Resource):
+    def post(self):
+        ids = parse_batch()
+        results = BLUEPRINT.config['storage'].stat_objects(ids)
+        objects = []
+        for x in ids:
+            stat = results[x]
+            if stat is None:
+                objects.append({"identifier": x, "exists": False})
+                continue
+            objects.append({
+                "identifier": x,
+                "exists": True,
+                "size": stat['size'],
+                "last_modified": stat['last_modified'].isoformat(),
+                "digest": stat['digest'],
+                "digests": stat.get('digests', {}),
+                "_link": API.url_for(Object, id=x)
+            })
+        return {"objects": objects}
+
+
+class BatchDelete(Resource):
+    def post(self):
+        ids = parse_batch()
+        results = BLUEPRINT.config['storage'].del_objects(ids)
+        return {
+            "objects": [{"identifier": x, "deleted": results[x]} for x in ids]
+        }
+
+
+class Archive(Resource):
+    def stream(self, ids, archive_format):
+        check_batch(ids)
+        if archive_format not in ("tar", "zip"):
+            raise UserError("Unsupported archive format: {}".format(archive_format))
+        storage = BLUEPRINT.config['storage']
+        # Sizes are needed for tar headers, and missing objects have to be
+        # reported before any of the archive is sent
+        stats = storage.stat_objects(ids)
+        missing = [x for x in ids if stats[x] is None]
+        if missing:
+            raise ObjectNotFoundError(", ".join(missing))
+        prefetch = BLUEPRINT.config.get("ARCHIVE_PREFETCH", 1)
+        headers = {
+            "Content-Disposition": "attachment; filename=archive.{}".format(archive_format)
+        }
+        if archive_format == "tar":
+            headers['Content-Length'] = str(tar_length(ids, stats))
+            return Response(
+                stream_with_context(generate_tar(
+                    ids, stats, storage.get_object, storage.read_chunk_size(), prefetch
+                )),
+                mimetype="application/x-tar",
+                headers=headers
+            )
+        return Response(
+            stream_with_context(generate_zip(
+                ids, stats, storage.get_object, storage.read_chunk_size(), prefetch
+            )),
+            mimetype="application/zip",
+            headers=headers
+        )
+
+    def get(self):
+        # One listing page worth of objects
+        parser = reqparse.RequestParser()
+        parser.add_argument("cursor", type=str, default="0", location="args")
+        parser.add_argument("limit", type=int, default=1000, location="args")
+        parser.add_argument("prefix", type=str, default=None, location="args")
+        parser.add_argument("format", type=str, default="tar", location="args")
+        args = parser.parse_args()
+        args['limit'] = check_limit(args['limit'])
+        if args['prefix']:
+            next_cursor, ids = BLUEPRINT.config['storage'].get_object_id_list(
+                args['cursor'], args['limit'], prefix=args['prefix']
+            )
+        else:
+            next_cursor, ids = BLUEPRINT.config['storage'].get_object_id_list(
+                args['cursor'], args['limit']
+            )
+        response = self.stream(ids, args['format'])
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    def post(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument(
+            "identifiers",
+            required=True,
+            type=str,
+            action="append",
+            location="json"
+        )
+        parser.add_argument("format", type=str, default="tar", location="json")
+        args = parser.parse_args()
+        return self.stream(args['identifiers'], args['format'])
+
+
+def generate_inventory(storage, ids, stat=False, page_size=1000):
+    # In: backend + iterable of identifiers, whether to include their stats
+    # Out: generator of newline delimited JSON, a page of identifiers at a time
+    ids = iter(ids)
+    while True:
+        page = list(islice(ids, page_size))
+        if not page:
+            return
+        stats = storage.stat_objects(page) if stat else {}
+        lines = []
+        for x in page:
+            entry = {"identifier": x}
+            if stat:
+                info = stats[x]
+                if info is None:
+                    # Deleted since it was listed
+                    continue
+                entry.update({
+                    "size": info['size'],
+                    "last_modified": info['last_modified'].isoformat(),
+                    "digest": info['digest'],
+                    "digests": info.get('digests', {})
+                })
+            lines.append(json.dumps(entry) + "\n")
+        yield "".join(lines).encode("utf-8")
+
+
+class Inventory(Resource):
+    def get(self):
+        # Every identifier, streamed as NDJSON straight from the backend's
+        # listing rather than a page per request
+        parser = reqparse.RequestParser()
+        parser.add_argument("prefix", type=str, default=None, location="args")
+        parser.add_argument("start_after", type=str, default=None, location="args")
+        parser.add_argument("stat", type=inputs.boolean, default=False, location="args")
+        args = parser.parse_args()
+        storage = BLUEPRINT.config['storage']
+        lines = generate_inventory(
+            storage,
+            storage.iter_object_ids(prefix=args['prefix'], start_after=args['start_after']),
+            stat=args['stat'],
+            page_size=BLUEPRINT.config.get('BATCH_MAX', 1000)
+        )
+        # The first page is fetched now, so errors (no listings from this
+        # backend, say) get a proper response rather than a truncated one
+        first = next(lines, b"")
+        return Response(
+            stream_with_context(chain([first], lines)),
+            mimetype="application/x-ndjson"
+        )
+
+
 class Version(Resource):
     def get(self):
         return {"version": __version__}
 
 
-@BLUEPRINT.record
-def handle_configs(setup_state):
+def ingest_queue():
+    ingest = BLUEPRINT.config.get('ingest')
+    if ingest is None:
+        raise FunctionalityOmittedError("Write behind ingest is not enabled")
+    return ingest
+
+
+class IngestQueue(Resource):
+    def get(self):
+        summary = ingest_queue().journal.summary()
+        if summary['oldest'] is not None:
+            summary['oldest'] = datetime.fromtimestamp(
+                summary['oldest'], timezone.utc
+            ).isoformat()
+        return summary
+
+
+class Ingest(Resource):
+    def get(self, id):
+        ingest = ingest_queue()
+        status = ingest.status(id)
+        if status is not None:
+            return status
+        if not ingest.backend.check_object_exists(id):
+            raise ObjectNotFoundError(str(id))
+        return {"identifier": id, "state": "stored", "_link": API.url_for(Object, id=id)}
+
+    def post(self, id):
+        # Retries an object which was given up on
+        if not ingest_queue().retry(id):
+            raise UserError("{} isn't a failed ingest".format(id))
+        return {"identifier": id, "state": "queued"}, 202
+
+
+class Metrics(Resource):
+    def get(self):
+        metrics = BLUEPRINT.config.get('metrics')
+        if metrics is None:
+            raise FunctionalityOmittedError("Metrics are not enabled")
+        body, content_type = metrics.exposition()
+        return Response(body, content_type=content_type)
+
+
+def configure_storage(bp):
+    # In: anything with a config dict holding a STORAGE_BACKEND (the
+    # blueprint, or a stand in for tools which need backends of their own)
+    # Sets config['storage'] to that backend, wrapped as configured
+    # Each backend's module (and so its client library) is only imported
+    # once it's chosen, and none of them connect until they're first used
+
     def configure_mongo(bp):
+        from .mongo import MongoStorageBackend
         mongo_host = bp.config['MONGO_HOST']
         mongo_port = bp.config.get('MONGO_PORT')
         mongo_db = bp.config.get("MONGO_DB")
         bp.config['storage'] = MongoStorageBackend(mongo_host, mongo_port, mongo_db)
 
     def configure_fs(bp):
+        from .filesystem import FileSystemStorageBackend
         root = bp.config['LTS_ROOT']
-        bp.config['storage'] = FileSystemStorageBackend(root)
+        bp.config['storage'] = FileSystemStorageBackend(
+            root,
+            index_path=bp.config.get('LTS_INDEX'),
+            use_index=not bp.config.get('LTS_NO_INDEX', False),
+            index_workers=int(bp.config.get('LTS_INDEX_WORKERS', 8))
+        )
 
     def configure_swift(bp):
+        from .swift import SwiftStorageBackend
         bp.config['storage'] = SwiftStorageBackend(
             bp.config['SWIFT_AUTH_URL'],
             bp.config['SWIFT_AUTH_VERSION'],
@@ -433,26 +963,163 @@ def handle_configs(setup_state):
             bp.config['SWIFT_KEY'],
             bp.config['SWIFT_TENANT_NAME'],
             os_options=bp.config.get('SWIFT_OS_OPTIONS', {}),
-            container_name=bp.config.get('SWIFT_CONTAINER_NAME', 'lts')
+            container_name=bp.config.get('SWIFT_CONTAINER_NAME', 'lts'),
+            pool_size=int(bp.config.get('SWIFT_POOL_SIZE', 10)),
+            pool_max_idle=float(bp.config.get('SWIFT_POOL_MAX_IDLE', 60)),
+            pool_timeout=bp.config.get('SWIFT_POOL_TIMEOUT'),
+            segment_size=int(bp.config.get('SWIFT_SEGMENT_SIZE', 128 * 1024 * 1024)),
+            workers=int(bp.config.get('SWIFT_WORKERS', 4)),
+            retries=int(bp.config.get('SWIFT_RETRIES', 5)),
+            segment_retries=int(bp.config.get('SWIFT_SEGMENT_RETRIES', 3))
         )
 
+    def configure_cache(bp):
+        from .cache import CachingStorageBackend
+        bp.config['storage'] = CachingStorageBackend(
+            bp.config['storage'],
+            bp.config['CACHE_DIR'],
+            int(bp.config.get('CACHE_MAX_BYTES', 1024 * 1024 * 1024)),
+            memory_max_bytes=int(bp.config.get('CACHE_MEMORY_MAX_BYTES', 64 * 1024 * 1024)),
+            memory_max_object_size=int(
+                bp.config.get('CACHE_MEMORY_MAX_OBJECT_SIZE', 64 * 1024)
+            )
+        )
+
+    def configure_metrics(bp):
+        # Outermost, so it sees what requests see (cache hits included)
+        try:
+            from . import metrics
+        except ImportError:
+            log.warning("METRICS is set, but prometheus_client isn't installed")
+            return
+        bp.config['metrics'] = metrics
+        bp.config['storage'] = metrics.MetricsStorageBackend(bp.config['storage'])
+
+    def configure_streaming(bp, storage_choice):
+        def setting(name, default=None):
+            # e.g. SWIFT_READ_AHEAD, falling back to READ_AHEAD
+            return bp.config.get(
+                "{}_{}".format(storage_choice.upper(), name), bp.config.get(name, default)
+            )
+
+        storage = bp.config['storage']
+        storage.read_ahead = int(setting('READ_AHEAD', 0))
+        adaptive = bool(setting('ADAPTIVE_CHUNKS', False))
+        for direction in ("read", "upload"):
+            size = setting("{}_CHUNK_SIZE".format(direction.upper()))
+            if size is None and not adaptive:
+                continue
+            setattr(storage, "{}_chunks".format(direction), ChunkSizing(
+                int(size or bp.config['BUFF']),
+                adaptive=adaptive,
+                minimum=int(setting('CHUNK_SIZE_MIN', 64 * 1024)),
+                maximum=int(setting('CHUNK_SIZE_MAX', 8 * 1024 * 1024))
+            ))
+
     def configure_s3(bp):
-        # TODO
-        raise NotImplemented("Yet")
+        from .s3 import S3StorageBackend
+        bp.config['storage'] = S3StorageBackend(
+            bp.config['S3_BUCKET'],
+            region_name=bp.config.get('S3_REGION'),
+            aws_access_key_id=bp.config.get('S3_ACCESS_KEY_ID'),
+            aws_secret_access_key=bp.config.get('S3_SECRET_ACCESS_KEY'),
+            endpoint_url=bp.config.get('S3_ENDPOINT_URL'),
+            part_size=int(bp.config.get('S3_PART_SIZE', 8 * 1024 * 1024)),
+            workers=int(bp.config.get('S3_WORKERS', 4))
+        )
 
-    app = setup_state.app
-    BLUEPRINT.config.update(app.config)
-    if BLUEPRINT.config.get('DEFER_CONFIG'):
-        log.debug("DEFER_CONFIG set, skipping configuration")
-        return
+    def configure_replicated(bp):
+        from .replicated import ReplicatedStorageBackend
+        backends = []
+        for choice in bp.config['REPLICATED_BACKENDS'].split(","):
+            choice = choice.strip().lower()
+            if choice == "replicated":
+                raise ValueError("Replicated backends can't be nested")
+            configure_backend(bp, choice)
+            configure_streaming(bp, choice)
+            backends.append(bp.config['storage'])
+        quorum = bp.config.get('REPLICATED_WRITE_QUORUM')
+        hedge_after = bp.config.get('REPLICATED_HEDGE_AFTER', 0.1)
+        bp.config['storage'] = ReplicatedStorageBackend(
+            backends,
+            write_quorum=int(quorum) if quorum else None,
+            hedge_after=float(hedge_after) if hedge_after not in (None, "") else None,
+            buffer_chunks=int(bp.config.get('REPLICATED_BUFFER_CHUNKS', 8))
+        )
+
+    def configure_plugin(bp, storage_choice):
+        # Backends from other packages, registered in the
+        # archstor.storage_backends entry point group as a callable which
+        # takes the configuration and returns an IStorageBackend
+        from importlib.metadata import entry_points
+        found = entry_points()
+        if hasattr(found, "select"):
+            found = found.select(group="archstor.storage_backends")
+        else:
+            found = found.get("archstor.storage_backends", [])
+        for entry_point in found:
+            if entry_point.name == storage_choice:
+                bp.config['storage'] = entry_point.load()(bp.config)
+                return
+        raise ValueError("Unknown storage backend: {}".format(storage_choice))
+
+    def configure_backend(bp, storage_choice):
+        if storage_choice in storage_options:
+            storage_options[storage_choice](bp)
+        else:
+            configure_plugin(bp, storage_choice)
+
+    def configure_membership_filter(bp):
+        from .membership import MembershipFilteredStorageBackend
+        rebuild_interval = bp.config.get('MEMBERSHIP_FILTER_REBUILD_INTERVAL')
+        bp.config['storage'] = MembershipFilteredStorageBackend(
+            bp.config['storage'],
+            bp.config['MEMBERSHIP_FILTER_DIR'],
+            capacity=int(bp.config.get('MEMBERSHIP_FILTER_CAPACITY', 1000000)),
+            error_rate=float(bp.config.get('MEMBERSHIP_FILTER_ERROR_RATE', 0.01)),
+            rebuild_interval=float(rebuild_interval) if rebuild_interval else None
+        )
+
+    def configure_ingest(bp):
+        from .ingest import WriteBehindStorageBackend
+        bp.config['storage'] = bp.config['ingest'] = WriteBehindStorageBackend(
+            bp.config['storage'],
+            bp.config['INGEST_STAGING_DIR'],
+            workers=int(bp.config.get('INGEST_WORKERS', 4)),
+            max_retries=int(bp.config.get('INGEST_MAX_RETRIES', 10)),
+            retry_backoff=float(bp.config.get('INGEST_RETRY_BACKOFF', 5)),
+            lease=float(bp.config.get('INGEST_LEASE', 300))
+        )
 
     storage_options = {
         "mongo": configure_mongo,
         "filesystem": configure_fs,
         "s3": configure_s3,
-        "swift": configure_swift
+        "swift": configure_swift,
+        "replicated": configure_replicated
     }
 
+    storage_choice = bp.config['STORAGE_BACKEND'].lower()
+    configure_backend(bp, storage_choice)
+    configure_streaming(bp, storage_choice)
+    if bp.config.get('MEMBERSHIP_FILTER_DIR'):
+        configure_membership_filter(bp)
+    if bp.config.get('INGEST_STAGING_DIR'):
+        configure_ingest(bp)
+    if bp.config.get('CACHE_DIR'):
+        configure_cache(bp)
+    if bp.config.get('METRICS'):
+        configure_metrics(bp)
+
+
+@BLUEPRINT.record
+def handle_configs(setup_state):
+    app = setup_state.app
+    BLUEPRINT.config.update(app.config)
+    if BLUEPRINT.config.get('DEFER_CONFIG'):
+        log.debug("DEFER_CONFIG set, skipping configuration")
+        return
+
     if BLUEPRINT.config.get('STORAGE_BACKEND'):
         storage_choice = BLUEPRINT.config['STORAGE_BACKEND'].lower()
 
@@ -461,7 +1128,7 @@ def handle_configs(setup_state):
             # the config['storage'] option somewhere else
             pass
         else:
-            storage_options[storage_choice](BLUEPRINT)
+            configure_storage(BLUEPRINT)
 
     if BLUEPRINT.config.get("VERBOSITY"):
         log.debug("Setting verbosity to {}".format(str(BLUEPRINT.config['VERBOSITY'])))
@@ -474,3 +1141,11 @@ def handle_configs(setup_state):
 API.add_resource(Root, "/")
 API.add_resource(Object, "/<string:id>")
 API.add_resource(Version, "/version")
+API.add_resource(BatchExists, "/_batch/exists")
+API.add_resource(BatchStat, "/_batch/stat")
+API.add_resource(BatchDelete, "/_batch/delete")
+API.add_resource(Archive, "/_archive")
+API.add_resource(Inventory, "/_inventory")
+API.add_resource(Metrics, "/_metrics")
+API.add_resource(IngestQueue, "/_ingest")
+API.add_resource(Ingest, "/_ingest/<string:id>")
@@ -0,0 +1,200 @@
+"""
+An asynchronous counterpart to IStorageBackend, used by the ASGI server
+(archstor.asgi) so an open object stream doesn't cost a thread
+"""
+import asyncio
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from . import chunk_size, forward_digests
+from .exceptions import FunctionalityOmittedError, ObjectNotFoundError
+from .fixity import DigestingReader
+
+
+class AsyncStorageBackend(metaclass=ABCMeta):
+    # The same methods, arguments and results as IStorageBackend, as
+    # coroutines. Streams in both directions are async readers, with a
+    # coroutine read(size=-1) (b"" once exhausted) and a coroutine close().
+
+    batch_concurrency = 8
+
+    @abstractmethod
+    async def get_object_id_list(self, cursor, limit, prefix=None):
+        pass
+
+    @abstractmethod
+    async def check_object_exists(self, id):
+        pass
+
+    @abstractmethod
+    async def get_object(self, id):
+        pass
+
+    async def get_object_range(self, id, start, stop):
+        raise FunctionalityOmittedError(
+            "Ranged reads are not available while using this storage backend"
+        )
+
+    async def stat_object(self, id):
+        raise FunctionalityOmittedError(
+            "Object metadata is not available while using this storage backend"
+        )
+
+    @abstractmethod
+    async def set_object(self, id, content):
+        pass
+
+    def read_chunk_size(self, length=None):
+        # As IStorageBackend.read_chunk_size, not a coroutine
+        return chunk_size(None, length)
+
+    @abstractmethod
+    async def del_object(self, id):
+        pass
+
+    async def _gather(self, func, ids):
+        # In: single identifier coroutine function + iterable of identifiers
+        # Out: dict of identifier -> result, at most batch_concurrency at once
+        ids = list(ids)
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def bounded(id):
+            async with semaphore:
+                return await func(id)
+        return dict(zip(ids, await asyncio.gather(*(bounded(x) for x in ids))))
+
+    async def check_objects_exist(self, ids):
+        return await self._gather(self.check_object_exists, ids)
+
+    async def stat_objects(self, ids):
+        async def stat_or_none(id):
+            try:
+                return await self.stat_object(id)
+            except ObjectNotFoundError:
+                return None
+        return await self._gather(stat_or_none, ids)
+
+    async def del_objects(self, ids):
+        async def delete(id):
+            await self.del_object(id)
+            return True
+        return await self._gather(delete, ids)
+
+
+class AsyncDigestingReader(DigestingReader):
+    # DigestingReader over an async reader, client supplied digests are
+    # checked before the final (empty) read returns
+    async def read(self, size=-1):
+        data = await self.src.read(size)
+        if data:
+            self.size += len(data)
+            for h in self.hashes.values():
+                h.update(data)
+        elif size != 0:
+            self.verify()
+        return data
+
+    async def close(self):
+        if hasattr(self.src, "close"):
+            await self.src.close()
+
+
+class ThreadedReader:
+    # An async reader over a blocking file like object, each read is run in
+    # the executor rather than the stream holding a thread while it's open
+    def __init__(self, f, executor):
+        self.f = f
+        self.executor = executor
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def read(self, size=-1):
+        return await self._run(self.f.read, size)
+
+    async def close(self):
+        if hasattr(self.f, "close"):
+            await self._run(self.f.close)
+
+
+class BlockingReader:
+    """
+    A blocking file like object over an async reader running on loop, for
+    handing request bodies to synchronous backends. Only usable from threads
+    other than the loop's own.
+    """
+    def __init__(self, src, loop):
+        self.src = src
+        self.loop = loop
+        self.content_length = getattr(src, "content_length", None)
+        forward_digests(self, src)
+
+    def read(self, size=-1):
+        return asyncio.run_coroutine_threadsafe(self.src.read(size), self.loop).result()
+
+    def close(self):
+        if hasattr(self.src, "close"):
+            asyncio.run_coroutine_threadsafe(self.src.close(), self.loop).result()
+
+
+class ThreadedAsyncStorageBackend(AsyncStorageBackend):
+    """
+    Adapts any IStorageBackend: calls are run in a thread pool, and streams
+    it returns are read a chunk at a time in the pool, so between reads a
+    slow client costs nothing but its buffers. Uploads do occupy a thread
+    for their duration, as the wrapped backend reads them synchronously.
+    """
+    def __init__(self, backend, executor=None, workers=32):
+        self.backend = backend
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        self.executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(func, *args, **kwargs)
+        )
+
+    def read_chunk_size(self, length=None):
+        return self.backend.read_chunk_size(length)
+
+    async def get_object_id_list(self, cursor, limit, prefix=None):
+        if prefix:
+            return await self._run(self.backend.get_object_id_list, cursor, limit, prefix=prefix)
+        return await self._run(self.backend.get_object_id_list, cursor, limit)
+
+    async def check_object_exists(self, id):
+        return await self._run(self.backend.check_object_exists, id)
+
+    async def get_object(self, id):
+        return ThreadedReader(await self._run(self.backend.get_object, id), self.executor)
+
+    async def get_object_range(self, id, start, stop):
+        contents, bounds, length = await self._run(
+            self.backend.get_object_range, id, start, stop
+        )
+        return ThreadedReader(contents, self.executor), bounds, length
+
+    async def stat_object(self, id):
+        return await self._run(self.backend.stat_object, id)
+
+    async def set_object(self, id, content):
+        return await self._run(
+            self.backend.set_object, id, BlockingReader(content, asyncio.get_running_loop())
+        )
+
+    async def del_object(self, id):
+        return await self._run(self.backend.del_object, id)
+
+    # The wrapped backend's batch operations are used as is, they're native
+    # where the backend supports it and already concurrent where it doesn't
+
+    async def check_objects_exist(self, ids):
+        return await self._run(self.backend.check_objects_exist, ids)
+
+    async def stat_objects(self, ids):
+        return await self._run(self.backend.stat_objects, ids)
+
+    async def del_objects(self, ids):
+        return await self._run(self.backend.del_objects, ids)
@@ -0,0 +1,132 @@
+"""
+Streams tar and zip archives of objects, without ever holding more than a
+chunk of any member in memory
+"""
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+
+from .exceptions import ServerError
+
+
+TAR_BLOCK = 512
+
+
+def prefetched(ids, open_member, depth=1):
+    # In: identifiers + a function opening one of them as a file like object
+    # Out: generator of (id, file like object), keeping the next depth
+    # objects' streams opening in the background while the current one is
+    # being consumed, so their latency overlaps with sending it
+    ids = iter(ids)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max(depth, 1))
+
+    def fill():
+        # The one about to be handed out, plus depth more
+        while len(pending) < depth + 1:
+            try:
+                id = next(ids)
+            except StopIteration:
+                return
+            pending.append((id, executor.submit(open_member, id)))
+
+    try:
+        fill()
+        while pending:
+            id, future = pending.popleft()
+            yield id, future.result()
+            fill()
+    finally:
+        # Close anything we opened but never handed out
+        for id, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for id, future in pending:
+            if not future.cancelled() and future.exception() is None:
+                e = future.result()
+                if hasattr(e, "close"):
+                    e.close()
+
+
+def _read_member(e, size, buff):
+    # Exactly size bytes, or an error, the archive framing depends on it
+    remaining = size
+    try:
+        while remaining > 0:
+            data = e.read(min(buff, remaining))
+            if not data:
+                raise ServerError("Object shorter than its recorded size")
+            remaining -= len(data)
+            yield data
+    finally:
+        if hasattr(e, "close"):
+            e.close()
+
+
+def tar_header(id, stat):
+    info = tarfile.TarInfo(name=id)
+    info.size = stat['size']
+    info.mtime = int(stat['last_modified'].timestamp())
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8")
+
+
+def tar_padding(size):
+    return (TAR_BLOCK - size % TAR_BLOCK) % TAR_BLOCK
+
+
+def tar_length(ids, stats):
+    # The exact length of the archive generate_tar will produce
+    return sum(
+        len(tar_header(id, stats[id])) + stats[id]['size'] + tar_padding(stats[id]['size'])
+        for id in ids
+    ) + 2 * TAR_BLOCK
+
+
+def generate_tar(ids, stats, open_member, buff, prefetch=1):
+    for id, e in prefetched(ids, open_member, prefetch):
+        size = stats[id]['size']
+        yield tar_header(id, stats[id])
+        yield from _read_member(e, size, buff)
+        padding = tar_padding(size)
+        if padding:
+            yield b"\0" * padding
+    yield b"\0" * (2 * TAR_BLOCK)
+
+
+class _Sink:
+    # An unseekable file like object that zipfile writes into, which we
+    # drain after every write
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def generate_zip(ids, stats, open_member, buff, prefetch=1):
+    # Members are stored (not compressed) with data descriptors and zip64
+    # extensions, so neither sizes nor CRCs need to be known up front
+    sink = _Sink()
+    with ZipFile(sink, "w", compression=ZIP_STORED, allowZip64=True) as zf:
+        for id, e in prefetched(ids, open_member, prefetch):
+            info = ZipInfo(
+                id, date_time=max(stats[id]['last_modified'].timetuple()[:6],
+                                  (1980, 1, 1, 0, 0, 0))
+            )
+            info.external_attr = 0o644 << 16
+            with zf.open(info, "w", force_zip64=True) as member:
+                for data in _read_member(e, stats[id]['size'], buff):
+                    member.write(data)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
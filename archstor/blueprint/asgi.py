@@ -0,0 +1,486 @@
+"""
+An ASGI application serving the same API as the flask one
+
+Object transfers, listings and the version are served natively, against an
+AsyncStorageBackend, so thousands of slow clients can be streaming at once
+without a thread each. Everything else (batch operations, archives,
+metrics, form uploads) is handed to the flask (WSGI) application, run on the
+same thread pool.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from uuid import uuid4
+
+from flask import Response
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_date, parse_etags, parse_if_range_header, \
+    parse_options_header, parse_range_header
+
+from . import BLUEPRINT, Object, __version__, check_id, check_limit, \
+    fixity_algorithms, if_range_holds, is_not_modified
+from .aio import AsyncDigestingReader, BlockingReader, ThreadedAsyncStorageBackend
+from .exceptions import Error, FunctionalityOmittedError, ObjectNotFoundError, \
+    RangeNotSatisfiableError, UserError
+from .fixity import parse_digest_headers
+
+
+log = logging.getLogger(__name__)
+
+
+# Request bodies flask has to parse, rather than being streamed to a backend
+FORM_MIMETYPES = ("multipart/form-data", "application/x-www-form-urlencoded")
+
+# Single segment paths flask routes somewhere other than /<id>
+RESERVED_PATHS = ("/version", "/_metrics", "/_archive", "/_ingest", "/_inventory")
+
+
+class RequestBody:
+    # The request body, as an async reader over ASGI receive
+    def __init__(self, receive):
+        self.receive = receive
+        self.buffer = bytearray()
+        self.more = True
+
+    async def _receive(self):
+        message = await self.receive()
+        if message["type"] == "http.disconnect":
+            raise UserError("The client disconnected before sending the whole body")
+        self.buffer += message.get("body", b"")
+        self.more = message.get("more_body", False)
+
+    async def read(self, size=-1):
+        if size is None or size < 0:
+            while self.more:
+                await self._receive()
+            size = len(self.buffer)
+        while self.more and len(self.buffer) < size:
+            await self._receive()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def close(self):
+        pass
+
+
+class Request:
+    def __init__(self, scope, receive, path):
+        self.scope = scope
+        self.receive = receive
+        self.path = path
+        self.method = scope["method"]
+        self.headers = Headers([
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in scope.get("headers", [])
+        ])
+        # First value wins, as with flask_restful's parsing
+        self.args = {}
+        for name, value in parse_qsl(scope.get("query_string", b"").decode("latin-1")):
+            self.args.setdefault(name, value)
+
+
+def start_message(status, headers=None, **kwargs):
+    # Headers are passed through flask's Response, so they get the same
+    # defaults (Content-Type and the like) the flask app would send
+    response = Response(status=status, headers=headers, **kwargs)
+    return {
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in response.headers.to_wsgi_list()
+        ]
+    }
+
+
+async def respond(send, status, headers=None, body=b"", **kwargs):
+    await send(start_message(status, headers, **kwargs))
+    await send({"type": "http.response.body", "body": body})
+
+
+async def respond_json(send, data, status=200, headers=None):
+    body = (json.dumps(data) + "\n").encode("utf-8")
+    headers = Headers(headers)
+    headers['Content-Length'] = str(len(body))
+    await respond(send, status, headers, body, mimetype="application/json")
+
+
+def build_environ(scope, path, body):
+    # In: ASGI http scope + path (without the root path) + blocking reader
+    # Out: WSGI environ, see PEP 3333
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # The body reader signals its own end, chunked or not
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+    if scope.get("client"):
+        environ['REMOTE_ADDR'] = scope["client"][0]
+        environ['REMOTE_PORT'] = str(scope["client"][1])
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+class ASGIApplication:
+    """
+    Serves wsgi_app's (archstor.app's) API over ASGI.
+
+    The backend used is BLUEPRINT.config['async_storage'] if one has been
+    configured, otherwise the synchronous BLUEPRINT.config['storage'] run
+    through a ThreadedAsyncStorageBackend.
+    """
+    def __init__(self, wsgi_app, workers=None):
+        self.wsgi_app = wsgi_app
+        self.workers = workers
+        self._executor = None
+        self._adapted = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            workers = self.workers or int(BLUEPRINT.config.get("ASYNC_WORKERS", 32))
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        return self._executor
+
+    def storage(self):
+        storage = BLUEPRINT.config.get('async_storage')
+        if storage is not None:
+            return storage
+        storage = BLUEPRINT.config['storage']
+        if self._adapted is None or self._adapted.backend is not storage:
+            self._adapted = ThreadedAsyncStorageBackend(storage, executor=self.executor)
+        return self._adapted
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError("Unsupported ASGI scope type: {}".format(scope["type"]))
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        request = Request(scope, receive, path)
+        route = self.route(request)
+        if route is None:
+            return await self.wsgi(scope, receive, send, path)
+        resource, handler, args = route
+        metrics = BLUEPRINT.config.get('metrics')
+        if metrics is not None:
+            send = metrics.asgi_send(send, resource, scope["method"])
+        started = []
+
+        async def tracked(message):
+            started.append(True)
+            await send(message)
+
+        try:
+            await handler(request, tracked, *args)
+        except Error as e:
+            if metrics is not None:
+                metrics.count_error(e)
+            if started:
+                # Too late for an error response, all we can do is cut the
+                # body short
+                raise
+            headers = {}
+            if isinstance(e, RangeNotSatisfiableError) and e.length is not None:
+                headers['Content-Range'] = "bytes */{}".format(e.length)
+            await respond_json(send, e.to_dict(), e.status_code, headers)
+
+    def route(self, request):
+        # Out: (resource name, handler, handler args) or None, for requests
+        # which are passed on to flask
+        method, path = request.method, request.path
+        if path == "/" and method == "GET":
+            return "Root", self.root, ()
+        if path == "/version" and method == "GET":
+            return "Version", self.version, ()
+        if path in RESERVED_PATHS or len(path) < 2 or "/" in path[1:]:
+            return None
+        id = path[1:]
+        if method == "PUT":
+            mimetype, _ = parse_options_header(request.headers.get("Content-Type", ""))
+            if mimetype in FORM_MIMETYPES:
+                return None
+            return "Object", self.put_object, (id,)
+        handlers = {
+            "GET": self.get_object,
+            "HEAD": self.head_object,
+            "DELETE": self.del_object
+        }
+        if method not in handlers:
+            return None
+        return "Object", handlers[method], (id,)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def urls(self, scope):
+        return self.wsgi_app.url_map.bind(
+            "localhost", script_name=scope.get("root_path") or "/"
+        )
+
+    async def root(self, request, send):
+        args = dict(request.args)
+        mimetype, _ = parse_options_header(request.headers.get("Content-Type", ""))
+        if mimetype == "application/x-www-form-urlencoded":
+            # flask_restful also takes arguments from a form body
+            body = await RequestBody(request.receive).read()
+            for name, value in parse_qsl(body.decode("latin-1")):
+                args.setdefault(name, value)
+        cursor = args.get("cursor", "0")
+        try:
+            limit = int(args.get("limit", 1000))
+        except ValueError:
+            raise UserError("limit must be an integer")
+        limit = check_limit(limit)
+        prefix = args.get("prefix") or None
+        storage = self.storage()
+        if prefix:
+            next_cursor, result = await storage.get_object_id_list(cursor, limit, prefix=prefix)
+        else:
+            next_cursor, result = await storage.get_object_id_list(cursor, limit)
+        urls = self.urls(request.scope)
+        await respond_json(send, {
+            "objects": [
+                {"identifier": x, "_link": urls.build("archstor.object", {"id": x})}
+                for x in result
+            ],
+            "pagination": {
+                "limit": limit,
+                "cursor": cursor,
+                "prefix": prefix,
+                "next_cursor": next_cursor
+            },
+            "_self": {
+                "identifier": None,
+                "_link": urls.build("archstor.root")
+            }
+        })
+
+    async def version(self, request, send):
+        await respond_json(send, {"version": __version__})
+
+    @staticmethod
+    async def stat(storage, id):
+        # Out: the backend's stat dict, or None if it can't provide one
+        try:
+            return await storage.stat_object(id)
+        except FunctionalityOmittedError:
+            return None
+
+    @staticmethod
+    def not_modified(request, stat):
+        return is_not_modified(
+            stat,
+            parse_etags(request.headers.get("If-None-Match")),
+            parse_date(request.headers.get("If-Modified-Since"))
+        )
+
+    async def head_object(self, request, send, id):
+        check_id(id)
+        storage = self.storage()
+        stat = await self.stat(storage, id)
+        if stat is None:
+            if not await storage.check_object_exists(id):
+                raise ObjectNotFoundError(str(id))
+            return await respond(send, 200)
+        headers = Object.stat_headers(stat)
+        if self.not_modified(request, stat):
+            return await respond(send, 304, headers)
+        headers['Content-Length'] = str(stat['size'])
+        await respond(send, 200, headers)
+
+    @staticmethod
+    async def send_stream(send, e, size, more_body=False):
+        try:
+            data = await e.read(size)
+            while data:
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+                data = await e.read(size)
+        finally:
+            # Also runs if the client goes away mid stream
+            await e.close()
+        if not more_body:
+            await send({"type": "http.response.body", "body": b""})
+
+    async def get_object(self, request, send, id):
+        check_id(id)
+        storage = self.storage()
+        stat = await self.stat(storage, id)
+        headers = Object.stat_headers(stat)
+        if self.not_modified(request, stat):
+            return await respond(send, 304, headers)
+        byte_ranges = parse_range_header(request.headers.get("Range"))
+        if byte_ranges is not None and byte_ranges.units == "bytes" and \
+                if_range_holds(stat, parse_if_range_header(request.headers.get("If-Range"))):
+            try:
+                e, (start, stop), length = await storage.get_object_range(
+                    id, *byte_ranges.ranges[0]
+                )
+            except FunctionalityOmittedError:
+                # Servers are free to ignore Range, so just send everything
+                log.debug("Backend can't serve ranges, sending whole object")
+            else:
+                headers['Accept-Ranges'] = "bytes"
+                if len(byte_ranges.ranges) == 1:
+                    headers['Content-Range'] = "bytes {}-{}/{}".format(
+                        start, stop - 1, length
+                    )
+                    headers['Content-Length'] = str(stop - start)
+                    await send(start_message(206, headers))
+                    return await self.send_stream(
+                        send, e, storage.read_chunk_size(stop - start)
+                    )
+                return await self.send_multipart(
+                    send, storage, id, headers, (e, (start, stop), length), byte_ranges.ranges
+                )
+        e = await storage.get_object(id)
+        if stat is not None:
+            headers['Content-Length'] = str(stat['size'])
+        await send(start_message(200, headers))
+        await self.send_stream(
+            send, e, storage.read_chunk_size(stat['size'] if stat is not None else None)
+        )
+
+    async def send_multipart(self, send, storage, id, headers, first, ranges):
+        # multipart/byteranges, see RFC 7233 Appendix A
+        boundary = uuid4().hex
+        await send(start_message(
+            206, headers, content_type="multipart/byteranges; boundary={}".format(boundary)
+        ))
+        for byte_range in ranges:
+            if first is not None:
+                e, (start, stop), length = first
+                first = None
+            else:
+                try:
+                    e, (start, stop), length = await storage.get_object_range(id, *byte_range)
+                except RangeNotSatisfiableError:
+                    # Unsatisfiable members of a range set are skipped
+                    continue
+            await send({
+                "type": "http.response.body",
+                "body": "--{}\r\nContent-Type: application/octet-stream\r\n"
+                "Content-Range: bytes {}-{}/{}\r\n\r\n".format(
+                    boundary, start, stop - 1, length
+                ).encode("ascii"),
+                "more_body": True
+            })
+            await self.send_stream(
+                send, e, storage.read_chunk_size(stop - start), more_body=True
+            )
+            await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+        await send({
+            "type": "http.response.body",
+            "body": "--{}--\r\n".format(boundary).encode("ascii")
+        })
+
+    async def put_object(self, request, send, id):
+        check_id(id)
+        # Client supplied digests (Content-MD5, Digest) are verified as the
+        # upload is read, failing it before the backend commits anything
+        content = AsyncDigestingReader(
+            RequestBody(request.receive), fixity_algorithms(),
+            parse_digest_headers(request.headers)
+        )
+        content.content_length = request.headers.get("Content-Length", type=int)
+        digests = await self.storage().set_object(id, content)
+        if BLUEPRINT.config.get('ingest') is None:
+            await respond_json(send, {'identifier': id, "added": True, "digests": digests})
+            return
+        # Only staged so far, see blueprint.added
+        await respond_json(send, {
+            'identifier': id, "added": True, "queued": True, "digests": digests,
+            "_link": self.urls(request.scope).build("archstor.ingest", {"id": id})
+        }, 202)
+
+    async def del_object(self, request, send, id):
+        await self.storage().del_object(id)
+        await respond_json(send, {"identifier": id, "deleted": True})
+
+    async def wsgi(self, scope, receive, send, path):
+        # Runs the flask app for one request. Each call into it (the request,
+        # then each chunk of the response) is a separate job on the thread
+        # pool, all in one context so flask's request context carries across
+        # them. Response chunks aren't produced faster than they're sent.
+        loop = asyncio.get_running_loop()
+        context = contextvars.Context()
+
+        async def run(func, *args):
+            return await loop.run_in_executor(self.executor, context.run, func, *args)
+
+        environ = build_environ(scope, path, BlockingReader(RequestBody(receive), loop))
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get("started"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(" ", 1)[0])
+            response['headers'] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+            return written.append
+
+        async def send_body(data):
+            if not response.get("started"):
+                response['started'] = True
+                await send({
+                    "type": "http.response.start",
+                    "status": response['status'],
+                    "headers": response['headers']
+                })
+            if data:
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+
+        result = await run(self.wsgi_app, environ, start_response)
+        try:
+            iterator = await run(iter, result)
+            while True:
+                data = await run(next, iterator, None)
+                while written:
+                    await send_body(written.pop(0))
+                if data is None:
+                    break
+                await send_body(data)
+            await send_body(b"")
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                await run(result.close)
@@ -0,0 +1,455 @@
+"""
+A read through cache which can be layered over any storage backend
+"""
+import logging
+import sqlite3
+from collections import OrderedDict
+from hashlib import sha256
+from io import BytesIO
+from os import fstat, makedirs, remove, rename, scandir
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+
+from . import RangedReader, WrappingStorageBackend, digesting, forward_digests, resolve_range
+from .pool import SqliteFile
+
+
+log = logging.getLogger(__name__)
+
+
+class ByteBudgetLRU:
+    """
+    Least recently used bookkeeping, bounded by the total size of the
+    entries rather than their count. on_evict is called with each evicted
+    key and value, outside of the lock.
+    """
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.total = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        evicted = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total -= old[1]
+                evicted.append((key, old[0]))
+            self._entries[key] = (value, size)
+            self.total += size
+            while self.total > self.max_bytes and self._entries:
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self.total -= old_size
+                evicted.append((old_key, old_value))
+        self._evicted(evicted)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self.total -= entry[1]
+        self._evicted([(key, entry[0])])
+        return entry[0]
+
+    def _evicted(self, evicted):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            self.on_evict(key, value)
+
+
+class DiskCache(SqliteFile):
+    """
+    The files in a cache directory, bounded by the total of their sizes,
+    least recently used first out. The sizes, when each was last used, and
+    their total are kept in a sqlite database in the directory, so every
+    process sharing it evicts against the same budget.
+
+    Entries are added, replaced, evicted and invalidated in transactions,
+    along with the renames and removals of their files, so those of
+    different processes never interleave. Invalidating an identifier
+    leaves a tombstone, and content read from before the latest one is
+    never added, so a read racing a delete can't put back what was deleted.
+    """
+    # Seconds tombstones are kept, and so how long a read can take and
+    # still be cached
+    TOMBSTONE_TTL = 3600
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        super().__init__(Path(cache_dir, ".index.sqlite3"))
+        with self.conn as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, " +
+                "size INTEGER NOT NULL, used REAL NOT NULL) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+            )
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('total', 0)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tombstones (key TEXT PRIMARY KEY, " +
+                "at REAL NOT NULL) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tombstones_at ON tombstones (at)")
+
+    def entry_path(self, key):
+        return Path(self.cache_dir, key)
+
+    @property
+    def total(self):
+        return self.conn.execute("SELECT value FROM meta WHERE key = 'total'").fetchone()[0]
+
+    def size(self, key):
+        # Out: the size of key's entry, or None if there isn't one
+        row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def touch(self, key):
+        with self.conn as conn:
+            conn.execute("UPDATE entries SET used = ? WHERE key = ?", (time(), key))
+
+    def add(self, key, tmp_path, size, since):
+        # Moves tmp_path into place as key's entry, unless key's been
+        # invalidated since the time since, evicting whatever that takes
+        # Out: whether it was added
+        now = time()
+        with self.transaction() as conn:
+            tombstone = conn.execute(
+                "SELECT at FROM tombstones WHERE key = ?", (key,)
+            ).fetchone()
+            # Tombstones older than the TTL are gone, so a read that long
+            # can't tell
+            if since < now - self.TOMBSTONE_TTL or \
+                    (tombstone is not None and tombstone[0] >= since):
+                self._remove(tmp_path)
+                return False
+            self._drop(conn, key)
+            rename(tmp_path, str(self.entry_path(key)))
+            conn.execute("INSERT INTO entries VALUES (?, ?, ?)", (key, size, now))
+            self._adjust(conn, size)
+            self._evict(conn)
+        return True
+
+    def invalidate(self, key):
+        now = time()
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO tombstones VALUES (?, ?)", (key, now))
+            conn.execute("DELETE FROM tombstones WHERE at < ?", (now - self.TOMBSTONE_TTL,))
+            self._drop(conn, key)
+
+    def reconcile(self):
+        # Brings the entries into line with the files actually there (what
+        # a process which crashed or predates the database left behind),
+        # then evicts down to the budget, which may have shrunk
+        with self.transaction() as conn:
+            known = dict(conn.execute("SELECT key, size FROM entries"))
+            found = set()
+            for entry in scandir(str(self.cache_dir)):
+                if not entry.is_file():
+                    continue
+                if entry.name.startswith(".tmp-"):
+                    if time() - entry.stat().st_mtime > 3600:
+                        # Left over from a crash
+                        self._remove(entry.path)
+                    continue
+                if entry.name.startswith("."):
+                    continue
+                found.add(entry.name)
+                if entry.name not in known:
+                    st = entry.stat()
+                    conn.execute("INSERT INTO entries VALUES (?, ?, ?)",
+                                 (entry.name, st.st_size, st.st_atime))
+            for key in set(known) - found:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            conn.execute(
+                "UPDATE meta SET value = (SELECT COALESCE(SUM(size), 0) FROM entries) " +
+                "WHERE key = 'total'"
+            )
+            self._evict(conn)
+
+    def _adjust(self, conn, delta):
+        conn.execute("UPDATE meta SET value = value + ? WHERE key = 'total'", (delta,))
+
+    def _drop(self, conn, key):
+        row = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._adjust(conn, -row[0])
+        # Whether it was an entry or not, another process may have just
+        # put it there
+        self._remove(str(self.entry_path(key)))
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT value FROM meta WHERE key = 'total'").fetchone()[0]
+        while total > self.max_bytes:
+            row = conn.execute(
+                "SELECT key, size FROM entries ORDER BY used LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self._drop(conn, row[0])
+            total -= row[1]
+
+    @staticmethod
+    def _remove(path):
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class CachingReader:
+    """
+    Passes reads through from src, writing a copy of everything read to a
+    temporary file. If src is read to the end, on_complete is called with the
+    temporary file's path and size, otherwise the copy is thrown away.
+    """
+    def __init__(self, src, cache_dir, max_size, on_complete):
+        self.src = src
+        self.max_size = max_size
+        self.on_complete = on_complete
+        self.size = 0
+        self.content_length = getattr(src, "content_length", None)
+        forward_digests(self, src)
+        self.sink = NamedTemporaryFile(dir=str(cache_dir), prefix=".tmp-", delete=False)
+
+    def _abort(self):
+        sink, self.sink = self.sink, None
+        if sink is not None:
+            sink.close()
+            try:
+                remove(sink.name)
+            except FileNotFoundError:
+                pass
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        if self.sink is None:
+            return data
+        if not data:
+            sink, self.sink = self.sink, None
+            sink.close()
+            self.on_complete(sink.name, self.size)
+            return data
+        self.size += len(data)
+        if self.size > self.max_size:
+            # Too big to ever fit, stop copying but keep streaming
+            self._abort()
+            return data
+        self.sink.write(data)
+        return data
+
+    def close(self):
+        try:
+            self._abort()
+        finally:
+            if hasattr(self.src, "close"):
+                self.src.close()
+
+
+class CachingStorageBackend(WrappingStorageBackend):
+    """
+    Wraps another backend with two tiers of cache, a small in memory one for
+    small objects, and a local disk one bounded by max_bytes, which every
+    process using the cache directory shares.
+
+    Objects can't be overwritten, so entries only ever need invalidating when
+    an object is deleted.
+    """
+    # Seconds between recording that an entry's been used, per process, so
+    # a popular object doesn't take the disk cache's lock on every hit
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, backend, cache_dir, max_bytes,
+                 memory_max_bytes=64 * 1024 * 1024, memory_max_object_size=64 * 1024,
+                 max_stats=100000):
+        super().__init__(backend)
+        self.cache_dir = Path(cache_dir)
+        self.memory_max_object_size = memory_max_object_size
+        makedirs(str(self.cache_dir), exist_ok=True)
+        self.memory = ByteBudgetLRU(memory_max_bytes)
+        self.disk = DiskCache(self.cache_dir, max_bytes)
+        # Stats are small, so just bound how many we keep
+        self.stats = ByteBudgetLRU(max_stats)
+        self._touched = ByteBudgetLRU(max_stats)
+        self.disk.reconcile()
+
+    @staticmethod
+    def _key(id):
+        return sha256(id.encode("utf-8")).hexdigest()
+
+    def _forget(self, key):
+        self.memory.pop(key)
+        self.stats.pop(key)
+
+    def _touch(self, key):
+        now = time()
+        touched = self._touched.get(key)
+        if touched is None or now - touched > self.TOUCH_INTERVAL:
+            self._touched.put(key, now, 1)
+            self.disk.touch(key)
+
+    def _cached(self, id):
+        # Out: (file like object, size) from one of the tiers, or None
+        # Every entry has a file on disk, even if it's also in memory. Other
+        # processes sharing the cache directory remove that file when they
+        # delete the object, which is how they invalidate our entries.
+        key = self._key(id)
+        path = self.disk.entry_path(key)
+        data = self.memory.get(key)
+        if data is not None:
+            if not path.is_file():
+                self._forget(key)
+                return None
+            self._touch(key)
+            return BytesIO(data), len(data)
+        try:
+            f = open(str(path), "rb")
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+        self._touch(key)
+        return f, fstat(f.fileno()).st_size
+
+    def _populate(self, id, tmp_path, size, since):
+        # since: when the content started being read, anything invalidating
+        # the id after which means it may be stale
+        key = self._key(id)
+        self._forget(key)
+        try:
+            if not self.disk.add(key, tmp_path, size, since):
+                return
+        except (OSError, sqlite3.Error):
+            # Not worth failing the request over
+            log.warning("Couldn't cache {}".format(str(id)), exc_info=True)
+            DiskCache._remove(tmp_path)
+            return
+        if size <= self.memory_max_object_size:
+            try:
+                with open(str(self.disk.entry_path(key)), "rb") as f:
+                    self.memory.put(key, f.read(), size)
+            except FileNotFoundError:
+                # Evicted or invalidated already
+                pass
+
+    def check_object_exists(self, id):
+        if self.disk.entry_path(self._key(id)).is_file():
+            return True
+        return self.backend.check_object_exists(id)
+
+    def get_object(self, id):
+        cached = self._cached(id)
+        if cached is not None:
+            return cached[0]
+        since = time()
+        return CachingReader(
+            self.backend.get_object(id), self.cache_dir, self.disk.max_bytes,
+            lambda tmp_path, size: self._populate(id, tmp_path, size, since)
+        )
+
+    def get_object_range(self, id, start, stop):
+        cached = self._cached(id)
+        if cached is None:
+            # Partial reads don't populate the cache
+            return self.backend.get_object_range(id, start, stop)
+        f, length = cached
+        try:
+            start, stop = resolve_range(start, stop, length)
+        except Exception:
+            f.close()
+            raise
+        f.seek(start)
+        return RangedReader(f, stop - start), (start, stop), length
+
+    def stat_object(self, id):
+        # Stats are only trusted while the content is cached as well
+        key = self._key(id)
+        if self.disk.entry_path(key).is_file():
+            stat_result = self.stats.get(key)
+            if stat_result is None:
+                stat_result = self.backend.stat_object(id)
+                self.stats.put(key, stat_result, 1)
+            return dict(stat_result)
+        return self.backend.stat_object(id)
+
+    def set_object(self, id, content):
+        # Recently ingested objects are likely to be requested, so cache
+        # them on the way in, but only once the backend has accepted them
+        # (it may refuse, if the object already exists)
+        completed = []
+        since = time()
+        reader = CachingReader(
+            digesting(content), self.cache_dir, self.disk.max_bytes,
+            lambda tmp_path, size: completed.append((tmp_path, size))
+        )
+        try:
+            digests = self.backend.set_object(id, reader)
+            if completed:
+                self._populate(id, *completed.pop(), since)
+            return digests
+        finally:
+            # Only a copy of the whole stream is worth keeping
+            reader._abort()
+            for tmp_path, size in completed:
+                DiskCache._remove(tmp_path)
+
+    def invalidate(self, id):
+        key = self._key(id)
+        self._forget(key)
+        # Removes the file even if another process cached it, and stops
+        # reads already under way caching it again
+        self.disk.invalidate(key)
+
+    def del_object(self, id):
+        self.invalidate(id)
+        try:
+            return self.backend.del_object(id)
+        finally:
+            # Again, as a read may have started between the first and the
+            # object's actually going
+            self.invalidate(id)
+
+    def check_objects_exist(self, ids):
+        results = {}
+        missing = []
+        for id in ids:
+            if self.disk.entry_path(self._key(id)).is_file():
+                results[id] = True
+            else:
+                missing.append(id)
+        if missing:
+            results.update(self.backend.check_objects_exist(missing))
+        return results
+
+    def stat_objects(self, ids):
+        return self.backend.stat_objects(ids)
+
+    def del_objects(self, ids):
+        ids = list(ids)
+        for id in ids:
+            self.invalidate(id)
+        try:
+            return self.backend.del_objects(ids)
+        finally:
+            for id in ids:
+                self.invalidate(id)
@@ -38,3 +38,12 @@ class ObjectAlreadyExistsError(UserError):
 class FunctionalityOmittedError(Error):
     error_name = "FunctionalityOmittedError"
     status_code = 501
+
+
+class RangeNotSatisfiableError(UserError):
+    error_name = "RangeNotSatisfiableError"
+    status_code = 416
+
+    def __init__(self, message=None, length=None):
+        super().__init__(message)
+        self.length = length
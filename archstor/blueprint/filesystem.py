@@ -0,0 +1,151 @@
+"""
+The file system (pairtree) storage backend
+"""
+import json
+from datetime import datetime, timezone
+from os import fstat, link, makedirs, remove, rename
+from pathlib import Path
+from tempfile import mkstemp
+
+from pypairtree.utils import identifier_to_path
+
+from . import IStorageBackend, RangedReader, content_length, copy_stream, decode_cursor, \
+    digesting, encode_cursor, resolve_range
+from .exceptions import FunctionalityOmittedError, ObjectAlreadyExistsError, \
+    ObjectNotFoundError
+from .fixity import primary_digest
+from .fsindex import IdentifierIndex
+
+
+class FileSystemStorageBackend(IStorageBackend):
+    def __init__(self, lts_root, index_path=None, use_index=True, index_workers=8):
+        self.lts_root = Path(lts_root)
+        self.index = None
+        self.index_workers = index_workers
+        if use_index:
+            if index_path is None:
+                index_path = Path(self.lts_root, ".archstor_index.sqlite3")
+            self.index = IdentifierIndex(index_path)
+
+    def _built_index(self):
+        if self.index is None:
+            raise FunctionalityOmittedError(
+                "This functionality is not available while using this storage backend"
+            )
+        # Bootstraps the index from the pairtree the first time through
+        self.index.ensure_built(self.lts_root, workers=self.index_workers)
+        return self.index
+
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        self._built_index()
+        offset, last_id = decode_cursor(cursor)
+        results = self.index.list(
+            after=last_id, limit=None if limit is None else limit + 1,
+            offset=offset, prefix=prefix
+        )
+        if limit is None or len(results) <= limit:
+            return None, results
+        results = results[:limit]
+        return encode_cursor(results[-1]), results
+
+    def iter_object_ids(self, prefix=None, start_after=None, page_size=1000):
+        # Keyset pages of the index, each a range scan from the last
+        index = self._built_index()
+        while True:
+            ids = index.list(after=start_after, limit=page_size, prefix=prefix)
+            yield from ids
+            if len(ids) < page_size:
+                return
+            start_after = ids[-1]
+
+    def get_object(self, id):
+        content_path = Path(
+            self.lts_root, identifier_to_path(id), "arf", "content.file"
+        )
+        try:
+            return open(str(content_path), "rb")
+        except FileNotFoundError:
+            raise ObjectNotFoundError(str(id))
+
+    def get_object_range(self, id, start, stop):
+        content_path = Path(
+            self.lts_root, identifier_to_path(id), "arf", "content.file"
+        )
+        if not content_path.is_file():
+            raise ObjectNotFoundError(str(id))
+        f = open(str(content_path), "rb")
+        try:
+            length = fstat(f.fileno()).st_size
+            start, stop = resolve_range(start, stop, length)
+            f.seek(start)
+        except Exception:
+            f.close()
+            raise
+        return RangedReader(f, stop - start), (start, stop), length
+
+    def stat_object(self, id):
+        content_path = Path(
+            self.lts_root, identifier_to_path(id), "arf", "content.file"
+        )
+        try:
+            st = content_path.stat()
+        except FileNotFoundError:
+            raise ObjectNotFoundError(str(id))
+        try:
+            with open(str(Path(content_path.parent, "digests.json"))) as f:
+                digests = json.load(f)
+        except FileNotFoundError:
+            digests = {}
+        return {
+            "size": st.st_size,
+            "last_modified": datetime.fromtimestamp(st.st_mtime, timezone.utc),
+            "digest": primary_digest(digests),
+            "digests": digests
+        }
+
+    def check_object_exists(self, id):
+        content_path = Path(
+            self.lts_root, identifier_to_path(id), "arf", "content.file"
+        )
+        return content_path.is_file()
+
+    def set_object(self, id, content):
+        content_path = Path(
+            self.lts_root, identifier_to_path(id), "arf", "content.file"
+        )
+        content = digesting(content)
+        makedirs(str(content_path.parent), exist_ok=True)
+        # Written to a temporary file (created O_CREAT | O_EXCL) and then
+        # hard linked into place, which fails atomically if the object
+        # exists, and means a partial object is never visible
+        fd, tmp_path = mkstemp(dir=str(content_path.parent), prefix=".content.file.")
+        try:
+            with open(fd, "wb") as f:
+                copy_stream(content, f, self.upload_chunk_size(content_length(content)))
+            link(tmp_path, str(content_path))
+        except FileExistsError:
+            raise ObjectAlreadyExistsError(str(id))
+        finally:
+            remove(tmp_path)
+        # A sidecar in the arf directory, next to the content
+        digests_path = Path(content_path.parent, "digests.json")
+        with open(str(digests_path) + ".tmp", "w") as f:
+            json.dump(content.hexdigests(), f)
+        rename(str(digests_path) + ".tmp", str(digests_path))
+        if self.index is not None:
+            self.index.add(id)
+        return content.hexdigests()
+
+    def del_object(self, id):
+        content_path = Path(
+            self.lts_root, identifier_to_path(id), "arf", "content.file"
+        )
+        if self.index is not None:
+            self.index.remove(id)
+        digests_path = Path(content_path.parent, "digests.json")
+        if digests_path.exists():
+            remove(str(digests_path))
+        if not content_path.exists():
+            return True
+        remove(str(content_path))
+        return True
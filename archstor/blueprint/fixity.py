@@ -0,0 +1,258 @@
+"""
+Fixity (checksum) computation, done incrementally while objects are
+streamed in, and a background audit which re-verifies stored objects
+"""
+import hashlib
+import json
+import logging
+from argparse import ArgumentParser
+from base64 import b64decode
+from binascii import Error as BinasciiError
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+
+from .exceptions import UserError
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_ALGORITHMS = ("md5", "sha256")
+
+# RFC 3230 / RFC 9530 digest algorithm names -> hashlib names
+HTTP_ALGORITHMS = {
+    "md5": "md5",
+    "sha": "sha1",
+    "sha-1": "sha1",
+    "sha-256": "sha256",
+    "sha-512": "sha512"
+}
+
+
+class DigestMismatchError(UserError):
+    error_name = "DigestMismatchError"
+
+
+def parse_digest_headers(headers):
+    # In: request headers
+    # Out: dict of hashlib algorithm name -> expected hex digest
+    expected = {}
+    values = []
+    for header in ("Digest", "Content-Digest"):
+        if headers.get(header):
+            values.extend(headers[header].split(","))
+    if headers.get("Content-MD5"):
+        values.append("md5=" + headers["Content-MD5"])
+    for value in values:
+        name, _, encoded = value.strip().partition("=")
+        algorithm = HTTP_ALGORITHMS.get(name.strip().lower())
+        if algorithm is None:
+            # Unknown algorithms may be ignored, RFC 3230 4.3.2
+            continue
+        try:
+            expected[algorithm] = b64decode(encoded.strip().strip(":"), validate=True).hex()
+        except (BinasciiError, ValueError):
+            raise UserError("Malformed digest header: {}".format(value.strip()))
+    return expected
+
+
+def primary_digest(digests):
+    # The digest used as an object's ETag
+    if not digests:
+        return None
+    if "md5" in digests:
+        return digests["md5"]
+    return digests[sorted(digests)[0]]
+
+
+class DigestingReader:
+    """
+    Passes reads through from src, updating a hash per algorithm as it goes.
+    If expected digests are given they're checked when src is exhausted,
+    before the final (empty) read returns, so a backend copying from this
+    fails before it commits anything.
+    """
+    def __init__(self, src, algorithms=DEFAULT_ALGORITHMS, expected=None):
+        self.src = src
+        self.expected = dict(expected or {})
+        algorithms = set(algorithms) | set(self.expected)
+        self.hashes = dict((x, hashlib.new(x)) for x in algorithms)
+        self.size = 0
+        self.verified = False
+        # How much there is to read, if known, which backends can size
+        # their chunks by
+        self.content_length = getattr(src, "content_length", None) or None
+
+    @classmethod
+    def wrap(cls, content, algorithms=DEFAULT_ALGORITHMS):
+        # Anything already computing digests (this class, or a wrapper
+        # exposing one) is passed through, so nothing is hashed twice
+        if hasattr(content, "hexdigests"):
+            return content
+        return cls(content, algorithms)
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        if data:
+            self.size += len(data)
+            for h in self.hashes.values():
+                h.update(data)
+        elif size != 0:
+            self.verify()
+        return data
+
+    def verify(self):
+        if self.verified:
+            return
+        digests = self.hexdigests()
+        for algorithm, value in self.expected.items():
+            if digests[algorithm] != value.lower():
+                raise DigestMismatchError(
+                    "{} mismatch, expected {} got {}".format(
+                        algorithm, value.lower(), digests[algorithm]
+                    )
+                )
+        self.verified = True
+
+    def hexdigests(self):
+        return dict((x, h.hexdigest()) for x, h in self.hashes.items())
+
+    def close(self):
+        if hasattr(self.src, "close"):
+            self.src.close()
+
+
+class RateLimiter:
+    """
+    A token bucket shared between threads, limiting throughput to
+    bytes_per_second (None for no limit)
+    """
+    def __init__(self, bytes_per_second=None):
+        self.rate = bytes_per_second
+        self.allowance = bytes_per_second or 0
+        self.last = monotonic()
+        self._lock = Lock()
+
+    def consume(self, n):
+        if not self.rate:
+            return
+        with self._lock:
+            now = monotonic()
+            self.allowance = min(
+                self.rate, self.allowance + (now - self.last) * self.rate
+            )
+            self.last = now
+            self.allowance -= n
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+class RateLimitedReader:
+    def __init__(self, src, limiter):
+        self.src = src
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+    def close(self):
+        if hasattr(self.src, "close"):
+            self.src.close()
+
+
+def audit_object(storage, id, buff, limiter=None):
+    # Out: dict describing the result of re-verifying one object
+    stored = storage.get_object_digests(id)
+    if not stored:
+        return {"identifier": id, "status": "no_digests"}
+    src = storage.get_object(id)
+    if limiter is not None:
+        src = RateLimitedReader(src, limiter)
+    reader = DigestingReader(src, stored.keys())
+    try:
+        while reader.read(buff):
+            pass
+    finally:
+        reader.close()
+    computed = reader.hexdigests()
+    mismatched = sorted(x for x in stored if stored[x] != computed[x])
+    if mismatched:
+        return {"identifier": id, "status": "mismatch", "algorithms": mismatched,
+                "stored": stored, "computed": computed}
+    return {"identifier": id, "status": "ok"}
+
+
+def iter_ids(storage, limit=1000):
+    cursor = "0"
+    while cursor is not None:
+        cursor, ids = storage.get_object_id_list(cursor, limit)
+        yield from ids
+
+
+def audit(storage, ids, workers=4, bytes_per_second=None, buff=1024 * 1000):
+    # In: backend + iterable of identifiers
+    # Out: generator of audit results, in completion order
+    # At most 2 * workers objects are in flight, so arbitrarily long listings
+    # don't pile up in memory
+    limiter = RateLimiter(bytes_per_second)
+    in_flight = BoundedSemaphore(2 * workers)
+    results = []
+    results_lock = Lock()
+
+    def run(id):
+        try:
+            result = audit_object(storage, id, buff, limiter)
+        except Exception as e:
+            result = {"identifier": id, "status": "error", "error": repr(e)}
+        finally:
+            in_flight.release()
+        with results_lock:
+            results.append(result)
+
+    def drain():
+        with results_lock:
+            done = results[:]
+            del results[:]
+        return done
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for id in ids:
+            in_flight.acquire()
+            executor.submit(run, id)
+            yield from drain()
+    yield from drain()
+
+
+def main():
+    parser = ArgumentParser(
+        description="Re-verify the stored fixity digests of archstor objects, " +
+        "using the backend configured by the ARCHSTOR_ environmental variables"
+    )
+    parser.add_argument("identifiers", nargs="*",
+                        help="Objects to audit, defaults to every object")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Maximum read throughput, in bytes per second")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO")
+
+    from . import BLUEPRINT
+    import archstor  # noqa: F401 (configures the blueprint's storage)
+
+    storage = BLUEPRINT.config['storage']
+    ids = args.identifiers or iter_ids(storage)
+    failures = 0
+    for result in audit(storage, ids, workers=args.workers,
+                        bytes_per_second=args.rate, buff=BLUEPRINT.config['BUFF']):
+        if result['status'] != "ok":
+            failures += 1
+        print(json.dumps(result), flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
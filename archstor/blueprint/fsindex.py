@@ -0,0 +1,186 @@
+"""
+An on-disk (sqlite) index of the identifiers stored in a pairtree, so that
+the file system backend can produce listings without walking the tree
+"""
+import logging
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, scandir
+from pathlib import Path
+from re import sub
+
+try:
+    from pypairtree.utils import identifier_to_path
+except ImportError:
+    # Hope we're not using a file system backend
+    pass
+
+from . import prefix_upper_bound
+from .pool import SqliteFile
+
+
+log = logging.getLogger(__name__)
+
+
+def path_to_identifier(parts):
+    # Reverses pairtree's identifier cleaning, see the pairtree spec 3.
+    joined = "".join(parts)
+    joined = joined.replace("=", "/").replace("+", ":").replace(",", ".")
+    return sub(r"\^([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), joined)
+
+
+def scan_pairtree(root, top=None):
+    # In: pairtree root + (optionally) one of its top level directories
+    # Out: generator of identifiers with an arf/content.file beneath them
+    stack = [((), Path(root)) if top is None else ((top,), Path(root, top))]
+    while stack:
+        parts, directory = stack.pop()
+        try:
+            entries = list(scandir(str(directory)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.name == "arf":
+                if Path(entry.path, "content.file").is_file():
+                    identifier = path_to_identifier(parts)
+                    if Path(identifier_to_path(identifier)) != Path(*parts):
+                        log.warning(
+                            "Can't map {} back to an identifier, skipping".format(
+                                str(directory)
+                            )
+                        )
+                        continue
+                    yield identifier
+                continue
+            stack.append((parts + (entry.name,), Path(entry.path)))
+
+
+class IdentifierIndex(SqliteFile):
+    """
+    A sorted set of identifiers, persisted in a sqlite database.
+
+    It's shared by every server writing the pairtree, typically over NFS,
+    which sqlite's write ahead log can't be used on (it needs memory shared
+    between the processes using it), so the rollback journal is used.
+    """
+    journal_mode = "DELETE"
+
+    def __init__(self, path):
+        super().__init__(path)
+        makedirs(str(self.path.parent), exist_ok=True)
+        with self.conn as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS objects (id TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    @property
+    def built(self):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'built'"
+        ).fetchone()
+        return row is not None
+
+    def add(self, id):
+        with self.conn as conn:
+            conn.execute("INSERT OR IGNORE INTO objects (id) VALUES (?)", (id,))
+
+    def remove(self, id):
+        with self.conn as conn:
+            conn.execute("DELETE FROM objects WHERE id = ?", (id,))
+
+    def list(self, after=None, limit=None, offset=0, prefix=None):
+        # In: exclusive lower bound, page size, legacy offset, prefix filter
+        # Out: list of identifiers, in order
+        clauses = []
+        params = []
+        if after is not None:
+            clauses.append("id > ?")
+            params.append(after)
+        if prefix:
+            clauses.append("id >= ?")
+            params.append(prefix)
+            upper = prefix_upper_bound(prefix)
+            if upper is not None:
+                clauses.append("id < ?")
+                params.append(upper)
+        query = "SELECT id FROM objects"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY id LIMIT ? OFFSET ?"
+        params.extend([-1 if limit is None else limit, offset])
+        return [row[0] for row in self.conn.execute(query, params)]
+
+    @contextmanager
+    def locked(self):
+        # Held while the index is (re)built, by whichever process is at it
+        with open(str(self.path) + ".lock", "w") as lock:
+            flock(lock, LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(lock, LOCK_UN)
+
+    def ensure_built(self, root, workers=8):
+        # Only one process (of however many share the index) does the
+        # initial scan, the rest wait for it to finish
+        if self.built:
+            return
+        with self.locked():
+            if not self.built:
+                self.rebuild(root, workers=workers)
+
+    def rebuild(self, root, workers=8):
+        # Walks each top level pairtree directory in its own thread, the
+        # walk is I/O bound, so this parallelizes well (especially over NFS)
+        # Listings are incomplete until this finishes.
+        tops = [
+            entry.name for entry in scandir(str(root))
+            if entry.is_dir(follow_symlinks=False)
+        ]
+        with self.conn as conn:
+            conn.execute("DELETE FROM meta WHERE key = 'built'")
+            conn.execute("DELETE FROM objects")
+        total = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scans = executor.map(lambda top: list(scan_pairtree(root, top)), tops)
+            for ids in scans:
+                with self.conn as conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO objects (id) VALUES (?)",
+                        ((id,) for id in ids)
+                    )
+                total += len(ids)
+        with self.conn as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+        log.info("Indexed {} identifiers beneath {}".format(str(total), str(root)))
+        return total
+
+
+def main():
+    parser = ArgumentParser(
+        description="(Re)build the identifier index of a file system archstor"
+    )
+    parser.add_argument("lts_root", help="The root of the pairtree")
+    parser.add_argument(
+        "--index", default=None,
+        help="The index location, defaults to .archstor_index.sqlite3 in the root"
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO")
+    index_path = args.index or Path(args.lts_root, ".archstor_index.sqlite3")
+    index = IdentifierIndex(index_path)
+    # Not while a server is building it as well
+    with index.locked():
+        index.rebuild(args.lts_root, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+"""
+Write behind ingest: uploads are staged on local disk and acknowledged,
+then written to the backend by background workers, retrying as needed. A
+sqlite journal of what's staged makes it crash safe, anything left there
+is picked up again when the next process starts.
+"""
+import json
+import logging
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from hashlib import sha256
+from os import O_RDONLY, close, fsync, getpid, makedirs, open as os_open, remove, scandir
+from pathlib import Path
+from threading import Event, Thread
+from time import sleep, time
+from uuid import uuid4
+
+from . import BLUEPRINT, RangedReader, WrappingStorageBackend, content_length, copy_stream, \
+    digesting, resolve_range
+from .exceptions import ObjectAlreadyExistsError
+from .fixity import DigestingReader, primary_digest
+from .pool import SqliteFile
+
+
+log = logging.getLogger(__name__)
+
+
+class IngestJournal(SqliteFile):
+    """
+    The staged objects, and where each is up to: "queued" (waiting for,
+    or between, attempts), "flushing" (claimed by a worker until
+    claimed_until, after which another may have it) or "failed" (given up on).
+    """
+    # An acknowledged upload has to survive a power cut
+    synchronous = "FULL"
+    row_factory = sqlite3.Row
+
+    def __init__(self, path):
+        super().__init__(path)
+        makedirs(str(self.path.parent), exist_ok=True)
+        with self.conn as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS staged (" +
+                "id TEXT PRIMARY KEY, file TEXT NOT NULL, size INTEGER NOT NULL, " +
+                "digests TEXT NOT NULL, staged_at REAL NOT NULL, state TEXT NOT NULL, " +
+                "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, " +
+                "claimed_until REAL, owner TEXT, error TEXT)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS staged_state ON staged (state, next_attempt)"
+            )
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['digests'] = json.loads(job['digests'])
+        return job
+
+    def add(self, id, file, size, digests):
+        # Out: False if the identifier is already staged
+        now = time()
+        try:
+            with self.conn as conn:
+                conn.execute(
+                    "INSERT INTO staged (id, file, size, digests, staged_at, state, " +
+                    "next_attempt) VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                    (id, file, size, json.dumps(digests), now, now)
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def get(self, id):
+        return self._job(self.conn.execute(
+            "SELECT * FROM staged WHERE id = ?", (id,)
+        ).fetchone())
+
+    def files(self):
+        return set(x[0] for x in self.conn.execute("SELECT file FROM staged"))
+
+    def claim(self, owner, lease):
+        # Out: the next job due, now claimed by owner for lease seconds, or
+        # None if there isn't one
+        while True:
+            now = time()
+            job = self._job(self.conn.execute(
+                "SELECT * FROM staged WHERE (state = 'queued' AND next_attempt <= ?) " +
+                "OR (state = 'flushing' AND claimed_until < ?) " +
+                "ORDER BY next_attempt LIMIT 1", (now, now)
+            ).fetchone())
+            if job is None:
+                return None
+            with self.conn as conn:
+                # Only if nobody else got there first
+                claimed = conn.execute(
+                    "UPDATE staged SET state = 'flushing', claimed_until = ?, owner = ? " +
+                    "WHERE id = ? AND state = ? AND owner IS ?",
+                    (now + lease, owner, job['id'], job['state'], job['owner'])
+                ).rowcount
+            if claimed:
+                job['owner'] = owner
+                return job
+
+    def renew(self, id, owner, lease):
+        # Extends owner's claim to lease seconds from now
+        # Out: False if the job is no longer owner's
+        with self.conn as conn:
+            return bool(conn.execute(
+                "UPDATE staged SET claimed_until = ? " +
+                "WHERE id = ? AND owner = ? AND state = 'flushing'",
+                (time() + lease, id, owner)
+            ).rowcount)
+
+    def finish(self, id, owner):
+        # Out: False if the job is no longer owner's (deleted, or its lease
+        # ran out and another worker has it)
+        with self.conn as conn:
+            return bool(conn.execute(
+                "DELETE FROM staged WHERE id = ? AND owner = ?", (id, owner)
+            ).rowcount)
+
+    def retry(self, id, owner, error, delay=None):
+        # Requeued after delay seconds, or failed for good if delay is None
+        with self.conn as conn:
+            conn.execute(
+                "UPDATE staged SET state = ?, attempts = attempts + 1, next_attempt = ?, " +
+                "claimed_until = NULL, owner = NULL, error = ? WHERE id = ? AND owner = ?",
+                ("failed" if delay is None else "queued", time() + (delay or 0),
+                 error, id, owner)
+            )
+
+    def requeue(self, id):
+        # Out: False if it isn't staged, or isn't failed
+        with self.conn as conn:
+            return bool(conn.execute(
+                "UPDATE staged SET state = 'queued', attempts = 0, next_attempt = ?, " +
+                "error = NULL WHERE id = ? AND state = 'failed'", (time(), id)
+            ).rowcount)
+
+    def remove(self, id):
+        # Out: the removed job, or None if it wasn't staged
+        with self.conn as conn:
+            job = self._job(conn.execute(
+                "SELECT * FROM staged WHERE id = ?", (id,)
+            ).fetchone())
+            if job is not None:
+                conn.execute("DELETE FROM staged WHERE id = ?", (id,))
+        return job
+
+    def summary(self):
+        # Out: dict of state -> count, with "oldest" (when the longest
+        # waiting object was staged, or None)
+        counts = dict(self.conn.execute(
+            "SELECT state, COUNT(*) FROM staged GROUP BY state"
+        ).fetchall())
+        oldest = self.conn.execute("SELECT MIN(staged_at) FROM staged").fetchone()[0]
+        result = dict((x, counts.get(x, 0)) for x in ("queued", "flushing", "failed"))
+        result['oldest'] = oldest
+        return result
+
+
+def status(job):
+    # A journal entry as the /_ingest/<id> resource presents it
+    return {
+        "identifier": job['id'],
+        "state": job['state'],
+        "size": job['size'],
+        "staged": datetime.fromtimestamp(job['staged_at'], timezone.utc).isoformat(),
+        "attempts": job['attempts'],
+        "error": job['error'],
+        "digests": job['digests']
+    }
+
+
+class WriteBehindStorageBackend(WrappingStorageBackend):
+    """
+    Wraps another backend. set_object durably stages the content in
+    staging_dir and returns, and worker threads (per process) write it to
+    the backend, retrying failures with exponential backoff (starting at
+    retry_backoff seconds) up to max_retries times. Until then the object
+    is served from the staging area, though it isn't listed (listings, and
+    their cursors, are the backend's own).
+
+    A worker holds a claim on an object for lease seconds, renewed every
+    third of that while it's writing it, so however long a large object
+    takes only a worker that's died loses its claim, and another may then
+    take it over.
+    """
+    def __init__(self, backend, staging_dir, workers=4, max_retries=10, retry_backoff=5,
+                 lease=300, poll_interval=5):
+        super().__init__(backend)
+        self.staging_dir = Path(staging_dir)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        makedirs(str(self.staging_dir), exist_ok=True)
+        self.journal = IngestJournal(Path(self.staging_dir, ".journal.sqlite3"))
+        self._wake = Event()
+        self._stopping = Event()
+        self._pid = None
+        self._sweep()
+        self.start()
+
+    def start(self):
+        # Workers don't survive a fork, so each process starts its own
+        if self._pid == getpid():
+            return
+        self._pid = getpid()
+        self._stopping.clear()
+        for x in range(self.workers):
+            Thread(target=self._work, daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def _sweep(self):
+        # Staged files which never made it into the journal (the process
+        # died in between), old enough not to be a stage in progress
+        referenced = self.journal.files()
+        for entry in scandir(str(self.staging_dir)):
+            if entry.name.startswith(".journal") or entry.name in referenced:
+                continue
+            if entry.is_file() and time() - entry.stat().st_mtime > 3600:
+                remove(entry.path)
+
+    def _path(self, job):
+        return str(Path(self.staging_dir, job['file']))
+
+    def _metrics(self, summary=None):
+        metrics = BLUEPRINT.config.get('metrics')
+        if metrics is not None:
+            if summary is None:
+                summary = self.journal.summary()
+            for state in ("queued", "flushing", "failed"):
+                metrics.INGEST_STAGED.labels(state).set(summary[state])
+        return metrics
+
+    def set_object(self, id, content):
+        self.start()
+        # Refused now, rather than acknowledged and then failing for good
+        if self.journal.get(id) is not None or self.backend.check_object_exists(id):
+            raise ObjectAlreadyExistsError(str(id))
+        content = digesting(content)
+        name = "{}-{}".format(sha256(id.encode("utf-8")).hexdigest(), uuid4().hex)
+        path = str(Path(self.staging_dir, name))
+        try:
+            with open(path, "wb") as f:
+                size = copy_stream(content, f, self.upload_chunk_size(content_length(content)))
+                f.flush()
+                fsync(f.fileno())
+            fsync_dir(str(self.staging_dir))
+            if not self.journal.add(id, name, size, content.hexdigests()):
+                raise ObjectAlreadyExistsError(str(id))
+        except BaseException:
+            remove_quietly(path)
+            raise
+        self._metrics()
+        self._wake.set()
+        return content.hexdigests()
+
+    def queued(self, id):
+        # Out: bool, whether id is staged rather than in the backend
+        return self.journal.get(id) is not None
+
+    def status(self, id):
+        job = self.journal.get(id)
+        return status(job) if job is not None else None
+
+    def retry(self, id):
+        # Out: False if id isn't staged and failed
+        if not self.journal.requeue(id):
+            return False
+        self._metrics()
+        self._wake.set()
+        return True
+
+    def _work(self):
+        owner = "{}-{}".format(getpid(), uuid4().hex)
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                job = self.journal.claim(owner, self.lease)
+            except sqlite3.Error:
+                log.exception("Couldn't read the ingest journal")
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                continue
+            try:
+                self.flush(job)
+            except Exception:
+                log.exception("Flushing %s failed unexpectedly", job['id'])
+
+    def flush(self, job):
+        id, owner = job['id'], job['owner']
+        try:
+            with open(self._path(job), "rb") as f:
+                # Re-verified on the way out, in case the staged copy has
+                # come to harm
+                reader = DigestingReader(f, job['digests'], job['digests'])
+                reader.content_length = job['size']
+                try:
+                    with self._holding(job):
+                        self.backend.set_object(id, reader)
+                except ObjectAlreadyExistsError:
+                    # A previous attempt got there, without being recorded,
+                    # or something else did
+                    if not self._stored(id, job['digests']):
+                        raise
+        except Exception as e:
+            self._failed(job, e)
+            return
+        if self.journal.finish(id, owner):
+            remove_quietly(self._path(job))
+            metrics = self._metrics()
+            if metrics is not None:
+                metrics.INGEST_FLUSH_SECONDS.observe(time() - job['staged_at'])
+        elif self.journal.get(id) is None:
+            # Deleted while it was being written
+            self.backend.del_object(id)
+
+    @contextmanager
+    def _holding(self, job):
+        # Renews the claim on job from a heartbeat thread until the block's
+        # done
+        done = Event()
+
+        def heartbeat():
+            while not done.wait(self.lease / 3):
+                try:
+                    if not self.journal.renew(job['id'], job['owner'], self.lease):
+                        # Deleted, or taken over after all
+                        return
+                except sqlite3.Error:
+                    log.warning("Couldn't renew the claim on %s", job['id'], exc_info=True)
+
+        thread = Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def _stored(self, id, digests):
+        # Out: bool, whether the backend's copy has the same digests
+        try:
+            stored = self.backend.get_object_digests(id)
+        except Exception:
+            return False
+        common = set(stored) & set(digests)
+        return bool(common) and all(stored[x] == digests[x] for x in common)
+
+    def _failed(self, job, e):
+        attempts = job['attempts'] + 1
+        permanent = isinstance(e, ObjectAlreadyExistsError) or attempts > self.max_retries
+        delay = None if permanent else self.retry_backoff * 2 ** (attempts - 1)
+        log.warning("Writing %s to the backend failed (attempt %s), %s: %s", job['id'],
+                    attempts, "giving up" if permanent else "retrying", e)
+        self.journal.retry(job['id'], job['owner'], "{}: {}".format(type(e).__name__, e),
+                           delay)
+        metrics = self._metrics()
+        if metrics is not None:
+            (metrics.INGEST_FAILURES if permanent else metrics.INGEST_RETRIES).inc()
+
+    def _staged(self, id):
+        # Out: (open staged file, job) or None if id isn't staged
+        job = self.journal.get(id)
+        if job is None:
+            return None
+        try:
+            return open(self._path(job), "rb"), job
+        except FileNotFoundError:
+            # Flushed (or deleted) since
+            return None
+
+    def check_object_exists(self, id):
+        return self.queued(id) or self.backend.check_object_exists(id)
+
+    def get_object(self, id):
+        staged = self._staged(id)
+        if staged is None:
+            return self.backend.get_object(id)
+        return staged[0]
+
+    def get_object_range(self, id, start, stop):
+        staged = self._staged(id)
+        if staged is None:
+            return self.backend.get_object_range(id, start, stop)
+        f, job = staged
+        try:
+            start, stop = resolve_range(start, stop, job['size'])
+        except Exception:
+            f.close()
+            raise
+        f.seek(start)
+        return RangedReader(f, stop - start), (start, stop), job['size']
+
+    def stat_object(self, id):
+        job = self.journal.get(id)
+        if job is None:
+            return self.backend.stat_object(id)
+        return {
+            "size": job['size'],
+            "last_modified": datetime.fromtimestamp(int(job['staged_at']), timezone.utc),
+            "digest": primary_digest(job['digests']),
+            "digests": job['digests']
+        }
+
+    def get_object_digests(self, id):
+        job = self.journal.get(id)
+        if job is None:
+            return self.backend.get_object_digests(id)
+        return job['digests']
+
+    def del_object(self, id):
+        job = self.journal.remove(id)
+        if job is not None:
+            remove_quietly(self._path(job))
+            self._metrics()
+        self.backend.del_object(id)
+
+    def check_objects_exist(self, ids):
+        ids = list(ids)
+        staged = [x for x in ids if self.queued(x)]
+        results = self.backend.check_objects_exist([x for x in ids if x not in staged])
+        results.update((x, True) for x in staged)
+        return dict((x, results[x]) for x in ids)
+
+    def del_objects(self, ids):
+        ids = list(ids)
+        for id in ids:
+            job = self.journal.remove(id)
+            if job is not None:
+                remove_quietly(self._path(job))
+        self._metrics()
+        return self.backend.del_objects(ids)
+
+    def wait(self, timeout=None):
+        # Blocks until nothing is queued or being written (failures aside),
+        # or timeout seconds have passed. Out: bool, whether it emptied
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            summary = self.journal.summary()
+            if not summary['queued'] and not summary['flushing']:
+                return True
+            if deadline is not None and time() >= deadline:
+                return False
+            sleep(0.01)
+
+
+def fsync_dir(path):
+    # So a new file's directory entry survives a crash too
+    fd = os_open(path, O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+
+def remove_quietly(path):
+    try:
+        remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,461 @@
+"""
+A counting Bloom filter of the identifiers in the backend, which answers
+"definitely not there" for existence checks and reads of missing objects
+without a round trip to the backend
+
+Every process keeps its own copy of the filter, kept in step through a
+change log shared in a (local) directory, along with a snapshot of the
+filter so new processes start warm rather than re-listing the backend.
+The filter is only complete if every write to the backend goes through
+archstor processes sharing that directory.
+"""
+import json
+import logging
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from hashlib import blake2b
+from math import ceil, log as ln
+from os import fsync, getpid, makedirs, rename
+from pathlib import Path
+from threading import Lock, Thread
+from time import time
+
+from . import WrappingStorageBackend
+from .exceptions import ObjectNotFoundError
+from .pool import SqliteFile
+
+
+log = logging.getLogger(__name__)
+
+
+class CountingBloomFilter:
+    """
+    A Bloom filter of one byte counters rather than bits, so members can be
+    removed as well as added. A saturated counter (255) is never decremented
+    again, which only costs false positives. False negatives can only come
+    from removing something that was never added.
+    """
+    MAGIC = b"archstor-cbf\n"
+
+    def __init__(self, size, hashes, counters=None, count=0):
+        self.size = size
+        self.hashes = hashes
+        self.counters = counters if counters is not None else bytearray(size)
+        # Approximately how many members there are
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        # The optimal size and number of hashes for capacity members at
+        # error_rate false positives
+        size = max(ceil(-capacity * ln(error_rate) / ln(2) ** 2), 64)
+        return cls(size, max(round(size / capacity * ln(2)), 1))
+
+    def _indexes(self, id):
+        # Double hashing, see Kirsch and Mitzenmacher 2006
+        digest = blake2b(id.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, id):
+        counters = self.counters
+        for i in self._indexes(id):
+            if counters[i] < 255:
+                counters[i] += 1
+        self.count += 1
+
+    def remove(self, id):
+        counters = self.counters
+        for i in self._indexes(id):
+            if 0 < counters[i] < 255:
+                counters[i] -= 1
+        self.count = max(self.count - 1, 0)
+
+    def __contains__(self, id):
+        counters = self.counters
+        return all(counters[i] for i in self._indexes(id))
+
+    def save(self, path, seq):
+        # Written aside and renamed into place, so readers never see half of
+        # one. seq is the last change log entry it includes.
+        tmp = "{}.tmp-{}".format(path, getpid())
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(json.dumps({
+                "size": self.size, "hashes": self.hashes, "count": self.count,
+                "seq": seq, "saved": time()
+            }).encode("utf-8") + b"\n")
+            f.write(self.counters)
+            f.flush()
+            fsync(f.fileno())
+        rename(tmp, str(path))
+
+    @classmethod
+    def load(cls, path):
+        # Out: (filter, header dict) or None if there's no usable snapshot
+        try:
+            with open(str(path), "rb") as f:
+                if f.readline() != cls.MAGIC:
+                    return None
+                header = json.loads(f.readline().decode("utf-8"))
+                counters = bytearray(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(counters) != header['size']:
+            return None
+        return cls(header['size'], header['hashes'], counters, header['count']), header
+
+
+class ChangeLog(SqliteFile):
+    """
+    Additions and removals, in order, shared between processes. Entries up
+    to the latest snapshot are truncated away, and processes further behind
+    than that reload the snapshot.
+
+    Alongside it, whether each identifier written or deleted through
+    archstor is counted as present, how many writes of it are under way,
+    and a version bumped by every write, so an identifier is only ever
+    removed once for each time it was added, however writes and deletes of
+    it overlap. Each change is decided and logged in one short transaction,
+    which every process takes in turn; anything asked of the backend is
+    asked outside of it, and the decision is only made if the identifier's
+    version shows no write has started in the meantime.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        with self.conn as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS changes (" +
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL, op INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS members (id TEXT PRIMARY KEY, " +
+                "present INTEGER NOT NULL, writers INTEGER NOT NULL, " +
+                "version INTEGER NOT NULL) WITHOUT ROWID"
+            )
+
+    @staticmethod
+    def _member(conn, id):
+        # Out: (present, writers, version), or None if it's only known to
+        # the listing
+        return conn.execute(
+            "SELECT present, writers, version FROM members WHERE id = ?", (id,)
+        ).fetchone()
+
+    def members(self, ids):
+        # Out: dict of id -> (present, writers, version) or None
+        conn = self.conn
+        return dict((id, self._member(conn, id)) for id in ids)
+
+    def writing(self, id):
+        # A write of id is starting, it's added unless it's already counted
+        with self.transaction() as conn:
+            member = self._member(conn, id)
+            conn.execute(
+                "INSERT INTO members (id, present, writers, version) VALUES (?, 1, 1, 1) " +
+                "ON CONFLICT (id) DO UPDATE SET present = 1, writers = writers + 1, " +
+                "version = version + 1", (id,)
+            )
+            if member is None or not member[0]:
+                conn.execute("INSERT INTO changes (id, op) VALUES (?, 1)", (id,))
+
+    def written(self, id, failed, exists):
+        # A write of id has finished. If it failed it's removed again, but
+        # only if it was the last write of it under way, exists says the
+        # backend hasn't got it, and no other write has started since.
+        with self.transaction() as conn:
+            conn.execute("UPDATE members SET writers = writers - 1 WHERE id = ?", (id,))
+            member = self._member(conn, id)
+        if not failed or member is None or not member[0] or member[1] > 0:
+            return
+        try:
+            there = exists()
+        except Exception:
+            log.warning("Couldn't tell if %s was written, leaving it in the filter", id,
+                        exc_info=True)
+            there = True
+        if not there:
+            self.removed({id: member})
+
+    def removed(self, before):
+        # In: dict of id -> its member (see members) from before it was
+        # deleted from the backend
+        # Out: the ids removed. Only those counted as present with no write
+        # under way are, and only if they're unchanged since: another delete
+        # may have removed one first, or a write started (and be about to
+        # put it back). Those only known to the listing are left in the
+        # filter, which is safe (a stale positive is passed through to the
+        # backend) where removing one that wasn't there isn't, until it's
+        # next rebuilt.
+        removed = []
+        with self.transaction() as conn:
+            for id, member in before.items():
+                if member is None or not member[0] or member[1] > 0:
+                    continue
+                if self._member(conn, id) == tuple(member):
+                    self._remove(conn, id)
+                    removed.append(id)
+        return removed
+
+    @staticmethod
+    def _remove(conn, id):
+        conn.execute("UPDATE members SET present = 0 WHERE id = ?", (id,))
+        conn.execute("INSERT INTO changes (id, op) VALUES (?, -1)", (id,))
+
+    def last(self):
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def truncated(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'truncated'").fetchone()
+        return row[0] if row is not None else 0
+
+    def since(self, seq):
+        # Out: list of (seq, id, op) after seq
+        return self.conn.execute(
+            "SELECT seq, id, op FROM changes WHERE seq > ? ORDER BY seq", (seq,)
+        ).fetchall()
+
+    def truncate(self, seq):
+        with self.conn as conn:
+            conn.execute("DELETE FROM changes WHERE seq <= ?", (seq,))
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('truncated', ?) " +
+                "ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)", (seq,)
+            )
+
+
+class MembershipFilteredStorageBackend(WrappingStorageBackend):
+    """
+    Wraps another backend, answering existence checks and reads of
+    identifiers the filter says aren't there without asking the backend.
+
+    The filter is loaded from the snapshot in directory, or if there isn't
+    one (or it's more than rebuild_interval seconds old) rebuilt from the
+    backend's listing in the background, everything being passed through
+    to the backend until it's ready. It is sized for capacity identifiers
+    at error_rate false positives, or twice the identifiers listed if
+    there are more. A snapshot is saved every snapshot_every changes.
+    """
+    def __init__(self, backend, directory, capacity=1000000, error_rate=0.01,
+                 rebuild_interval=None, snapshot_every=10000):
+        super().__init__(backend)
+        self.directory = Path(directory)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.snapshot_every = snapshot_every
+        makedirs(str(self.directory), exist_ok=True)
+        self.snapshot_path = Path(self.directory, "filter.snapshot")
+        self.lock_path = Path(self.directory, "filter.lock")
+        self.changes = ChangeLog(Path(self.directory, "changes.sqlite3"))
+        self.filter = None
+        self.seq = 0
+        self.unsaved = 0
+        self._lock = Lock()
+        self._tried = 0
+        self._building = False
+        self._requested = 0
+        header = self._load()
+        if header is None or (rebuild_interval and time() - header['saved'] > rebuild_interval):
+            self.rebuild(background=True)
+
+    @property
+    def ready(self):
+        return self.filter is not None
+
+    def _load(self):
+        # Out: the snapshot's header, or None if there isn't one
+        loaded = CountingBloomFilter.load(self.snapshot_path)
+        if loaded is None:
+            return None
+        with self._lock:
+            self.filter, header = loaded
+            self.seq = header['seq']
+            self.unsaved = 0
+        self._catch_up(reload=False)
+        return header
+
+    def _catch_up(self, reload=True):
+        with self._lock:
+            if self.filter is None:
+                return
+            behind = self.changes.truncated() > self.seq
+            if not behind or not reload:
+                for seq, id, op in self.changes.since(self.seq):
+                    if op > 0:
+                        self.filter.add(id)
+                    else:
+                        self.filter.remove(id)
+                    self.seq = seq
+                    self.unsaved += 1
+        if behind and reload:
+            # Too far behind, the snapshot has what we missed
+            self._load()
+        elif self.unsaved >= self.snapshot_every:
+            self.snapshot(block=False)
+
+    def snapshot(self, block=True):
+        # Out: bool, whether one was saved (not if another process is at it,
+        # and block is False)
+        with open(str(self.lock_path), "a") as lock:
+            try:
+                flock(lock, LOCK_EX if block else LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                with self._lock:
+                    if self.filter is None:
+                        return False
+                    seq = self.seq
+                    bloom = CountingBloomFilter(
+                        self.filter.size, self.filter.hashes,
+                        bytearray(self.filter.counters), self.filter.count
+                    )
+                    self.unsaved = 0
+                bloom.save(self.snapshot_path, seq)
+                self.changes.truncate(seq)
+            finally:
+                flock(lock, LOCK_UN)
+        return True
+
+    def rebuild(self, background=False):
+        self._requested = time()
+        if background:
+            with self._lock:
+                if self._building:
+                    return
+                self._building = True
+            Thread(target=self._rebuild, daemon=True).start()
+        else:
+            self._rebuild()
+
+    def _rebuild(self):
+        try:
+            with open(str(self.lock_path), "a") as lock:
+                flock(lock, LOCK_EX)
+                try:
+                    self._build()
+                finally:
+                    flock(lock, LOCK_UN)
+        except Exception:
+            log.exception("Couldn't build the membership filter, so it's not in use")
+        finally:
+            self._building = False
+
+    def _build(self):
+        loaded = CountingBloomFilter.load(self.snapshot_path)
+        if loaded is not None and loaded[1]['saved'] >= self._requested:
+            # Another process did while we waited for the lock
+            self._load()
+            return
+        start = self.changes.last()
+        # Sized for capacity, or what the last snapshot held if that's more,
+        # and listed again into one twice the size if the listing outgrows it
+        capacity = self.capacity
+        if loaded is not None:
+            capacity = max(capacity, 2 * loaded[0].count)
+        while True:
+            bloom = CountingBloomFilter.for_capacity(capacity, self.error_rate)
+            for id in self.backend.iter_object_ids():
+                bloom.add(id)
+            if bloom.count <= capacity:
+                break
+            capacity = 2 * bloom.count
+        listed = bloom.count
+        # Additions since the listing began, which it may have missed.
+        # Removals can't be told apart from identifiers it never saw, so
+        # they're left out, at the cost of a few false positives.
+        seq = start
+        for seq, id, op in self.changes.since(start):
+            if op > 0:
+                bloom.add(id)
+        bloom.save(self.snapshot_path, seq)
+        self.changes.truncate(seq)
+        log.info("Built a membership filter of %s identifiers", listed)
+        self._load()
+
+    def _absent(self, id):
+        # Out: True only if id is definitely not in the backend
+        if self.filter is None:
+            if time() - self._tried > 1:
+                # Perhaps another process (or the one we forked from) has
+                # built it since
+                self._tried = time()
+                self._load()
+            if self.filter is None:
+                return False
+        if id in self.filter:
+            return False
+        # Something may have added it since we last looked
+        self._catch_up()
+        return id not in self.filter
+
+    def check_object_exists(self, id):
+        if self._absent(id):
+            return False
+        return self.backend.check_object_exists(id)
+
+    def check_objects_exist(self, ids):
+        ids = list(ids)
+        maybe = [x for x in ids if not self._absent(x)]
+        results = self.backend.check_objects_exist(maybe) if maybe else {}
+        return dict((x, results.get(x, False)) for x in ids)
+
+    def get_object(self, id):
+        if self._absent(id):
+            raise ObjectNotFoundError(str(id))
+        return self.backend.get_object(id)
+
+    def get_object_range(self, id, start, stop):
+        if self._absent(id):
+            raise ObjectNotFoundError(str(id))
+        return self.backend.get_object_range(id, start, stop)
+
+    def stat_object(self, id):
+        if self._absent(id):
+            raise ObjectNotFoundError(str(id))
+        return self.backend.stat_object(id)
+
+    def get_object_digests(self, id):
+        if self._absent(id):
+            raise ObjectNotFoundError(str(id))
+        return self.backend.get_object_digests(id)
+
+    def stat_objects(self, ids):
+        ids = list(ids)
+        maybe = [x for x in ids if not self._absent(x)]
+        results = self.backend.stat_objects(maybe) if maybe else {}
+        return dict((x, results.get(x)) for x in ids)
+
+    def set_object(self, id, content):
+        # Added first, so no process answers "not there" once it is. If the
+        # write fails it's only taken out again if the backend hasn't got it
+        # (it may have committed before failing, or have been there before)
+        self.changes.writing(id)
+        failed = True
+        try:
+            digests = self.backend.set_object(id, content)
+            failed = False
+            return digests
+        finally:
+            self.changes.written(id, failed, lambda: self.backend.check_object_exists(id))
+            self._catch_up()
+
+    def del_object(self, id):
+        # Removing something that was never added would cause false
+        # negatives, so only what archstor counted as present is removed
+        before = self.changes.members([id])
+        self.backend.del_object(id)
+        if self.changes.removed(before):
+            self._catch_up()
+
+    def del_objects(self, ids):
+        ids = list(ids)
+        before = self.changes.members(ids)
+        results = self.backend.del_objects(ids)
+        if self.changes.removed(dict((x, before[x]) for x in ids if results.get(x))):
+            self._catch_up()
+        return results
@@ -0,0 +1,284 @@
+"""
+Prometheus instrumentation, of requests and of the configured storage backend
+
+Under gunicorn (or anything else which forks workers) set
+PROMETHEUS_MULTIPROC_DIR to an empty directory before the workers start, so
+every worker's samples are aggregated, and call child_exit from gunicorn's
+child_exit hook.
+"""
+from os import environ, fstat
+from time import perf_counter
+
+from flask import current_app, g, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, \
+    REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+from . import WrappingStorageBackend, digesting, forward_digests
+
+
+# Storage operations range from sub millisecond cache hits to minute long
+# uploads
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUESTS = Counter(
+    "archstor_requests_total", "Requests handled",
+    ["resource", "method", "status"]
+)
+REQUEST_SECONDS = Histogram(
+    "archstor_request_duration_seconds",
+    "Time spent handling requests, including streaming the response body",
+    ["resource", "method"], buckets=BUCKETS
+)
+FIRST_BYTE_SECONDS = Histogram(
+    "archstor_object_get_first_byte_seconds",
+    "Time from receiving an object GET to the first byte of its body being ready",
+    buckets=BUCKETS
+)
+BACKEND_SECONDS = Histogram(
+    "archstor_backend_duration_seconds",
+    "Time spent in storage backend calls, for streams the time to open them",
+    ["backend", "operation"], buckets=BUCKETS
+)
+BYTES = Counter(
+    "archstor_bytes_total", "Object bytes streamed to (in) and from (out) the backend",
+    ["direction"]
+)
+STREAMS = Gauge(
+    "archstor_streams_in_flight", "Object streams currently open",
+    ["direction"], multiprocess_mode="livesum"
+)
+ERRORS = Counter(
+    "archstor_errors_total", "Exceptions raised while handling requests",
+    ["error"]
+)
+INGEST_STAGED = Gauge(
+    "archstor_ingest_staged", "Objects staged by write behind ingest, by state",
+    ["state"], multiprocess_mode="livemax"
+)
+INGEST_FLUSH_SECONDS = Histogram(
+    "archstor_ingest_flush_seconds",
+    "Time from an object being staged to it being written to the backend",
+    buckets=BUCKETS + (300, 900, 3600)
+)
+INGEST_RETRIES = Counter(
+    "archstor_ingest_retries_total",
+    "Failed writes of staged objects to the backend, which will be retried"
+)
+INGEST_FAILURES = Counter(
+    "archstor_ingest_failures_total", "Staged objects given up on"
+)
+
+
+def child_exit(server, worker):
+    # For gunicorn's config file: child_exit = archstor.blueprint.metrics.child_exit
+    if environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def exposition():
+    # Out: (body bytes, content type)
+    if environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def _resource():
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(getattr(view, "view_class", None), "__name__", None) or \
+        str(request.endpoint)
+
+
+def before_request():
+    g.archstor_started = perf_counter()
+
+
+def after_request(response):
+    started = g.pop("archstor_started", None)
+    if started is None:
+        return response
+    resource = _resource()
+    method = request.method
+    REQUESTS.labels(resource, method, str(response.status_code)).inc()
+
+    def finished():
+        REQUEST_SECONDS.labels(resource, method).observe(perf_counter() - started)
+
+    body_pending = response.is_streamed and not response.direct_passthrough
+    if resource == "Object" and method == "GET" and response.status_code in (200, 206):
+        if body_pending:
+            response.response = _FirstByteTimer(response.response, started)
+        else:
+            FIRST_BYTE_SECONDS.observe(perf_counter() - started)
+    if body_pending:
+        # Observed once the server is done sending the body
+        response.call_on_close(finished)
+    else:
+        finished()
+    return response
+
+
+def on_exception(sender, exception, **extra):
+    # Both flask and flask_restful signal some exceptions, count each once
+    if request.blueprint != "archstor" or g.get("archstor_error_counted"):
+        return
+    g.archstor_error_counted = True
+    count_error(exception)
+
+
+def count_error(exception):
+    ERRORS.labels(type(exception).__name__).inc()
+
+
+def asgi_send(send, resource, method):
+    # The ASGI server's equivalent of before_request/after_request: wraps
+    # its send, observing the request once the last of the body is sent
+    started = perf_counter()
+    state = {"status": None, "first_byte": False}
+
+    async def observed(message):
+        if message["type"] == "http.response.start":
+            state['status'] = message["status"]
+            REQUESTS.labels(resource, method, str(message["status"])).inc()
+        elif message.get("body") and not state['first_byte'] and resource == "Object" \
+                and method == "GET" and state['status'] in (200, 206):
+            state['first_byte'] = True
+            FIRST_BYTE_SECONDS.observe(perf_counter() - started)
+        await send(message)
+        if message["type"] == "http.response.body" and not message.get("more_body", False):
+            REQUEST_SECONDS.labels(resource, method).observe(perf_counter() - started)
+    return observed
+
+
+class _FirstByteTimer:
+    def __init__(self, iterable, started):
+        self.iterable = iterable
+        self.started = started
+
+    def __iter__(self):
+        first = True
+        for data in self.iterable:
+            if first and data:
+                FIRST_BYTE_SECONDS.observe(perf_counter() - self.started)
+                first = False
+            yield data
+
+    def close(self):
+        if hasattr(self.iterable, "close"):
+            self.iterable.close()
+
+
+class CountingReader:
+    """
+    Counts the bytes read through it, reported once the stream is exhausted
+    or closed rather than on every read, to keep the per chunk cost down
+    """
+    def __init__(self, src, direction):
+        self.src = src
+        self.direction = direction
+        self.count = 0
+        self.done = False
+        self.content_length = getattr(src, "content_length", None)
+        forward_digests(self, src)
+        STREAMS.labels(direction).inc()
+        if hasattr(src, "fileno"):
+            # Keeps files eligible for the server's wsgi.file_wrapper
+            self.fileno = src.fileno
+            self.tell = src.tell
+            self._offset = src.tell()
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.count += len(data)
+        if not data and size != 0:
+            self._finish()
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(1024 * 64), b"")
+
+    def _finish(self):
+        if self.done:
+            return
+        self.done = True
+        if not self.count and hasattr(self, "fileno"):
+            # Sent by the server straight from the file (sendfile(2) and
+            # the like) without going through us, which sends the rest
+            try:
+                self.count = fstat(self.fileno()).st_size - self._offset
+            except (OSError, ValueError):
+                pass
+        BYTES.labels(self.direction).inc(self.count)
+        STREAMS.labels(self.direction).dec()
+
+    def close(self):
+        try:
+            self._finish()
+        finally:
+            if hasattr(self.src, "close"):
+                self.src.close()
+
+
+class MetricsStorageBackend(WrappingStorageBackend):
+    """
+    Wraps another backend, timing each of its calls (but iter_object_ids,
+    which lasts as long as its consumer takes over it) and counting the
+    bytes which go through its streams
+    """
+    def __init__(self, backend):
+        super().__init__(backend)
+        name = type(backend).__name__
+        self._seconds = dict(
+            (operation, BACKEND_SECONDS.labels(name, operation)) for operation in (
+                "get_object_id_list", "check_object_exists", "get_object",
+                "get_object_range", "stat_object", "get_object_digests", "set_object",
+                "del_object",
+                "check_objects_exist", "stat_objects", "del_objects"
+            )
+        )
+
+    def _timed(self, operation, *args, **kwargs):
+        with self._seconds[operation].time():
+            return getattr(self.backend, operation)(*args, **kwargs)
+
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        if prefix:
+            return self._timed("get_object_id_list", cursor, limit, prefix=prefix)
+        return self._timed("get_object_id_list", cursor, limit)
+
+    def check_object_exists(self, id):
+        return self._timed("check_object_exists", id)
+
+    def get_object(self, id):
+        return CountingReader(self._timed("get_object", id), "out")
+
+    def get_object_range(self, id, start, stop):
+        contents, bounds, length = self._timed("get_object_range", id, start, stop)
+        return CountingReader(contents, "out"), bounds, length
+
+    def stat_object(self, id):
+        return self._timed("stat_object", id)
+
+    def get_object_digests(self, id):
+        return self._timed("get_object_digests", id)
+
+    def set_object(self, id, content):
+        reader = CountingReader(digesting(content), "in")
+        try:
+            return self._timed("set_object", id, reader)
+        finally:
+            reader._finish()
+
+    def del_object(self, id):
+        return self._timed("del_object", id)
+
+    def check_objects_exist(self, ids):
+        return self._timed("check_objects_exist", ids)
+
+    def stat_objects(self, ids):
+        return self._timed("stat_objects", ids)
+
+    def del_objects(self, ids):
+        return self._timed("del_objects", ids)
@@ -0,0 +1,254 @@
+"""
+Copies every object from one storage backend to another, streaming each one
+straight through, several at a time, and checkpointing how far through the
+source's listing it has got so an interrupted migration picks up where it
+left off
+"""
+import json
+import logging
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import replace
+from os.path import exists
+from threading import BoundedSemaphore, Lock
+from types import SimpleNamespace
+
+from flask_env import MetaFlaskEnv
+
+from . import BLUEPRINT, configure_storage
+from .exceptions import FunctionalityOmittedError, ObjectAlreadyExistsError
+from .fixity import DigestingReader, DigestMismatchError, RateLimiter, RateLimitedReader
+
+
+log = logging.getLogger(__name__)
+
+
+FAILED = ("error", "mismatch")
+
+
+def storage_from_config(config):
+    # In: dict of settings, named as archstor's own are (STORAGE_BACKEND,
+    # MONGO_HOST and so on)
+    # Out: the IStorageBackend they configure
+    if not config.get('STORAGE_BACKEND'):
+        raise ValueError("No STORAGE_BACKEND configured")
+    bp = SimpleNamespace(config=dict({'BUFF': BLUEPRINT.config['BUFF']}, **config))
+    configure_storage(bp)
+    return bp.config['storage']
+
+
+def storage_from_env(prefix):
+    # The backend configured by the environmental variables starting with
+    # prefix (ARCHSTOR_SOURCE_STORAGE_BACKEND, ARCHSTOR_SOURCE_MONGO_HOST...),
+    # their values parsed as flask_env parses archstor's own
+    settings = MetaFlaskEnv("Settings", (), {"ENV_PREFIX": prefix, "ENV_LOAD_ALL": True})
+    return storage_from_config(dict(
+        (k, v) for k, v in vars(settings).items()
+        if k.isupper() and k not in ("ENV_PREFIX", "ENV_LOAD_ALL")
+    ))
+
+
+class Checkpoint:
+    """
+    How far a migration has got: the listing cursor before which every
+    object has been dealt with (None once the listing's finished), and the
+    identifiers which failed, which are retried when it's resumed. Pages are
+    copied concurrently, so the cursor only moves past a page once it and
+    every page before it are done. Saved, if there's a path, by renaming a
+    freshly written file over the last one, so it's never half written.
+    """
+    def __init__(self, path=None, prefix=None):
+        self.path = path
+        self.prefix = prefix
+        self.cursor = "0"
+        self.failed = {}
+        # [cursor after the page, how many of its objects are outstanding]
+        self.pages = deque()
+        self._lock = Lock()
+        if path is not None and exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved.get("prefix") != self.prefix:
+            raise ValueError("{} is a checkpoint of a migration of prefix {!r}".format(
+                self.path, saved.get("prefix")
+            ))
+        self.cursor = saved["cursor"]
+        self.failed = dict.fromkeys(saved.get("failed", []))
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"prefix": self.prefix, "cursor": self.cursor,
+                       "failed": list(self.failed)}, f)
+        replace(tmp, self.path)
+
+    def add_page(self, next_cursor, ids):
+        # Out: the page's entry, to pass to done() with each of its results
+        page = [next_cursor, len(ids)]
+        with self._lock:
+            self.pages.append(page)
+            self._advance()
+        return page
+
+    def done(self, page, result):
+        with self._lock:
+            if result['status'] in FAILED:
+                self.failed[result['identifier']] = None
+            else:
+                self.failed.pop(result['identifier'], None)
+            page[1] -= 1
+            self._advance()
+
+    def _advance(self):
+        advanced = False
+        while self.pages and self.pages[0][1] == 0:
+            self.cursor = self.pages.popleft()[0]
+            advanced = True
+        if advanced:
+            self.save()
+
+
+def mismatched_digests(a, b):
+    # Out: the algorithms both have a digest for which disagree
+    return sorted(x for x in set(a) & set(b) if a[x].lower() != b[x].lower())
+
+
+def copy_object(source, dest, id, limiter=None, verify=False):
+    # Out: dict describing the result of copying one object
+    if dest.check_object_exists(id):
+        if verify:
+            mismatched = mismatched_digests(source.get_object_digests(id),
+                                            dest.get_object_digests(id))
+            if mismatched:
+                return {"identifier": id, "status": "mismatch", "algorithms": mismatched}
+        return {"identifier": id, "status": "skipped"}
+    try:
+        stat = source.stat_object(id)
+    except FunctionalityOmittedError:
+        stat = {}
+    stored = source.get_object_digests(id) if verify and stat else {}
+    src = source.get_object(id)
+    if limiter is not None:
+        src = RateLimitedReader(src, limiter)
+    # Checks the source against its stored digests as it's read, failing
+    # the write before the destination commits it
+    reader = DigestingReader(src, expected=stored)
+    if stat.get("size"):
+        reader.content_length = stat["size"]
+    try:
+        dest.set_object(id, reader)
+    except ObjectAlreadyExistsError:
+        # Another writer got there first
+        return {"identifier": id, "status": "skipped"}
+    except DigestMismatchError as e:
+        return {"identifier": id, "status": "mismatch", "error": str(e)}
+    finally:
+        reader.close()
+    if verify:
+        computed = reader.hexdigests()
+        mismatched = mismatched_digests(computed, dest.get_object_digests(id))
+        if mismatched:
+            # Removed, so it isn't skipped as already copied next time
+            dest.del_object(id)
+            return {"identifier": id, "status": "mismatch", "algorithms": mismatched,
+                    "computed": computed}
+    return {"identifier": id, "status": "copied", "size": reader.size}
+
+
+def migrate(source, dest, checkpoint=None, prefix=None, workers=4, bytes_per_second=None,
+            verify=False, page_size=1000):
+    # In: source and destination backends + a Checkpoint to resume from and
+    # keep up to date (by default one which isn't saved)
+    # Out: generator of copy results, in completion order
+    # At most 2 * workers objects are in flight, as in the fixity audit
+    if checkpoint is None:
+        checkpoint = Checkpoint(prefix=prefix)
+    limiter = RateLimiter(bytes_per_second)
+    in_flight = BoundedSemaphore(2 * workers)
+    results = []
+    results_lock = Lock()
+
+    def run(page, id):
+        try:
+            result = copy_object(source, dest, id, limiter, verify)
+        except Exception as e:
+            result = {"identifier": id, "status": "error", "error": repr(e)}
+        finally:
+            in_flight.release()
+        checkpoint.done(page, result)
+        with results_lock:
+            results.append(result)
+
+    def drain():
+        with results_lock:
+            done = results[:]
+            del results[:]
+        return done
+
+    def pages():
+        # What failed last time first, then the rest of the listing
+        if checkpoint.failed:
+            yield checkpoint.cursor, list(checkpoint.failed)
+        cursor = checkpoint.cursor
+        while cursor is not None:
+            if prefix:
+                cursor, ids = source.get_object_id_list(cursor, page_size, prefix=prefix)
+            else:
+                cursor, ids = source.get_object_id_list(cursor, page_size)
+            yield cursor, ids
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for next_cursor, ids in pages():
+            page = checkpoint.add_page(next_cursor, ids)
+            for id in ids:
+                in_flight.acquire()
+                executor.submit(run, page, id)
+                yield from drain()
+    yield from drain()
+
+
+def main():
+    parser = ArgumentParser(
+        description="Copy every object from one storage backend to another, " +
+        "each configured as archstor is but by environmental variables with " +
+        "their own prefixes"
+    )
+    parser.add_argument("--source", default="ARCHSTOR_SOURCE_",
+                        help="The source's environmental variable prefix")
+    parser.add_argument("--destination", default="ARCHSTOR_DESTINATION_",
+                        help="The destination's environmental variable prefix")
+    parser.add_argument("--checkpoint", default=None,
+                        help="A file recording progress, resumed from if it exists")
+    parser.add_argument("--prefix", default=None,
+                        help="Only copy objects whose identifiers start with this")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Maximum read throughput, in bytes per second")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check each object against the source's stored digests " +
+                        "as it's copied, and the destination's once it's written")
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO")
+
+    source = storage_from_env(args.source)
+    dest = storage_from_env(args.destination)
+    checkpoint = Checkpoint(args.checkpoint, prefix=args.prefix)
+    counts = {}
+    for result in migrate(source, dest, checkpoint, prefix=args.prefix, workers=args.workers,
+                          bytes_per_second=args.rate, verify=args.verify,
+                          page_size=args.page_size):
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        print(json.dumps(result), flush=True)
+    log.info("Migration finished: %s", json.dumps(counts, sort_keys=True))
+    return 1 if checkpoint.failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,259 @@
+"""
+The GridFS storage backend
+"""
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import DuplicateKeyError
+from bson.binary import Binary
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from gridfs import GridFS, DEFAULT_CHUNK_SIZE
+
+from . import IStorageBackend, RangedReader, as_utc, decode_cursor, digesting, \
+    encode_cursor, prefix_upper_bound, resolve_range
+from .exceptions import ObjectAlreadyExistsError, ObjectNotFoundError, ServerError
+from .fixity import primary_digest
+from .parallel import iter_parts
+from .pool import ProcessLocal
+
+
+class MongoStorageBackend(IStorageBackend):
+    def __init__(self, db_host, db_port=None, db_name=None):
+        if db_port is None:
+            db_port = 27017
+        if db_name is None:
+            db_name = "lts"
+        self.db_host = db_host
+        self.db_port = db_port
+        self.db_name = db_name
+        # Nothing is connected until the first request in each process
+        self._client = ProcessLocal(self._connect)
+
+    def _connect(self):
+        # Out: (database, GridFS), over one client
+        db = MongoClient(self.db_host, self.db_port)[self.db_name]
+        # GridFS' own index, which set_object relies on to claim identifiers
+        db.fs.chunks.create_index(
+            [("files_id", ASCENDING), ("n", ASCENDING)], unique=True
+        )
+        return db, GridFS(db)
+
+    @property
+    def db(self):
+        return self._client.get()[0]
+
+    @property
+    def fs(self):
+        return self._client.get()[1]
+
+    @staticmethod
+    def _id_query(after=None, prefix=None):
+        id_range = {}
+        if after is not None:
+            id_range["$gt"] = after
+        if prefix:
+            # A range rather than a regex, so it's answered from the index
+            id_range["$gte"] = prefix
+            upper = prefix_upper_bound(prefix)
+            if upper is not None:
+                id_range["$lt"] = upper
+        return {"_id": id_range} if id_range else {}
+
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        offset, last_id = decode_cursor(cursor)
+        query = self._id_query(last_id, prefix)
+        # Only the _id index is needed to produce a listing, so skip GridOut
+        # construction entirely and ask fs.files for the ids themselves.
+        results = self.db.fs.files.find(query, {"_id": 1}).sort('_id', ASCENDING)
+        if offset:
+            # Legacy numeric cursor, only the first page pays for the skip
+            results = results.skip(offset)
+        if limit is None:
+            return None, [x['_id'] for x in results]
+        # Fetch one extra id to find out if there's another page
+        results = [x['_id'] for x in results.limit(limit + 1)]
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor(results[-1])
+        return next_cursor, results
+
+    def iter_object_ids(self, prefix=None, start_after=None, page_size=1000):
+        # One server side cursor, fetching page_size ids per round trip
+        results = self.db.fs.files.find(
+            self._id_query(start_after, prefix), {"_id": 1}
+        ).sort('_id', ASCENDING).batch_size(page_size)
+        try:
+            for x in results:
+                yield x['_id']
+        finally:
+            results.close()
+
+    def check_object_exists(self, id):
+        if self.fs.find_one({"_id": id}):
+            return True
+        return False
+
+    def get_object(self, id):
+        gr_entry = self.fs.find_one({"_id": id})
+        if gr_entry is None:
+            raise ObjectNotFoundError(str(id))
+        return gr_entry
+
+    def get_object_range(self, id, start, stop):
+        gr_entry = self.get_object(id)
+        start, stop = resolve_range(start, stop, gr_entry.length)
+        gr_entry.seek(start)
+        return RangedReader(gr_entry, stop - start), (start, stop), gr_entry.length
+
+    @staticmethod
+    def _stat(entry):
+        digests = dict(entry.get('digests') or {})
+        # Older pymongos recorded an md5 of their own
+        if entry.get('md5'):
+            digests.setdefault('md5', entry['md5'])
+        return {
+            "size": entry['length'],
+            "last_modified": as_utc(entry['uploadDate']),
+            "digest": primary_digest(digests),
+            "digests": digests
+        }
+
+    def stat_object(self, id):
+        entry = self.db.fs.files.find_one(
+            {"_id": id}, {"length": 1, "md5": 1, "uploadDate": 1, "digests": 1}
+        )
+        if entry is None:
+            raise ObjectNotFoundError(str(id))
+        return self._stat(entry)
+
+    def check_objects_exist(self, ids):
+        found = set(
+            x['_id'] for x in self.db.fs.files.find({"_id": {"$in": list(ids)}}, {"_id": 1})
+        )
+        return dict((id, id in found) for id in ids)
+
+    def stat_objects(self, ids):
+        found = dict(
+            (x['_id'], x) for x in self.db.fs.files.find(
+                {"_id": {"$in": list(ids)}},
+                {"length": 1, "md5": 1, "uploadDate": 1, "digests": 1}
+            )
+        )
+        return dict(
+            (id, None if found.get(id) is None else self._stat(found[id])) for id in ids
+        )
+
+    def del_objects(self, ids):
+        ids = list(ids)
+        # Files first, so nothing is left half deleted but still listed
+        self.db.fs.files.delete_many({"_id": {"$in": ids}})
+        self.db.fs.chunks.delete_many({"files_id": {"$in": ids}})
+        return dict((id, True) for id in ids)
+
+    # Chunks written per insert, after the first
+    CHUNK_BATCH = 16
+    # Seconds a claim on an identifier (its first chunk) can go untouched by
+    # the upload holding it before it's taken for the remains of a crash
+    CLAIM_TIMEOUT = 15 * 60
+
+    def set_object(self, id, content):
+        # Written in the GridFS layout directly, rather than through GridIn,
+        # so we know whether anything of ours has reached the database.
+        # The unique (files_id, n) index makes inserting the first chunk an
+        # atomic claim on the identifier, and the files document's unique
+        # _id does the same for empty objects. Every chunk names the upload
+        # it belongs to, so only ever our own are cleared out.
+        content = digesting(content)
+        upload = ObjectId()
+        claimed = False
+        touched = None
+        size = 0
+        batch = []
+        try:
+            for n, data in enumerate(iter_parts(content, DEFAULT_CHUNK_SIZE)):
+                batch.append({"files_id": id, "n": n, "data": Binary(data), "upload": upload})
+                size += len(data)
+                if not claimed:
+                    self._claim(id, batch.pop())
+                    claimed = True
+                    touched = monotonic()
+                elif len(batch) >= self.CHUNK_BATCH:
+                    self.db.fs.chunks.insert_many(batch)
+                    batch = []
+                    if monotonic() - touched > self.CLAIM_TIMEOUT / 4:
+                        self._touch(id, upload)
+                        touched = monotonic()
+            if batch:
+                self.db.fs.chunks.insert_many(batch)
+            if claimed:
+                # So it can't be reclaimed out from under the files document
+                self._touch(id, upload)
+            self.db.fs.files.insert_one({
+                "_id": id,
+                "length": Int64(size),
+                "chunkSize": DEFAULT_CHUNK_SIZE,
+                "uploadDate": datetime.now(timezone.utc),
+                "digests": content.hexdigests()
+            })
+        except DuplicateKeyError:
+            if claimed:
+                # An existing empty object, which had no chunks to collide with
+                self.db.fs.chunks.delete_many({"files_id": id, "upload": upload})
+            raise ObjectAlreadyExistsError(str(id))
+        except BaseException:
+            if claimed:
+                self.db.fs.chunks.delete_many({"files_id": id, "upload": upload})
+            raise
+        return content.hexdigests()
+
+    def _claim(self, id, chunk):
+        # Inserts the first chunk, reclaiming the identifier from an upload
+        # that died before writing its files document (which would otherwise
+        # hold it forever: not found, but already existing)
+        chunk["claimedAt"] = datetime.now(timezone.utc)
+        try:
+            self.db.fs.chunks.insert_one(chunk)
+        except DuplicateKeyError:
+            if not self._reclaim(id):
+                raise
+            self.db.fs.chunks.insert_one(chunk)
+
+    def _reclaim(self, id):
+        # Out: whether a stale claim on id was cleared
+        if self.db.fs.files.find_one({"_id": id}, {"_id": 1}) is not None:
+            return False
+        first = self.db.fs.chunks.find_one({"files_id": id, "n": 0},
+                                           {"upload": 1, "claimedAt": 1})
+        if first is None:
+            # Cleared since, try again
+            return True
+        # Chunks from before claims were stamped, or left by a delete that
+        # died part way through, have no claimedAt, and are always stale
+        claimed_at = first.get("claimedAt")
+        stale = datetime.now(timezone.utc) - timedelta(seconds=self.CLAIM_TIMEOUT)
+        if claimed_at is not None and as_utc(claimed_at) > stale:
+            return False
+        # Only if it's still untouched, so of several servers reclaiming at
+        # once only one goes on to claim it, and a live upload is left be
+        cleared = self.db.fs.chunks.delete_one(
+            {"_id": first["_id"], "claimedAt": claimed_at}
+        ).deleted_count
+        if not cleared:
+            return False
+        self.db.fs.chunks.delete_many({"files_id": id, "upload": first.get("upload")})
+        return True
+
+    def _touch(self, id, upload):
+        # Renews our claim on id, failing if it's been reclaimed, in which
+        # case our chunks have been cleared out too
+        if not self.db.fs.chunks.update_one(
+                {"files_id": id, "n": 0, "upload": upload},
+                {"$set": {"claimedAt": datetime.now(timezone.utc)}}
+        ).matched_count:
+            raise ServerError("Lost the claim on {} part way through writing it".format(id))
+
+    def del_object(self, id):
+        return self.fs.delete(id)
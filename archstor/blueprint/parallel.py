@@ -0,0 +1,209 @@
+"""
+Moves single large objects as several parts in flight at once, for backends
+whose per request latency (rather than bandwidth) bounds a single stream
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from queue import Empty, Queue
+from threading import BoundedSemaphore, Event, Thread
+
+from .exceptions import ServerError
+
+
+def read_part(src, size):
+    # Exactly size bytes, unless src runs out first
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        data = src.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b"".join(chunks)
+
+
+def iter_parts(src, part_size, grow_every=None):
+    # In: readable file like object + part size
+    # Out: generator of parts, all part_size long except (perhaps) the last
+    # If grow_every is given the part size doubles every grow_every parts, for
+    # services with a cap on the number of parts
+    n = 0
+    while True:
+        data = read_part(src, part_size)
+        if data:
+            yield data
+        if len(data) < part_size:
+            return
+        n += 1
+        if grow_every and n % grow_every == 0:
+            part_size *= 2
+
+
+def upload_parts(parts, upload_part, workers=4):
+    # In: iterable of parts + function(part number, data), numbered from 1
+    # Out: list of upload_part's results, in part order
+    # Parts are read one after another (they're usually coming off a stream)
+    # but at most workers of them are being sent, and held in memory, at once.
+    in_flight = BoundedSemaphore(workers)
+    failed = []
+    futures = []
+
+    def done(future):
+        if future.exception() is not None:
+            failed.append(future.exception())
+        in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for number, data in enumerate(parts, 1):
+                in_flight.acquire()
+                if failed:
+                    # No sense reading the rest of the stream
+                    break
+                future = executor.submit(upload_part, number, data)
+                future.add_done_callback(done)
+                futures.append(future)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return [future.result() for future in futures]
+
+
+class ParallelRangeReader:
+    """
+    A file like object over [start, length) of an object, which keeps up to
+    workers part_size ranges downloading concurrently ahead of the reader and
+    hands them out in order.
+
+    fetch(start, stop) returns the bytes of one range (stop exclusive). first,
+    if given, is an already open stream of the bytes from start onwards,
+    which is read before any of the fetched parts.
+    """
+    def __init__(self, fetch, length, part_size, workers=4, start=0,
+                 first=None, first_length=0):
+        self.fetch = fetch
+        self.stop = length
+        self.part_size = part_size
+        self.workers = workers
+        self.next_start = start + first_length
+        self.current = first if first is not None else BytesIO()
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._fill()
+
+    def _fetch(self, start, stop):
+        data = self.fetch(start, stop)
+        if len(data) != stop - start:
+            raise ServerError("Short read of bytes {}-{}".format(start, stop - 1))
+        return data
+
+    def _fill(self):
+        while len(self.pending) < self.workers and self.next_start < self.stop:
+            stop = min(self.next_start + self.part_size, self.stop)
+            self.pending.append(self.executor.submit(self._fetch, self.next_start, stop))
+            self.next_start = stop
+
+    def _advance(self):
+        # Out: False once every part has been handed out
+        if not self.pending:
+            return False
+        if hasattr(self.current, "close"):
+            self.current.close()
+        self.current = BytesIO(self.pending.popleft().result())
+        self._fill()
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self.current.read()]
+            while self._advance():
+                chunks.append(self.current.read())
+            return b"".join(chunks)
+        data = self.current.read(size)
+        while not data and size and self._advance():
+            data = self.current.read(size)
+        return data
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+        if hasattr(self.current, "close"):
+            self.current.close()
+
+
+class ReadAheadReader:
+    """
+    A file like object which keeps up to depth chunk_size chunks of src read
+    ahead of its reader, on a background thread, so that waiting on the
+    backend and waiting on the client overlap rather than taking turns.
+
+    src is only ever touched by the background thread, which closes it when
+    it's done, whether that's at the end of src, on an error (raised to the
+    reader in order) or because the reader was closed early.
+    """
+    def __init__(self, src, chunk_size, depth):
+        self.src = src
+        self.chunk_size = chunk_size
+        self.chunks = Queue(maxsize=depth)
+        self.closed = Event()
+        self.current = b""
+        self.exhausted = False
+        self.thread = Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.closed.is_set():
+                try:
+                    data = self.src.read(self.chunk_size)
+                except Exception as e:
+                    self.chunks.put(e)
+                    return
+                # Blocks while the reader is depth chunks behind
+                self.chunks.put(data)
+                if not data:
+                    return
+        finally:
+            if hasattr(self.src, "close"):
+                self.src.close()
+
+    def _next(self):
+        # Out: False once src is exhausted
+        if self.exhausted:
+            return False
+        item = self.chunks.get()
+        if isinstance(item, Exception):
+            self.exhausted = True
+            raise item
+        if not item:
+            self.exhausted = True
+            return False
+        self.current = item
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self.current]
+            while self._next():
+                chunks.append(self.current)
+            self.current = b""
+            return b"".join(chunks)
+        if not self.current and size and not self._next():
+            return b""
+        data, self.current = self.current[:size], self.current[size:]
+        return data
+
+    def close(self):
+        self.closed.set()
+        # Unblocks the background thread if it's waiting for room, it sees
+        # closed as soon as it's done with any read in progress
+        try:
+            while True:
+                self.chunks.get_nowait()
+        except Empty:
+            pass
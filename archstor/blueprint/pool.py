@@ -0,0 +1,247 @@
+"""
+A small, bounded, thread safe pool of reusable client connections, clients
+made lazily once per process, and sqlite databases connected per thread
+"""
+import logging
+import sqlite3
+from collections import deque
+from contextlib import contextmanager
+from os import getpid, register_at_fork
+from pathlib import Path
+from threading import BoundedSemaphore, Lock, local
+from time import monotonic
+from weakref import WeakSet
+
+from .exceptions import ServerError
+
+
+log = logging.getLogger(__name__)
+
+# Pools and clients which forget what they hold in a forked child, before
+# any other thread of it can run
+_FORGET_AFTER_FORK = WeakSet()
+
+
+def _after_fork():
+    for x in list(_FORGET_AFTER_FORK):
+        x._forget()
+
+
+register_at_fork(after_in_child=_after_fork)
+
+
+class PoolExhaustedError(ServerError):
+    error_name = "PoolExhaustedError"
+    status_code = 503
+
+
+class ConnectionPool:
+    """
+    At most size connections exist at once, borrowers block (up to
+    timeout seconds) while they are all checked out.
+
+    Connections idle for longer than max_idle seconds, or which fail the
+    optional check callable, are closed instead of being handed out again.
+    """
+    def __init__(self, factory, size=10, max_idle=60, timeout=None,
+                 check=None, close=None, on_release=None):
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.check = check
+        self._close = close
+        self.on_release = on_release
+        self._forget()
+        _FORGET_AFTER_FORK.add(self)
+
+    def _forget(self):
+        # Connections inherited across a fork share their sockets with the
+        # parent, so they're dropped (unclosed) and the child makes its own
+        self._slots = BoundedSemaphore(self.size)
+        self._idle = deque()
+        self._lock = Lock()
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhaustedError("No backend connections available")
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, released_at = self._idle.pop()
+                if monotonic() - released_at > self.max_idle:
+                    log.debug("Evicting idle connection")
+                    self.close_connection(conn)
+                    continue
+                if self.check is not None and not self.check(conn):
+                    log.debug("Evicting unhealthy connection")
+                    self.close_connection(conn)
+                    continue
+                return conn
+            return self.factory()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        try:
+            if discard:
+                self.close_connection(conn)
+            else:
+                if self.on_release is not None:
+                    self.on_release(conn)
+                with self._lock:
+                    self._idle.append((conn, monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, keep_on=()):
+        # Connections which raised anything other than keep_on are assumed to
+        # be in an unknown state, and aren't returned to the pool
+        conn = self.acquire()
+        try:
+            yield conn
+        except keep_on:
+            self.release(conn)
+            raise
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def close_connection(self, conn):
+        if self._close is None:
+            return
+        try:
+            self._close(conn)
+        except Exception:
+            log.debug("Error closing pooled connection", exc_info=True)
+
+    def close_all(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self.close_connection(conn)
+
+
+class PooledStream:
+    """
+    Wraps a streaming response body so the connection it came in on is
+    returned to the pool only once the body has been consumed or closed.
+    """
+    def __init__(self, body, pool, conn):
+        self.body = body
+        self.pool = pool
+        self.conn = conn
+
+    def _finish(self, discard=False):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            self.pool.release(conn, discard=discard)
+
+    def read(self, size=None):
+        try:
+            data = self.body.read(size)
+        except Exception:
+            self._finish(discard=True)
+            raise
+        if not data:
+            self._finish()
+        return data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.body)
+        except StopIteration:
+            self._finish()
+            raise
+        except Exception:
+            self._finish(discard=True)
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self._finish()
+
+    def __del__(self):
+        # Last resort, don't leak a pool slot if nobody closed us
+        self._finish(discard=True)
+
+
+class ProcessLocal:
+    """
+    A client made by factory the first time get() is called in a process,
+    so that nothing is connected before a server forks its workers, and
+    no client (pymongo's and boto3's aren't safe to) is shared across a
+    fork. Threads within a process share the one client.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._forget()
+        _FORGET_AFTER_FORK.add(self)
+
+    def _forget(self):
+        self._client = None
+        self._made = False
+        self._lock = Lock()
+
+    def get(self):
+        if not self._made:
+            with self._lock:
+                if not self._made:
+                    self._client = self.factory()
+                    self._made = True
+        return self._client
+
+
+class SqliteFile:
+    """
+    A sqlite database at path. Connections are per thread (and per process,
+    so it is safe to create one before a server forks its workers).
+    Subclasses choose the journal mode (None leaves it as it is), how
+    durable commits are, and the row factory.
+    """
+    journal_mode = "WAL"
+    synchronous = "NORMAL"
+    row_factory = None
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = local()
+
+    @property
+    def conn(self):
+        if getattr(self._local, "pid", None) != getpid():
+            conn = sqlite3.connect(str(self.path), timeout=30)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            if self.journal_mode is not None:
+                conn.execute("PRAGMA journal_mode={}".format(self.journal_mode))
+            conn.execute("PRAGMA synchronous={}".format(self.synchronous))
+            self._local.conn = conn
+            self._local.pid = getpid()
+        return self._local.conn
+
+    @contextmanager
+    def transaction(self):
+        # Takes the database's write lock up front, so what's read in it and
+        # the writes decided on from that are atomic across processes
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
@@ -0,0 +1,328 @@
+"""
+A composite backend which keeps a copy of every object in each of several
+backends, writing them all from a single pass over the upload and reading
+from whichever replica is answering quickest
+"""
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import monotonic
+
+from . import IStorageBackend, digesting, content_length
+from .exceptions import ObjectAlreadyExistsError, ObjectNotFoundError, UserError
+
+
+log = logging.getLogger(__name__)
+
+
+class TeeReader:
+    """
+    One branch of a tee: a file like object over the chunks put into queue,
+    which end with b"" (or an exception, raised in the reader). The digests
+    are those of the reader being tee'd, so nothing is hashed twice.
+    """
+    def __init__(self, queue, hexdigests, content_length=None):
+        self.queue = queue
+        self.hexdigests = hexdigests
+        self.content_length = content_length
+        self.buffer = b""
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.buffer and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            if not item:
+                self.eof = True
+            self.buffer = item
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class Replica:
+    # A child backend, with a moving average of how long its reads take and
+    # a cool off period after it fails, which together rank it for reads
+    def __init__(self, backend):
+        self.backend = backend
+        self.latency = 0.0
+        self.failed_until = 0
+        self.lock = Lock()
+
+    def rank(self, now):
+        return (self.failed_until > now, self.latency)
+
+    def observe(self, seconds, failed=False, cool_off=30):
+        with self.lock:
+            if failed:
+                self.failed_until = monotonic() + cool_off
+                return
+            self.failed_until = 0
+            # Exponentially weighted, so it follows the replica as it changes
+            self.latency = seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+
+
+def close_result(future):
+    # Whatever a hedged read that lost the race opened, close it
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    if isinstance(result, tuple):
+        result = result[0]
+    if hasattr(result, "close"):
+        result.close()
+
+
+class ReplicatedStorageBackend(IStorageBackend):
+    """
+    Writes go to every backend at once, off one read of the content through
+    bounded per replica buffers (so the slowest replica sets the pace, and
+    at most buffer_chunks chunks are held per replica). A write succeeds once
+    write_quorum replicas have it (by default all of them), otherwise the
+    copies that were made are deleted again. Concurrent writes of one
+    identifier are taken in turn, so they can't each claim it on a different
+    replica and all back out (though writers in different processes still
+    can).
+
+    Reads go to the healthiest, fastest replica first. If it hasn't answered
+    within hedge_after seconds the next one is asked as well, and whichever
+    answers first is used. A replica which doesn't have the object is passed
+    over for the next, so objects written below a full quorum are still
+    found. Listings come from the first backend given, as cursors are
+    specific to a backend.
+    """
+    def __init__(self, backends, write_quorum=None, hedge_after=0.1, buffer_chunks=8,
+                 cool_off=30, workers=32):
+        if not backends:
+            raise ValueError("At least one backend is required")
+        self.replicas = [Replica(x) for x in backends]
+        self.write_quorum = min(write_quorum or len(backends), len(backends))
+        self.hedge_after = hedge_after
+        self.buffer_chunks = buffer_chunks
+        self.cool_off = cool_off
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # identifier -> (lock, how many writers hold or want it)
+        self._writing = {}
+        self._writing_lock = Lock()
+
+    @property
+    def backends(self):
+        return [x.backend for x in self.replicas]
+
+    def _ranked(self):
+        now = monotonic()
+        # Stable, so replicas that rank the same are asked in the order given
+        return sorted(self.replicas, key=lambda x: x.rank(now))
+
+    def _timed(self, replica, func):
+        start = monotonic()
+        try:
+            result = func(replica.backend)
+        except (ObjectNotFoundError, UserError):
+            # The replica answered, it just doesn't have it
+            replica.observe(monotonic() - start)
+            raise
+        except Exception:
+            replica.observe(monotonic() - start, failed=True, cool_off=self.cool_off)
+            raise
+        replica.observe(monotonic() - start)
+        return result
+
+    def _read(self, func):
+        # In: function(backend)
+        # Out: its result from the first replica to answer with one
+        # Raises ObjectNotFoundError if no replica has it, or the first
+        # other error if none could say
+        replicas = self._ranked()
+        pending = {}
+        errors = []
+
+        def ask():
+            replica = replicas.pop(0)
+            pending[self.executor.submit(self._timed, replica, func)] = replica
+
+        ask()
+        while pending:
+            timeout = self.hedge_after if replicas else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Too slow, hedge with the next replica
+                ask()
+                continue
+            for future in done:
+                del pending[future]
+                try:
+                    result = future.result()
+                except UserError:
+                    # The same from any replica (an unsatisfiable range, say)
+                    self._abandon(pending)
+                    raise
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                self._abandon(pending)
+                return result
+            if not pending and replicas:
+                ask()
+        for e in errors:
+            if not isinstance(e, ObjectNotFoundError):
+                raise e
+        raise errors[0]
+
+    @staticmethod
+    def _abandon(pending):
+        for future in pending:
+            future.add_done_callback(close_result)
+
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        if prefix:
+            return self.backends[0].get_object_id_list(cursor, limit, prefix=prefix)
+        return self.backends[0].get_object_id_list(cursor, limit)
+
+    def iter_object_ids(self, prefix=None, start_after=None, page_size=1000):
+        return self.backends[0].iter_object_ids(prefix=prefix, start_after=start_after,
+                                                page_size=page_size)
+
+    def check_object_exists(self, id):
+        def exists(backend):
+            if not backend.check_object_exists(id):
+                raise ObjectNotFoundError(str(id))
+            return True
+        try:
+            return self._read(exists)
+        except ObjectNotFoundError:
+            return False
+
+    def get_object(self, id):
+        return self._read(lambda backend: backend.get_object(id))
+
+    def get_object_range(self, id, start, stop):
+        return self._read(lambda backend: backend.get_object_range(id, start, stop))
+
+    def stat_object(self, id):
+        return self._read(lambda backend: backend.stat_object(id))
+
+    def get_object_digests(self, id):
+        return self._read(lambda backend: backend.get_object_digests(id))
+
+    @contextmanager
+    def _writer(self, id):
+        with self._writing_lock:
+            lock, count = self._writing.get(id, (Lock(), 0))
+            self._writing[id] = (lock, count + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._writing_lock:
+                lock, count = self._writing[id]
+                if count == 1:
+                    del self._writing[id]
+                else:
+                    self._writing[id] = (lock, count - 1)
+
+    def set_object(self, id, content):
+        with self._writer(id):
+            return self._set_object(id, content)
+
+    def _set_object(self, id, content):
+        content = digesting(content)
+        length = content_length(content)
+        branches = []
+        for replica in self.replicas:
+            branch = {
+                "replica": replica,
+                "queue": Queue(maxsize=self.buffer_chunks),
+                "done": False,
+                "error": None
+            }
+            branch["thread"] = Thread(target=self._write_branch, args=(id, branch, content, length),
+                                      daemon=True)
+            branches.append(branch)
+        for branch in branches:
+            branch["thread"].start()
+        error = None
+        try:
+            self._tee(content, branches, self.upload_chunk_size(length))
+        except BaseException as e:
+            error = e
+        for branch in branches:
+            branch["thread"].join()
+        written = [x for x in branches if x["error"] is None]
+        # Whatever the quorum, an object one replica already has can't be
+        # written, or the replicas would hold different content under one
+        # identifier
+        exists = [x["error"] for x in branches
+                  if isinstance(x["error"], ObjectAlreadyExistsError)]
+        if error is None and not exists and len(written) >= self.write_quorum:
+            for branch in branches:
+                if branch["error"] is not None:
+                    log.warning("%s wasn't written to %s: %s", id,
+                                type(branch["replica"].backend).__name__, branch["error"])
+            return content.hexdigests()
+        # Back out the copies this write made, so it isn't half there
+        for branch in written:
+            try:
+                branch["replica"].backend.del_object(id)
+            except Exception:
+                log.exception("Couldn't remove %s from %s", id,
+                              type(branch["replica"].backend).__name__)
+        if exists:
+            raise exists[0]
+        if error is not None:
+            raise error
+        raise [x["error"] for x in branches if x["error"] is not None][0]
+
+    @staticmethod
+    def _tee(content, branches, size):
+        # Reads content once, handing each chunk to every branch still
+        # writing. Errors (a digest mismatch, say) are handed on too, so
+        # every branch fails without committing anything.
+        while True:
+            try:
+                data = content.read(size)
+            except BaseException as e:
+                for branch in branches:
+                    if not branch["done"]:
+                        branch["queue"].put(e)
+                raise
+            for branch in branches:
+                if not branch["done"]:
+                    # A branch finishing empties its queue, so this can't
+                    # block forever on one that's stopped reading
+                    branch["queue"].put(data)
+            if not data:
+                return
+
+    def _write_branch(self, id, branch, content, length):
+        reader = TeeReader(branch["queue"], content.hexdigests, length)
+        try:
+            branch["replica"].backend.set_object(id, reader)
+        except BaseException as e:
+            branch["error"] = e
+        finally:
+            branch["done"] = True
+            # Unblock the tee, if it's waiting on this branch
+            while True:
+                try:
+                    branch["queue"].get_nowait()
+                except Empty:
+                    break
+
+    def del_object(self, id):
+        futures = [self.executor.submit(x.del_object, id) for x in self.backends]
+        for future in futures:
+            future.result()
+
+    def del_objects(self, ids):
+        ids = list(ids)
+        results = dict((id, True) for id in ids)
+        futures = [self.executor.submit(x.del_objects, ids) for x in self.backends]
+        for future in futures:
+            for id, deleted in future.result().items():
+                results[id] = results.get(id, True) and deleted
+        return results
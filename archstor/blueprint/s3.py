@@ -0,0 +1,343 @@
+"""
+The S3 (and S3 compatible services) storage backend
+"""
+import logging
+from itertools import chain
+
+import boto3
+import botocore
+import botocore.config
+from werkzeug.http import parse_content_range_header
+
+from . import IStorageBackend, as_utc, declared_digests, decode_cursor, digesting, \
+    encode_cursor, fan_out, range_header_value
+from .exceptions import ObjectAlreadyExistsError, ObjectNotFoundError, \
+    RangeNotSatisfiableError
+from .fixity import primary_digest
+from .parallel import ParallelRangeReader, iter_parts, upload_parts
+from .pool import ProcessLocal
+
+
+log = logging.getLogger(__name__)
+
+
+class S3StorageBackend(IStorageBackend):
+    # S3 won't take (non-final) multipart parts under 5MiB, or more than 10000
+    # of them
+    MIN_PART_SIZE = 5 * 1024 * 1024
+    MAX_PARTS = 10000
+
+    def __init__(self, bucket_name, region_name=None, aws_access_key_id=None,
+                 aws_secret_access_key=None, endpoint_url=None,
+                 part_size=8 * 1024 * 1024, workers=4):
+        self.part_size = part_size
+        self.workers = workers
+        self.bucket = bucket_name
+        self.region_name = region_name
+        self._client_kwargs = {
+            "region_name": region_name, "aws_access_key_id": aws_access_key_id,
+            "aws_secret_access_key": aws_secret_access_key, "endpoint_url": endpoint_url
+        }
+        # Nothing is connected until the first request in each process
+        self._client = ProcessLocal(self._connect)
+
+    def _connect(self):
+        s3 = boto3.client(
+            's3',
+            # Enough connections for every part of a couple of concurrent
+            # transfers, the client itself is safe to share between threads
+            config=botocore.config.Config(max_pool_connections=max(10, 2 * self.workers)),
+            **self._client_kwargs
+        )
+        try:
+            s3.head_bucket(Bucket=self.bucket)
+        except botocore.exceptions.ClientError as e:
+            if not self._not_found(e):
+                raise
+            # Init the bucket
+            if self.region_name and self.region_name != "us-east-1":
+                s3.create_bucket(
+                    Bucket=self.bucket,
+                    CreateBucketConfiguration={"LocationConstraint": self.region_name}
+                )
+            else:
+                s3.create_bucket(Bucket=self.bucket)
+        return s3
+
+    @property
+    def s3(self):
+        return self._client.get()
+
+    @staticmethod
+    def _not_found(e):
+        return e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NoSuchBucket', 'NotFound')
+
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        # Cursors handed back to clients are our own opaque keyset cursors
+        # (S3's StartAfter), which unlike continuation tokens don't expire
+        # and work the same against every backend. Continuation tokens are
+        # used to page through S3's (at most 1000 key) listings within a call.
+        offset, last_id = decode_cursor(cursor)
+        kwargs = {"Bucket": self.bucket}
+        if prefix:
+            kwargs["Prefix"] = prefix
+        if last_id is not None:
+            kwargs["StartAfter"] = last_id
+        results = []
+        while True:
+            if limit is not None:
+                # One extra to find out if there's another page
+                kwargs["MaxKeys"] = min(1000, offset + limit + 1 - len(results))
+            response = self.s3.list_objects_v2(**kwargs)
+            keys = [x['Key'] for x in response.get('Contents', [])]
+            if offset:
+                # Legacy numeric cursor, only the first page pays for the skip
+                skipped = min(offset, len(keys))
+                keys = keys[skipped:]
+                offset -= skipped
+            results.extend(keys)
+            if not response.get('IsTruncated') or \
+                    (limit is not None and len(results) > limit):
+                break
+            kwargs["ContinuationToken"] = response['NextContinuationToken']
+        next_cursor = None
+        if limit is not None and len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor(results[-1])
+        return next_cursor, results
+
+    def iter_object_ids(self, prefix=None, start_after=None, page_size=1000):
+        kwargs = {"Bucket": self.bucket, "PaginationConfig": {"PageSize": page_size}}
+        if prefix:
+            kwargs["Prefix"] = prefix
+        if start_after is not None:
+            kwargs["StartAfter"] = start_after
+        for response in self.s3.get_paginator("list_objects_v2").paginate(**kwargs):
+            for x in response.get('Contents', []):
+                yield x['Key']
+
+    def check_object_exists(self, id):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=id)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if self._not_found(e):
+                return False
+            raise
+
+    def _get(self, id, **kwargs):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=id, **kwargs)
+        except botocore.exceptions.ClientError as e:
+            if self._not_found(e):
+                raise ObjectNotFoundError(str(id))
+            if e.response['Error']['Code'] == 'InvalidRange':
+                length = e.response['Error'].get('ActualObjectSize')
+                raise RangeNotSatisfiableError(
+                    length=int(length) if length is not None else None
+                )
+            raise
+
+    def _fetch_range(self, id, etag):
+        # Every part has to come from the same object the first one did
+        def fetch(start, stop):
+            obj = self._get(id, Range=range_header_value(start, stop), IfMatch=etag)
+            try:
+                return obj['Body'].read()
+            finally:
+                obj['Body'].close()
+        return fetch
+
+    def get_object(self, id):
+        try:
+            contents, _, _ = self.get_object_range(id, 0, None)
+        except RangeNotSatisfiableError:
+            # Only empty objects have no satisfiable range
+            return self._get(id)['Body']
+        return contents
+
+    def get_object_range(self, id, start, stop):
+        # The first request only asks for one part, if that turns out to be
+        # the whole range it's streamed straight through, otherwise the rest
+        # is fetched part_size at a time, workers parts at once
+        first_stop = stop
+        if start >= 0 and (stop is None or stop - start > self.part_size):
+            first_stop = start + self.part_size
+        obj = self._get(id, Range=range_header_value(start, first_stop))
+        content_range = parse_content_range_header(obj.get('ContentRange'))
+        if content_range is None:
+            # Whole object returned
+            return obj['Body'], (0, obj['ContentLength']), obj['ContentLength']
+        length = content_range.length
+        start = content_range.start
+        stop = length if stop is None else min(stop, length)
+        if content_range.stop >= stop:
+            return obj['Body'], (start, stop), length
+        return ParallelRangeReader(
+            self._fetch_range(id, obj['ETag']), stop, self.part_size,
+            workers=self.workers, start=start, first=obj['Body'],
+            first_length=content_range.stop - start
+        ), (start, stop), length
+
+    def _head(self, id):
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=id)
+        except botocore.exceptions.ClientError as e:
+            if self._not_found(e):
+                raise ObjectNotFoundError(str(id))
+            raise
+
+    @staticmethod
+    def _metadata_digests(obj):
+        return dict(
+            (k[len("digest-"):], v) for k, v in obj.get('Metadata', {}).items()
+            if k.startswith("digest-")
+        )
+
+    def _stat(self, id, obj, tagged=False):
+        # Digests only tagged on an object (multipart uploads whose digests
+        # weren't known up front) cost another request, so they're only
+        # fetched if tagged is set. Either way its ETag is the same.
+        digests = self._metadata_digests(obj)
+        # Multipart ETags aren't digests of the content, but still change
+        # whenever it does
+        digest = primary_digest(digests) or obj['ETag'].strip('"')
+        if tagged and not digests:
+            digests = self._tagged_digests(id, obj['ETag'])
+        return {
+            "size": obj['ContentLength'],
+            "last_modified": as_utc(obj['LastModified']),
+            "digest": digest,
+            "digests": digests
+        }
+
+    def stat_object(self, id):
+        return self._stat(id, self._head(id))
+
+    def get_object_digests(self, id):
+        return self._stat(id, self._head(id), tagged=True)['digests']
+
+    def stat_objects(self, ids):
+        # Those asking for batches of stats are after the digests
+        def stat_or_none(id):
+            try:
+                return self._stat(id, self._head(id), tagged=True)
+            except ObjectNotFoundError:
+                return None
+        return fan_out(stat_or_none, ids)
+
+    def set_object(self, id, content):
+        # Conditional writes make creating objects atomic, without a HEAD
+        # first. Multipart uploads are conditional on completion, and
+        # aborted if another object got there first.
+        content = digesting(content)
+        parts = iter_parts(content, self.part_size,
+                           grow_every=self.MAX_PARTS // 10)
+        first = next(parts, b"")
+        if len(first) < self.part_size:
+            # Small enough for a single request, by which point the digests
+            # are known and can go along with it
+            try:
+                self.s3.put_object(Bucket=self.bucket, Key=id, Body=first, IfNoneMatch="*",
+                                   Metadata=self._digest_metadata(content.hexdigests()))
+            except botocore.exceptions.ClientError as e:
+                self._check_precondition(e, id)
+                raise
+            return content.hexdigests()
+        declared = declared_digests(content)
+        etag = self._upload_multipart(
+            id, chain([first], parts),
+            metadata=self._digest_metadata(declared) if declared else None
+        )
+        if not declared:
+            # Metadata has to be sent before the body, so digests only known
+            # once it's all been read are tagged on afterwards
+            self._tag_digests(id, etag, content.hexdigests())
+        return content.hexdigests()
+
+    def _tag_digests(self, id, etag, digests):
+        # Tags can't be made conditional, so they name the upload (by its
+        # ETag) they belong to, and are only believed while that's the
+        # object. The object is stored by now, so failing to tag it isn't
+        # worth failing the request (and its retry) over.
+        tags = [{"Key": "etag", "Value": etag.strip('"')}] + [
+            {"Key": "digest-" + k, "Value": v} for k, v in sorted(digests.items())
+        ]
+        try:
+            self.s3.put_object_tagging(Bucket=self.bucket, Key=id, Tagging={"TagSet": tags})
+        except botocore.exceptions.ClientError:
+            log.warning("Couldn't record the digests of %s", id, exc_info=True)
+
+    def _tagged_digests(self, id, etag):
+        try:
+            tags = self.s3.get_object_tagging(Bucket=self.bucket, Key=id)['TagSet']
+        except botocore.exceptions.ClientError as e:
+            if self._not_found(e):
+                return {}
+            raise
+        tags = dict((x['Key'], x['Value']) for x in tags)
+        if tags.get("etag") != etag.strip('"'):
+            return {}
+        return dict(
+            (k[len("digest-"):], v) for k, v in tags.items() if k.startswith("digest-")
+        )
+
+    @staticmethod
+    def _check_precondition(e, id):
+        if e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+            raise ObjectAlreadyExistsError(str(id))
+
+    @staticmethod
+    def _digest_metadata(digests):
+        return dict(("digest-" + k, v) for k, v in digests.items())
+
+    def _upload_multipart(self, id, parts, metadata=None):
+        # In: identifier + iterable of parts + optional metadata
+        # Out: the completed object's ETag
+        kwargs = {"Metadata": metadata} if metadata is not None else {}
+        upload_id = self.s3.create_multipart_upload(
+            Bucket=self.bucket, Key=id, **kwargs
+        )['UploadId']
+
+        def upload_part(number, data):
+            return self.s3.upload_part(
+                Bucket=self.bucket, Key=id, UploadId=upload_id, PartNumber=number,
+                Body=data
+            )['ETag']
+
+        try:
+            etags = upload_parts(parts, upload_part, workers=self.workers)
+            return self.s3.complete_multipart_upload(
+                Bucket=self.bucket, Key=id, UploadId=upload_id,
+                MultipartUpload={"Parts": [
+                    {"PartNumber": number, "ETag": etag}
+                    for number, etag in enumerate(etags, 1)
+                ]},
+                IfNoneMatch="*"
+            )['ETag']
+        except botocore.exceptions.ClientError as e:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=id, UploadId=upload_id)
+            self._check_precondition(e, id)
+            raise
+        except BaseException:
+            # Otherwise the parts are kept (and billed) indefinitely
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=id, UploadId=upload_id)
+            raise
+
+    def del_object(self, id):
+        # Deleting a key which doesn't exist isn't an error in S3
+        self.s3.delete_object(Bucket=self.bucket, Key=id)
+        return True
+
+    def del_objects(self, ids):
+        ids = list(ids)
+        results = dict((id, True) for id in ids)
+        # S3 caps multi object deletes at 1000 keys
+        for i in range(0, len(ids), 1000):
+            response = self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": id} for id in ids[i:i + 1000]], "Quiet": True}
+            )
+            for error in response.get('Errors', []):
+                results[error['Key']] = False
+        return results
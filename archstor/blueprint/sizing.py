@@ -0,0 +1,33 @@
+"""
+The sizes of the chunks objects are streamed in and out of backends in
+"""
+
+
+def next_power_of_two(n):
+    return 1 << max(n - 1, 0).bit_length()
+
+
+class ChunkSizing:
+    """
+    Fixed size chunks, or with adaptive set, chunks scaled to the length of
+    the object (when it's known) so it goes in about target_chunks of them,
+    within [minimum, maximum]. Small objects then go in small chunks, so
+    their first byte isn't held up behind a large read, and large objects
+    in large ones, cutting the per chunk overhead (a trip through python, a
+    socket write, a round trip to the backend).
+    """
+    def __init__(self, size=1024 * 1000, adaptive=False, minimum=64 * 1024,
+                 maximum=8 * 1024 * 1024, target_chunks=16):
+        self.size = size
+        self.adaptive = adaptive
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_chunks = target_chunks
+
+    def size_for(self, length=None):
+        # In: the length of the object (or range), or None if unknown
+        # Out: int chunk size
+        if not self.adaptive or length is None:
+            return self.size
+        size = next_power_of_two(-(-length // self.target_chunks))
+        return max(self.minimum, min(self.maximum, size))
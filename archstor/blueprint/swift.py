@@ -0,0 +1,498 @@
+"""
+The swift storage backend
+"""
+import json
+import logging
+from io import BytesIO
+from itertools import chain
+from tempfile import SpooledTemporaryFile
+from time import sleep
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+import swiftclient
+import swiftclient.service
+from swiftclient.exceptions import ClientException
+from werkzeug.http import parse_content_range_header, parse_date
+
+from . import IStorageBackend, RangedReader, as_utc, content_length, copy_stream, \
+    declared_digests, digesting, fan_out, range_header_value
+from .exceptions import Error, ObjectAlreadyExistsError, ObjectNotFoundError, \
+    RangeNotSatisfiableError
+from .parallel import upload_parts
+from .pool import ConnectionPool, PooledStream
+
+
+log = logging.getLogger(__name__)
+
+
+class SwiftStorageBackend(IStorageBackend):
+    # Static large objects can have at most 1000 segments (swift's default
+    # max_manifest_segments), segments are staged in up to SPOOL_MEMORY bytes
+    # of memory each (on disk past that), and a segment that fails to upload
+    # is retried after RETRY_BACKOFF seconds, doubling each attempt
+    MAX_SEGMENTS = 1000
+    SPOOL_MEMORY = 8 * 1024 * 1024
+    RETRY_BACKOFF = 0.5
+
+    def __init__(self,
+                 auth_url,
+                 auth_version,
+                 user,
+                 key,
+                 tenant_name,
+                 os_options={},
+                 container_name="lts",
+                 pool_size=10,
+                 pool_max_idle=60,
+                 pool_timeout=None,
+                 segment_size=128 * 1024 * 1024,
+                 workers=4,
+                 retries=5,
+                 segment_retries=3):
+        self.auth_url = auth_url
+        self.auth_version = auth_version
+        self.user = user
+        self.key = key
+        self.tenant_name = tenant_name
+        self.os_options = os_options
+        self.container_name = container_name
+        self.segment_size = segment_size
+        self.segment_container = container_name + "_segments"
+        self.workers = workers
+        self.segment_retries = segment_retries
+        self._segment_container_exists = False
+        self._opts = {'auth': self.auth_url, 'user': self.user, 'key': self.key,
+                      'use_slo': True, 'segment_size': segment_size,
+                      'auth_version': self.auth_version, 'retries': retries}
+        self._opts = dict(
+            swiftclient.service._default_global_options,
+            **dict(swiftclient.service._default_local_options, **self._opts)
+        )
+        swiftclient.service.process_options(self._opts)
+        # The storage url and token of the most recently returned connection,
+        # new connections start from these rather than re-authenticating
+        self._auth = None
+        self.pool = ConnectionPool(
+            self.create_connection,
+            size=pool_size,
+            max_idle=pool_max_idle,
+            timeout=pool_timeout,
+            check=lambda conn: bool(conn.url and conn.token),
+            close=lambda conn: conn.close(),
+            on_release=self._remember_auth
+        )
+        # Whether our LTS container is known to exist, nothing is connected
+        # until the first request
+        self._container_exists = False
+
+    def create_connection(self):
+        conn = swiftclient.service.get_conn(self._opts)
+        if self._auth is not None:
+            conn.url, conn.token = self._auth
+        if not self._container_exists:
+            self._ensure_container(conn)
+        return conn
+
+    def _ensure_container(self, conn):
+        try:
+            conn.head_container(self.container_name)
+        except ClientException as e:
+            if e.http_status == 404:
+                conn.put_container(self.container_name)
+            else:
+                raise
+        self._container_exists = True
+
+    def _remember_auth(self, conn):
+        if conn.url and conn.token:
+            self._auth = (conn.url, conn.token)
+
+    def connection(self):
+        # ClientExceptions are responses from swift, which leave the
+        # connection usable, anything else (socket errors etc) doesn't
+        return self.pool.connection(keep_on=(ClientException, Error))
+
+    def get_object_id_list(self, cursor, limit, prefix=None):
+        if cursor == "0":
+            cursor = None
+        results = []
+        listing = True
+        with self.connection() as conn:
+            while listing:
+                headers, listing = conn.get_container(
+                    self.container_name, marker=cursor, limit=limit, prefix=prefix
+                )
+                for x in listing:
+                    results.append(x['name'])
+                if not listing:
+                    cursor = None
+                    break
+                cursor = listing[-1].get('name', listing[-1].get('subdir'))
+                if limit is not None and len(listing) >= limit:
+                    break
+
+        return cursor, results
+
+    def iter_object_ids(self, prefix=None, start_after=None, page_size=1000):
+        # A pooled connection per page, rather than held while the consumer
+        # works through the listing
+        marker = start_after
+        while True:
+            with self.connection() as conn:
+                headers, listing = conn.get_container(
+                    self.container_name, marker=marker, limit=page_size, prefix=prefix
+                )
+            if not listing:
+                return
+            for x in listing:
+                yield x['name']
+            marker = listing[-1].get('name', listing[-1].get('subdir'))
+
+    def _get(self, id, headers=None):
+        # The connection goes back to the pool once the body is exhausted or
+        # closed, rather than being torn down under the unread response
+        conn = self.pool.acquire()
+        try:
+            resp_headers, contents = conn.get_object(
+                self.container_name, id, resp_chunk_size=self.read_chunk_size(),
+                headers=headers
+            )
+        except ClientException as e:
+            self.pool.release(conn)
+            if e.http_status == 404:
+                raise ObjectNotFoundError(str(id))
+            if e.http_status == 416:
+                content_range = parse_content_range_header(
+                    (e.http_response_headers or {}).get('content-range')
+                )
+                raise RangeNotSatisfiableError(
+                    length=content_range.length if content_range else None
+                )
+            raise
+        except BaseException:
+            self.pool.release(conn, discard=True)
+            raise
+        return resp_headers, PooledStream(contents, self.pool, conn)
+
+    def get_object(self, id):
+        headers, contents = self._get(id)
+        return contents
+
+    def get_object_range(self, id, start, stop):
+        headers, contents = self._get(
+            id, headers={'Range': range_header_value(start, stop)}
+        )
+        content_range = parse_content_range_header(headers.get('content-range'))
+        if content_range is None:
+            # Swift ignored the range, so we got the whole thing
+            length = int(headers['content-length'])
+            return contents, (0, length), length
+        return contents, (content_range.start, content_range.stop), \
+            content_range.length
+
+    def stat_object(self, id):
+        with self.connection() as conn:
+            try:
+                headers = conn.head_object(self.container_name, id)
+            except ClientException as e:
+                if e.http_status == 404:
+                    raise ObjectNotFoundError(str(id))
+                raise
+        digests = dict(
+            (k[len("x-object-meta-digest-"):], v) for k, v in headers.items()
+            if k.startswith("x-object-meta-digest-")
+        )
+        return {
+            "size": int(headers['content-length']),
+            "last_modified": as_utc(parse_date(headers.get('last-modified'))),
+            # For SLOs this is the etag of the manifest, which still changes
+            # whenever the content does
+            "digest": headers.get('etag', '').strip('"') or None,
+            "digests": digests
+        }
+
+    def check_object_exists(self, id):
+        with self.connection() as conn:
+            try:
+                conn.head_object(self.container_name, id)
+                return True
+            except ClientException as e:
+                if e.http_status == 404:
+                    return False
+                raise
+
+    @staticmethod
+    def _digest_headers(digests):
+        return dict(("X-Object-Meta-Digest-" + k, v) for k, v in digests.items())
+
+    def set_object(self, id, content):
+        content = digesting(content)
+        length = content_length(content)
+        if length is not None and length <= self.segment_size:
+            return self._put_streaming(id, content, length)
+        # Too large, or of unknown size, so it's staged a segment at a time
+        segment_size = self.segment_size
+        if length is not None:
+            segment_size = max(segment_size, -(-length // self.MAX_SEGMENTS))
+        spools = []
+        try:
+            segments = self._spool_segments(content, segment_size, length is None, spools)
+            first = next(segments, None)
+            if first is None or first[1] < segment_size:
+                # It all fit in one, by which point the digests are known
+                # and can go along with it
+                spool, size = first or (BytesIO(), 0)
+                return self._put_whole(id, content, spool, size)
+            return self._put_segmented(id, content, chain([first], segments))
+        finally:
+            for spool in spools:
+                spool.close()
+
+    def _put_streaming(self, id, content, length):
+        # Failing part way through reading the content (a digest mismatch,
+        # say) leaves the connection mid request, so don't keep it
+        with self.pool.connection(keep_on=(ClientException,)) as conn:
+            # Swift refuses the write (412) if the object exists, atomically
+            declared = declared_digests(content)
+            headers = self._digest_headers(declared) if declared else {}
+            headers['If-None-Match'] = '*'
+            try:
+                conn.put_object(self.container_name, id, contents=content,
+                                chunk_size=self.upload_chunk_size(length),
+                                headers=headers)
+            except ClientException as e:
+                if e.http_status == 412:
+                    raise ObjectAlreadyExistsError(str(id))
+                raise
+            if not declared:
+                # Metadata has to be sent before the body, so digests only
+                # known once it's all been read are attached afterwards (a
+                # metadata only request, the content isn't re-read)
+                self._post_digests(conn, id, content.hexdigests())
+        return content.hexdigests()
+
+    def _post_digests(self, conn, id, digests):
+        # The object is stored by now, so failing to describe it isn't worth
+        # failing the request (and its retry, which would 409) over; it's
+        # just without stored digests, as objects written before there were
+        # any are
+        try:
+            conn.post_object(self.container_name, id,
+                             headers=self._digest_headers(digests))
+        except Exception as e:
+            log.warning("Couldn't store the digests of swift object %s: %s", id, e)
+
+    def _put_whole(self, id, content, f, size):
+        headers = self._digest_headers(content.hexdigests())
+        headers['If-None-Match'] = '*'
+        with self.pool.connection(keep_on=(ClientException,)) as conn:
+            try:
+                conn.put_object(self.container_name, id, contents=f, content_length=size,
+                                chunk_size=self.upload_chunk_size(size), headers=headers)
+            except ClientException as e:
+                if e.http_status == 412:
+                    raise ObjectAlreadyExistsError(str(id))
+                raise
+        return content.hexdigests()
+
+    def _spool_segments(self, content, segment_size, grow, spools):
+        # In: readable file like object + segment size + whether to grow the
+        # segment size (the length isn't known, so neither is how many
+        # segments there'll be) + list each spool is appended to
+        # Out: generator of (spooled segment, its size), all segment_size
+        # long except (perhaps) the last
+        # The content is read one segment at a time, as upload_parts asks
+        # for them, so at most a few segments are staged at once.
+        n = 0
+        while True:
+            spool = SpooledTemporaryFile(max_size=self.SPOOL_MEMORY)
+            spools.append(spool)
+            size = copy_stream(RangedReader(content, segment_size), spool,
+                               self.upload_chunk_size(segment_size))
+            if not size:
+                spool.close()
+                return
+            spool.seek(0)
+            yield spool, size
+            if size < segment_size:
+                return
+            n += 1
+            if grow and n % (self.MAX_SEGMENTS // 10) == 0:
+                segment_size *= 2
+
+    def _ensure_segment_container(self):
+        if self._segment_container_exists:
+            return
+        with self.connection() as conn:
+            conn.put_container(self.segment_container)
+        self._segment_container_exists = True
+
+    def _put_segment(self, name, f, size):
+        # Out: the segment's etag
+        # Retried from the start of the spool, on top of swiftclient's own
+        # retries, so one bad segment doesn't fail a whole large upload
+        attempt = 0
+        while True:
+            f.seek(0)
+            try:
+                with self.pool.connection(keep_on=(ClientException,)) as conn:
+                    return conn.put_object(self.segment_container, name, contents=f,
+                                           content_length=size,
+                                           chunk_size=self.upload_chunk_size(size))
+            except Exception as e:
+                status = getattr(e, "http_status", None)
+                if attempt >= self.segment_retries or \
+                        (status is not None and 400 <= status < 500 and status not in (408, 429)):
+                    raise
+                log.warning("Retrying swift segment %s after: %s", name, e)
+                sleep(self.RETRY_BACKOFF * 2 ** attempt)
+                attempt += 1
+
+    def _put_segmented(self, id, content, segments):
+        # Segments are uploaded concurrently under a name unique to this
+        # upload, then the manifest stitching them together is written as
+        # the object itself, conditionally, so concurrent uploads of the
+        # same identifier can't clobber each other's segments
+        self._ensure_segment_container()
+        upload = "{}/{}/".format(id, uuid4().hex)
+        names = []
+
+        def upload_segment(number, segment):
+            f, size = segment
+            name = "{}{:08d}".format(upload, number)
+            # Before it's sent, a segment that seemingly failed may still
+            # have landed
+            names.append(name)
+            try:
+                etag = self._put_segment(name, f, size)
+            finally:
+                f.close()
+            return {"path": "/{}/{}".format(self.segment_container, name),
+                    "etag": etag, "size_bytes": size}
+
+        try:
+            manifest = upload_parts(segments, upload_segment, workers=self.workers)
+            headers = self._digest_headers(content.hexdigests())
+            headers['If-None-Match'] = '*'
+            with self.connection() as conn:
+                try:
+                    conn.put_object(self.container_name, id, contents=json.dumps(manifest),
+                                    query_string="multipart-manifest=put", headers=headers)
+                except ClientException as e:
+                    if e.http_status == 412:
+                        raise ObjectAlreadyExistsError(str(id))
+                    raise
+        except BaseException:
+            # Otherwise they're orphaned, nothing references them
+            self._delete_segments(names)
+            raise
+        return content.hexdigests()
+
+    def _bulk_delete(self, paths):
+        # In: list of "/container/object" paths
+        # Out: the bulk middleware's response, or None if the cluster
+        # doesn't have it
+        body = "\n".join(quote(x) for x in paths).encode("utf-8")
+        with self.connection() as conn:
+            try:
+                headers, response = conn.post_account(
+                    {'Accept': 'application/json', 'Content-Type': 'text/plain'},
+                    query_string='bulk-delete',
+                    data=body
+                )
+            except ClientException as e:
+                if e.http_status in (400, 404, 405, 501):
+                    return None
+                raise
+        return json.loads(response.decode("utf-8"))
+
+    def _delete_segments(self, names):
+        # Best effort, failing to tidy up shouldn't mask what went wrong
+        if not names:
+            return
+        try:
+            paths = ["/{}/{}".format(self.segment_container, x) for x in names]
+            if self._bulk_delete(paths) is not None:
+                return
+            with self.connection() as conn:
+                for name in names:
+                    try:
+                        conn.delete_object(self.segment_container, name)
+                    except ClientException as e:
+                        if e.http_status != 404:
+                            raise
+        except Exception:
+            log.exception("Couldn't delete %s swift segments from %s", len(names),
+                          self.segment_container)
+
+    def _segmented(self, ids):
+        # Out: set of those ids with segments (large objects, or uploads of
+        # them in progress)
+        with self.connection() as conn:
+            try:
+                headers = conn.head_container(self.segment_container)
+            except ClientException as e:
+                if e.http_status == 404:
+                    return set()
+                raise
+            if not int(headers.get('x-container-object-count', 0)):
+                return set()
+            segmented = set()
+            for id in ids:
+                headers, listing = conn.get_container(
+                    self.segment_container, prefix=id + "/", limit=1
+                )
+                if listing:
+                    segmented.add(id)
+        return segmented
+
+    def del_object(self, id):
+        with self.connection() as conn:
+            try:
+                # Removes a large object's segments along with it
+                conn.delete_object(self.container_name, id,
+                                   query_string="multipart-manifest=delete")
+            except ClientException as e:
+                if e.http_status == 404:
+                    return
+                raise
+
+    def del_objects(self, ids):
+        # Uses the bulk middleware, if the cluster has it. That leaves a
+        # large object's segments behind, so those with any are deleted one
+        # at a time, as del_object does, and swift removes exactly the
+        # segments each manifest references (never those of an upload
+        # still in progress, or of an object that failed to delete).
+        ids = list(ids)
+        if not ids:
+            return {}
+        segmented = self._segmented(ids)
+        results = fan_out(self._del_object_result, [x for x in ids if x in segmented])
+        rest = [x for x in ids if x not in segmented]
+        if rest:
+            response = self._bulk_delete(
+                ["/{}/{}".format(self.container_name, id) for id in rest]
+            )
+            if response is None:
+                log.debug("No bulk delete support, deleting one at a time")
+                results.update(fan_out(self._del_object_result, rest))
+            else:
+                results.update((id, True) for id in rest)
+                prefix = "/{}/".format(self.container_name)
+                for name, status in response.get("Errors", []):
+                    # Names come back quoted or not, depending on the swift
+                    # version
+                    name = unquote(name)
+                    if name.startswith(prefix) and not status.startswith("404"):
+                        results[name[len(prefix):]] = False
+        return dict((id, results[id]) for id in ids)
+
+    def _del_object_result(self, id):
+        # Out: bool, whether id was deleted
+        try:
+            self.del_object(id)
+        except ClientException as e:
+            log.warning("Couldn't delete swift object %s: %s", id, e)
+            return False
+        return True
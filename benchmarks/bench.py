@@ -0,0 +1,618 @@
+"""
+Reproducible benchmarks of archstor, driving the flask app (through its test
+client, or a real WSGI server) against each backend or a local stand in for
+it, and reporting throughput, latency and peak RSS as JSON
+
+    python -m benchmarks.bench --backend filesystem --backend swift \\
+        --sizes 4KiB:70,1MiB:25,16MiB:5 --objects 200 --concurrency 8 \\
+        --output results.json
+    python -m benchmarks.bench --compare baseline.json results.json
+"""
+import json
+import platform
+import random
+import resource
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.client import HTTPConnection
+from os import environ
+from re import fullmatch
+from tempfile import TemporaryDirectory
+from threading import Event, Thread, local
+from time import perf_counter
+from urllib.parse import urlencode
+from uuid import uuid4
+
+# Storage is configured per benchmark, not from the environment
+environ.setdefault('ARCHSTOR_DEFER_CONFIG', "True")
+
+import archstor  # noqa: E402
+from archstor import blueprint  # noqa: E402
+from werkzeug.serving import make_server, WSGIRequestHandler  # noqa: E402
+
+
+WORKLOADS = ("ingest", "download", "range", "list", "mixed")
+BACKENDS = ("filesystem", "mongo", "swift", "s3")
+
+UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_size(value):
+    # "512", "4KiB", "4k", "16MB" (sizes are always binary)
+    match = fullmatch(r"\s*(\d+)\s*([kmg]?)(?:i?b)?\s*", value.lower())
+    if match is None:
+        raise ValueError("Can't parse size: {}".format(value))
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def parse_sizes(value):
+    # "4KiB:70,1MiB:25,16MiB:5" -> [(size, weight), ...]
+    sizes = []
+    for entry in value.split(","):
+        size, _, weight = entry.partition(":")
+        sizes.append((parse_size(size), float(weight or 1)))
+    return sizes
+
+
+def parse_mix(value):
+    # "get=60,range=20,put=15,list=5" -> {operation: weight}
+    mix = {}
+    for entry in value.split(","):
+        operation, _, weight = entry.partition("=")
+        if operation.strip() not in ("get", "range", "put", "head", "list"):
+            raise ValueError("Unknown operation: {}".format(operation))
+        mix[operation.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(ordered, fraction):
+    # Nearest rank
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def current_rss():
+    # Bytes, or None where /proc isn't available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss():
+    # The process' lifetime peak (ru_maxrss is KiB on linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RSSSampler:
+    """
+    Polls the resident set size while a workload runs, since the lifetime
+    peak can't be reset between workloads
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = current_rss() or 0
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        rss = current_rss()
+        if rss is None:
+            self.peak = max_rss()
+        else:
+            self.peak = max(self.peak, rss)
+
+
+class Payloads:
+    # Deterministic (per seed) incompressible content, without generating
+    # every object's bytes separately
+    def __init__(self, seed, block_size=1024 * 1024):
+        rng = random.Random(seed)
+        self.block = bytes(rng.getrandbits(8) for x in range(block_size))
+
+    def get(self, size):
+        repeats = size // len(self.block) + 1
+        return (self.block * repeats)[:size]
+
+
+class TestClientDriver:
+    # Requests go through flask's test client, in process, with no sockets
+    def __init__(self, app):
+        self.app = app
+        self._local = local()
+
+    @property
+    def client(self):
+        if getattr(self._local, "client", None) is None:
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def request(self, method, path, body=None, headers=None, query=None):
+        # Out: (status, body bytes read, body if small enough to keep)
+        rv = self.client.open(
+            path, method=method, data=body, headers=headers or {}, query_string=query,
+            content_type="application/octet-stream" if body is not None else None
+        )
+        try:
+            kept = []
+            count = 0
+            for data in rv.response:
+                count += len(data)
+                if method != "GET" or path == "/":
+                    kept.append(data)
+            return rv.status_code, count, b"".join(kept)
+        finally:
+            rv.close()
+
+
+class HTTPDriver:
+    # Requests go over real (keep alive) HTTP connections, one per thread
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._local = local()
+
+    def request(self, method, path, body=None, headers=None, query=None):
+        if query:
+            path += "?" + urlencode(query)
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Type'] = "application/octet-stream"
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = HTTPConnection(self.host, self.port)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            kept = []
+            count = 0
+            data = resp.read(1024 * 1024)
+            while data:
+                count += len(data)
+                if method != "GET" or path.startswith("/?") or path == "/":
+                    kept.append(data)
+                data = resp.read(1024 * 1024)
+            if resp.will_close:
+                conn.close()
+                self._local.conn = None
+            return resp.status, count, b"".join(kept)
+        except Exception:
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+class _KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@contextmanager
+def wsgi_server(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True,
+                         request_handler=_KeepAliveHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.host, server.port
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# Backends, each a context manager yielding a storage backend
+
+@contextmanager
+def filesystem_backend(args):
+    with TemporaryDirectory() as root:
+        yield blueprint.FileSystemStorageBackend(root)
+
+
+@contextmanager
+def mongo_backend(args):
+    db_name = "archstor_bench_{}".format(uuid4().hex)
+    if args.mongo == "mock":
+        import mongomock
+        import mongomock.gridfs
+        from archstor.blueprint import mongo
+        mongomock.gridfs.enable_gridfs_integration()
+        real_client = mongo.MongoClient
+        mongo.MongoClient = mongomock.MongoClient
+        try:
+            yield mongo.MongoStorageBackend("localhost", 27017, db_name)
+        finally:
+            mongo.MongoClient = real_client
+        return
+    host, _, port = args.mongo.partition(":")
+    storage = blueprint.MongoStorageBackend(host, int(port or 27017), db_name)
+    try:
+        yield storage
+    finally:
+        storage.db.client.drop_database(db_name)
+
+
+@contextmanager
+def swift_backend(args):
+    # The test suite's fake, so run from the root of the repository
+    from tests.fakeswift import FakeSwift
+    swift = FakeSwift().start()
+    try:
+        yield blueprint.SwiftStorageBackend(
+            swift.auth_url, '1', swift.user, swift.key, 'bench',
+            container_name='bench', pool_size=max(args.concurrency, 4)
+        )
+    finally:
+        swift.stop()
+
+
+@contextmanager
+def s3_backend(args):
+    # An S3 compatible endpoint (minio, say) if given, otherwise moto, as a
+    # local server if moto's server extras are installed, else in process
+    environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    bucket = "archstor-bench-{}".format(uuid4().hex[:12])
+    kwargs = {"region_name": "us-east-1", "workers": max(args.concurrency // 2, 2)}
+    if args.s3_endpoint:
+        yield blueprint.S3StorageBackend(bucket, endpoint_url=args.s3_endpoint, **kwargs)
+        return
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        ThreadedMotoServer = None
+    if ThreadedMotoServer is not None:
+        server = ThreadedMotoServer(port=0, verbose=False)
+        server.start()
+        host, port = server.get_host_and_port()
+        try:
+            yield blueprint.S3StorageBackend(
+                bucket, endpoint_url="http://{}:{}".format(host, port), **kwargs
+            )
+        finally:
+            server.stop()
+        return
+    from moto import mock_aws
+    with mock_aws():
+        yield blueprint.S3StorageBackend(bucket, **kwargs)
+
+
+BACKEND_FACTORIES = {
+    "filesystem": filesystem_backend,
+    "mongo": mongo_backend,
+    "swift": swift_backend,
+    "s3": s3_backend
+}
+
+
+class Benchmark:
+    def __init__(self, driver, args, payloads, rng):
+        self.driver = driver
+        self.args = args
+        self.payloads = payloads
+        self.rng = rng
+        self.sizes = parse_sizes(args.sizes)
+        # identifier -> size, of everything stored so far
+        self.objects = {}
+
+    def sample_size(self):
+        sizes, weights = zip(*self.sizes)
+        return self.rng.choices(sizes, weights)[0]
+
+    def run(self, name, operations):
+        # In: list of zero argument callables, each returning bytes moved
+        # Out: summary dict
+        def timed(operation):
+            started = perf_counter()
+            try:
+                moved = operation()
+                error = None
+            except Exception as e:
+                moved = 0
+                error = repr(e)
+            return perf_counter() - started, moved, error
+
+        with RSSSampler() as rss:
+            started = perf_counter()
+            with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+                results = list(executor.map(timed, operations))
+            seconds = perf_counter() - started
+        latencies = sorted(x[0] for x in results if x[2] is None)
+        errors = [x[2] for x in results if x[2] is not None]
+        moved = sum(x[1] for x in results)
+        return {
+            "workload": name,
+            "operations": len(results),
+            "errors": len(errors),
+            "error_samples": sorted(set(errors))[:5],
+            "seconds": seconds,
+            "ops_per_second": len(results) / seconds if seconds else None,
+            "bytes": moved,
+            "mib_per_second": moved / (1024 * 1024) / seconds if seconds else None,
+            "latency_ms": {
+                "p50": _ms(percentile(latencies, .5)),
+                "p90": _ms(percentile(latencies, .9)),
+                "p99": _ms(percentile(latencies, .99)),
+                "max": _ms(latencies[-1] if latencies else None),
+                "mean": _ms(sum(latencies) / len(latencies) if latencies else None)
+            },
+            "peak_rss_mib": rss.peak / (1024 * 1024)
+        }
+
+    # Single operations
+
+    def put(self, id, size):
+        status, _, body = self.driver.request("PUT", "/" + id, body=self.payloads.get(size))
+        if status != 200:
+            raise RuntimeError("PUT {} answered {}: {}".format(id, status, body[:200]))
+        self.objects[id] = size
+        return size
+
+    def get(self, id):
+        status, count, _ = self.driver.request("GET", "/" + id)
+        if status != 200 or count != self.objects[id]:
+            raise RuntimeError("GET {} answered {} with {} bytes".format(id, status, count))
+        return count
+
+    def get_range(self, id, start, stop):
+        status, count, _ = self.driver.request(
+            "GET", "/" + id, headers={"Range": "bytes={}-{}".format(start, stop - 1)}
+        )
+        if status != 206 or count != stop - start:
+            raise RuntimeError("Range of {} answered {} with {} bytes".format(id, status, count))
+        return count
+
+    def head(self, id):
+        status, _, _ = self.driver.request("HEAD", "/" + id)
+        if status != 200:
+            raise RuntimeError("HEAD {} answered {}".format(id, status))
+        return 0
+
+    def list_page(self, cursor):
+        # Out: the next cursor
+        status, _, body = self.driver.request(
+            "GET", "/", query={"cursor": cursor, "limit": self.args.page_size}
+        )
+        if status != 200:
+            raise RuntimeError("Listing answered {}".format(status))
+        return json.loads(body.decode("utf-8"))['pagination']['next_cursor']
+
+    def list_first(self):
+        self.list_page("0")
+        return 0
+
+    def random_range(self):
+        candidates = [id for id, size in self.objects.items() if size > 0]
+        id = self.rng.choice(candidates)
+        size = self.objects[id]
+        length = min(self.args.range_size, size)
+        start = self.rng.randrange(0, size - length + 1)
+        return id, start, start + length
+
+    # Workloads
+
+    def ingest(self):
+        operations = []
+        for x in range(self.args.objects):
+            id = "bench{}".format(uuid4().hex)
+            size = self.sample_size()
+            operations.append(lambda id=id, size=size: self.put(id, size))
+        return self.run("ingest", operations)
+
+    def download(self):
+        ids = list(self.objects)
+        self.rng.shuffle(ids)
+        return self.run("download", [lambda id=id: self.get(id) for id in ids])
+
+    def range(self):
+        operations = []
+        for x in range(self.args.range_requests or len(self.objects)):
+            id, start, stop = self.random_range()
+            operations.append(lambda id=id, start=start, stop=stop: self.get_range(id, start, stop))
+        return self.run("range", operations)
+
+    def list(self):
+        # Pages depend on each other, so a walk is sequential, the
+        # concurrency is in running several walks at once
+        pages = []
+
+        def walk():
+            cursor = "0"
+            count = 0
+            while cursor:
+                cursor = self.list_page(cursor)
+                count += 1
+            pages.append(count)
+            return 0
+
+        summary = self.run("list", [walk for x in range(self.args.concurrency)])
+        summary['pages_per_walk'] = max(pages) if pages else 0
+        return summary
+
+    def mixed(self):
+        mix = parse_mix(self.args.mix)
+        names, weights = zip(*mix.items())
+        operations = []
+        for x in range(self.args.mixed_operations or 2 * self.args.objects):
+            name = self.rng.choices(names, weights)[0]
+            if name == "put":
+                id = "bench{}".format(uuid4().hex)
+                operations.append(lambda id=id, size=self.sample_size(): self.put(id, size))
+            elif name == "get":
+                id = self.rng.choice(list(self.objects))
+                operations.append(lambda id=id: self.get(id))
+            elif name == "head":
+                id = self.rng.choice(list(self.objects))
+                operations.append(lambda id=id: self.head(id))
+            elif name == "range":
+                id, start, stop = self.random_range()
+                operations.append(
+                    lambda id=id, start=start, stop=stop: self.get_range(id, start, stop)
+                )
+            else:
+                operations.append(self.list_first)
+        return self.run("mixed", operations)
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def run_backend(name, args):
+    # Out: list of workload summaries
+    with BACKEND_FACTORIES[name](args) as storage:
+        blueprint.BLUEPRINT.config['storage'] = storage
+        app = archstor.app
+        payloads = Payloads(args.seed)
+        rng = random.Random(args.seed)
+        results = []
+        if args.mode == "wsgi":
+            with wsgi_server(app) as (host, port):
+                bench = Benchmark(HTTPDriver(host, port), args, payloads, rng)
+                for workload in args.workloads:
+                    results.append(getattr(bench, workload)())
+        else:
+            bench = Benchmark(TestClientDriver(app), args, payloads, rng)
+            for workload in args.workloads:
+                results.append(getattr(bench, workload)())
+        for summary in results:
+            summary['backend'] = name
+            summary['mode'] = args.mode
+        return results
+
+
+def run(args):
+    args.workloads = list(args.workload or WORKLOADS)
+    if "ingest" not in args.workloads:
+        # Everything else needs objects to work on
+        args.workloads.insert(0, "ingest")
+    report = {
+        "archstor_version": blueprint.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": datetime.now(timezone.utc).isoformat(),
+        "parameters": {
+            "mode": args.mode, "objects": args.objects, "sizes": args.sizes,
+            "concurrency": args.concurrency, "range_size": args.range_size,
+            "page_size": args.page_size, "mix": args.mix, "seed": args.seed
+        },
+        "results": []
+    }
+    for name in args.backend or BACKENDS:
+        try:
+            report['results'].extend(run_backend(name, args))
+        except Exception as e:
+            if args.backend:
+                raise
+            # Only skip stand ins we couldn't set up when running everything
+            print("Skipping {}: {!r}".format(name, e), file=sys.stderr)
+    report['peak_rss_mib'] = max_rss() / (1024 * 1024)
+    return report
+
+
+def compare(baseline, current, threshold):
+    # Out: list of regression descriptions
+    # Lower is better for latency, higher for throughput
+    def key(summary):
+        return summary['backend'], summary['mode'], summary['workload']
+
+    before = dict((key(x), x) for x in baseline['results'])
+    regressions = []
+    for summary in current['results']:
+        old = before.get(key(summary))
+        if old is None:
+            continue
+        checks = [
+            ("ops_per_second", old['ops_per_second'], summary['ops_per_second'], 1),
+            ("latency p50", old['latency_ms']['p50'], summary['latency_ms']['p50'], -1),
+            ("latency p99", old['latency_ms']['p99'], summary['latency_ms']['p99'], -1),
+            ("peak_rss_mib", old['peak_rss_mib'], summary['peak_rss_mib'], -1)
+        ]
+        for metric, was, now, direction in checks:
+            if not was or now is None:
+                continue
+            change = (now - was) / was * 100
+            print("{:<11} {:<5} {:<9} {:<15} {:>12.2f} -> {:>12.2f} ({:+.1f}%)".format(
+                summary['backend'], summary['mode'], summary['workload'], metric,
+                was, now, change
+            ))
+            if change * direction < -threshold:
+                regressions.append("{} {} {} {} {:+.1f}%".format(
+                    summary['backend'], summary['mode'], summary['workload'], metric, change
+                ))
+    return regressions
+
+
+def build_parser():
+    parser = ArgumentParser(description="Benchmark archstor against local backends")
+    parser.add_argument("--backend", action="append", choices=BACKENDS,
+                        help="Repeatable, defaults to every backend")
+    parser.add_argument("--workload", action="append", choices=WORKLOADS,
+                        help="Repeatable, defaults to every workload")
+    parser.add_argument("--mode", choices=("client", "wsgi"), default="client",
+                        help="The flask test client, or a real WSGI server over HTTP")
+    parser.add_argument("--objects", type=int, default=100)
+    parser.add_argument("--sizes", default="4KiB:70,256KiB:25,8MiB:5",
+                        help="Object size distribution, size:weight,...")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--range-size", type=parse_size, default=64 * 1024)
+    parser.add_argument("--range-requests", type=int, default=None,
+                        help="Defaults to the number of objects")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--mix", default="get=60,range=20,put=10,head=5,list=5")
+    parser.add_argument("--mixed-operations", type=int, default=None,
+                        help="Defaults to twice the number of objects")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo", default="localhost:27017",
+                        help="A mongod host[:port], or 'mock' for mongomock")
+    parser.add_argument("--s3-endpoint", default=None,
+                        help="An S3 compatible endpoint, defaults to moto")
+    parser.add_argument("--output", default=None, help="Defaults to stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Compare two reports instead of running")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="Percent change treated as a regression by --compare")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        return 1 if regressions else 0
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,185 @@
+"""
+How long an archstor worker takes to start: importing the application and
+configuring a storage backend, each run in a fresh interpreter, and which
+storage client libraries that pulled in. Only the configured backend's
+should be imported, and nothing should connect to it.
+
+    python -m benchmarks.startup --backend filesystem --backend s3 --runs 10 \\
+        --max-seconds 0.5 --importtime 15
+
+Exits non-zero if the median startup exceeds --max-seconds, or if another
+backend's client library was imported.
+"""
+import json
+import platform
+import subprocess
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from statistics import median
+from tempfile import TemporaryDirectory
+
+
+BACKENDS = ("filesystem", "mongo", "s3", "swift")
+
+# The top level modules of each backend's client library
+DRIVERS = {
+    "filesystem": ("pypairtree",),
+    "mongo": ("pymongo", "gridfs", "bson"),
+    "s3": ("boto3", "botocore"),
+    "swift": ("swiftclient",)
+}
+
+# Enough to configure each backend, none of which has to be listening
+CONFIGS = {
+    "filesystem": lambda tmpdir: {"LTS_ROOT": tmpdir},
+    "mongo": lambda tmpdir: {"MONGO_HOST": "127.0.0.1", "MONGO_PORT": 9},
+    "s3": lambda tmpdir: {"S3_BUCKET": "archstor-startup", "S3_REGION": "us-east-1",
+                          "S3_ENDPOINT_URL": "http://127.0.0.1:9"},
+    "swift": lambda tmpdir: {"SWIFT_AUTH_URL": "http://127.0.0.1:9/auth/v1.0",
+                             "SWIFT_AUTH_VERSION": "1", "SWIFT_USER": "startup",
+                             "SWIFT_KEY": "startup", "SWIFT_TENANT_NAME": "startup"}
+}
+
+# Run in the fresh interpreter, modules already imported by the time it
+# starts (by a sitecustomize, say) aren't archstor's doing
+STARTUP = """
+import json, sys
+from time import perf_counter
+before = set(sys.modules)
+start = perf_counter()
+from flask import Flask
+from archstor.blueprint import BLUEPRINT
+imported = perf_counter()
+app = Flask("archstor")
+app.config.update(json.loads(sys.argv[1]))
+app.register_blueprint(BLUEPRINT)
+configured = perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "configure_seconds": configured - imported,
+    "storage": type(BLUEPRINT.config.get("storage")).__name__,
+    "modules": sorted(set(x.split(".")[0] for x in sys.modules) - before)
+}))
+"""
+
+
+def start(backend, tmpdir, importtime=False):
+    # Out: the STARTUP script's report, and -X importtime's output if asked
+    config = dict(CONFIGS[backend](tmpdir), STORAGE_BACKEND=backend, DEFER_CONFIG=False)
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    result = subprocess.run(
+        command + ["-c", STARTUP, json.dumps(config)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout), result.stderr
+
+
+def slowest_imports(importtime, count):
+    # In: -X importtime output
+    # Out: the count top level imports which took longest, cumulatively
+    imports = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit() or name.startswith("  "):
+            continue
+        imports.append({"module": name.strip(), "ms": int(cumulative) / 1000})
+    return sorted(imports, key=lambda x: x['ms'], reverse=True)[:count]
+
+
+def measure(backend, runs, importtime=0):
+    summary = {"backend": backend, "runs": runs}
+    reports = []
+    with TemporaryDirectory() as tmpdir:
+        try:
+            for _ in range(runs):
+                reports.append(start(backend, tmpdir)[0])
+            if importtime:
+                summary['slowest_imports'] = slowest_imports(
+                    start(backend, tmpdir, importtime=True)[1], importtime
+                )
+        except RuntimeError as e:
+            summary['error'] = str(e)
+            return summary
+    totals = sorted(x['import_seconds'] + x['configure_seconds'] for x in reports)
+    summary['storage'] = reports[-1]['storage']
+    summary['seconds'] = {"min": totals[0], "median": median(totals), "max": totals[-1]}
+    summary['import_seconds'] = median(x['import_seconds'] for x in reports)
+    summary['configure_seconds'] = median(x['configure_seconds'] for x in reports)
+    modules = set(reports[-1]['modules'])
+    summary['drivers'] = sorted(
+        x for driver in DRIVERS.values() for x in driver if x in modules
+    )
+    summary['unexpected_drivers'] = sorted(
+        x for x in summary['drivers'] if x not in DRIVERS[backend]
+    )
+    return summary
+
+
+def run(args):
+    return {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "max_seconds": args.max_seconds,
+        "results": [
+            measure(backend, args.runs, args.importtime)
+            for backend in (args.backend or BACKENDS)
+        ]
+    }
+
+
+def failures(report):
+    # Out: list of str, how the report misses its targets
+    failed = []
+    for summary in report['results']:
+        if 'error' in summary:
+            failed.append("{}: {}".format(summary['backend'], summary['error']))
+            continue
+        if summary['unexpected_drivers']:
+            failed.append("{} imported {}".format(
+                summary['backend'], ", ".join(summary['unexpected_drivers'])
+            ))
+        if report['max_seconds'] is not None and \
+                summary['seconds']['median'] > report['max_seconds']:
+            failed.append("{} took {:.3f}s to start".format(
+                summary['backend'], summary['seconds']['median']
+            ))
+    return failed
+
+
+def build_parser():
+    parser = ArgumentParser(description="Benchmark archstor's startup")
+    parser.add_argument("--backend", action="append", choices=BACKENDS,
+                        help="Repeatable, defaults to every backend")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=0.5,
+                        help="The target median time to import and configure archstor")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N",
+                        help="Report the N slowest imports, from python -X importtime")
+    parser.add_argument("--output", default=None, help="Defaults to stdout")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    report = run(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    failed = failures(report)
+    for failure in failed:
+        print("FAILED: " + failure, file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -16,6 +16,7 @@ setup(
     author_email="brian@brianbalsamo.com",
     packages=find_packages(
         exclude=[
+            "benchmarks"
         ]
     ),
     include_package_data=True,
@@ -31,6 +32,13 @@ setup(
         'pypairtree',
         'pymongo'
     ],
+    entry_points={
+        'console_scripts': [
+            'archstor-fsindex = archstor.blueprint.fsindex:main',
+            'archstor-fixity-audit = archstor.blueprint.fixity:main',
+            'archstor-migrate = archstor.blueprint.migrate:main'
+        ]
+    },
     tests_require=[
         'pytest'
     ],
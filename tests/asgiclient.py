@@ -0,0 +1,93 @@
+"""
+A stand in for flask's test client which drives an ASGI application, so
+the same tests can be run against archstor.asgi
+"""
+import asyncio
+
+from flask import Response
+from werkzeug.datastructures import Headers
+from werkzeug.test import EnvironBuilder
+
+
+class ASGITestClient:
+    def __init__(self, app, chunk_size=64 * 1024):
+        self.app = app
+        self.chunk_size = chunk_size
+
+    def open(self, path, method="GET", **kwargs):
+        builder = EnvironBuilder(path=path, method=method, **kwargs)
+        try:
+            environ = builder.get_environ()
+            body = environ['wsgi.input'].read()
+        finally:
+            builder.close()
+        headers = [
+            (name[5:].replace("_", "-").lower(), value) for name, value in environ.items()
+            if name.startswith("HTTP_")
+        ]
+        for name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            if environ.get(name):
+                headers.append((name.replace("_", "-").lower(), environ[name]))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": environ['PATH_INFO'].encode("latin-1").decode("utf-8"),
+            "raw_path": environ['PATH_INFO'].encode("latin-1"),
+            "query_string": environ['QUERY_STRING'].encode("latin-1"),
+            "root_path": "",
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+            "client": ("127.0.0.1", 12345),
+            "server": ("localhost", 80)
+        }
+        return asyncio.run(self._request(scope, body))
+
+    async def _request(self, scope, body):
+        chunks = [
+            body[x:x + self.chunk_size] for x in range(0, len(body), self.chunk_size)
+        ] or [b""]
+        received = []
+        sent = []
+
+        async def receive():
+            if received:
+                # The whole body has gone, so it's only the client going away
+                # that's left to hear about
+                await asyncio.Event().wait()
+            data = chunks.pop(0)
+            if not chunks:
+                received.append(True)
+            return {"type": "http.request", "body": data, "more_body": bool(chunks)}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app(scope, receive, send)
+        start = sent[0]
+        assert start["type"] == "http.response.start"
+        assert not sent[-1].get("more_body", False)
+        response = Response(
+            b"".join(x.get("body", b"") for x in sent[1:]), status=start["status"]
+        )
+        # As sent, Content-Length included (HEAD responses have no body)
+        response.headers = Headers(
+            [(k.decode("latin-1"), v.decode("latin-1")) for k, v in start["headers"]]
+        )
+        return response
+
+    def get(self, path, **kwargs):
+        return self.open(path, "GET", **kwargs)
+
+    def head(self, path, **kwargs):
+        return self.open(path, "HEAD", **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open(path, "PUT", **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, "POST", **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, "DELETE", **kwargs)
@@ -0,0 +1,318 @@
+"""
+A minimal in-memory stand in for a Swift proxy (v1 auth), good enough to
+exercise SwiftStorageBackend in the test suite. Static large object
+manifests are supported, and object PUTs can be made to fail or to take a
+while, to exercise segmented uploads.
+"""
+import json
+from hashlib import md5
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs, unquote
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+from werkzeug.http import http_date, parse_range_header
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def _read_body(environ):
+    stream = environ['wsgi.input']
+    if environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int(stream.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                # Trailers, if any, end with a blank line
+                while stream.readline().strip():
+                    pass
+                break
+            chunks.append(stream.read(size))
+            stream.readline()
+        return b"".join(chunks)
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    return stream.read(length) if length else b""
+
+
+class FakeSwift:
+    def __init__(self, user="test:tester", key="testing"):
+        self.user = user
+        self.key = key
+        self.token = "AUTH_tk_fake"
+        self.containers = {}
+        self.manifests = {}
+        self.auth_requests = 0
+        self.requests = 0
+        # container -> [how many of the next PUTs into it answer 503, only
+        # those of objects with names containing this]
+        self.failures = {}
+        # How many of the next object POSTs answer 503
+        self.failing_posts = 0
+        # Objects whose deletes (bulk or not) answer 503
+        self.undeletable = set()
+        self.put_delay = 0
+        self.puts_in_flight = 0
+        self.max_puts_in_flight = 0
+        self._lock = Lock()
+        self._server = None
+
+    @property
+    def auth_url(self):
+        return "http://127.0.0.1:{}/auth/v1.0".format(self._server.server_port)
+
+    def start(self):
+        self._server = make_server(
+            "127.0.0.1", 0, self, server_class=_ThreadingWSGIServer,
+            handler_class=_QuietHandler
+        )
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.containers = {}
+            self.manifests = {}
+            self.auth_requests = 0
+            self.requests = 0
+            self.failures = {}
+            self.failing_posts = 0
+            self.undeletable = set()
+            self.put_delay = 0
+            self.puts_in_flight = 0
+            self.max_puts_in_flight = 0
+
+    def fail_puts(self, container, n, match=""):
+        with self._lock:
+            self.failures[container] = [n, match]
+
+    def __call__(self, environ, start_response):
+        path = unquote(environ['PATH_INFO'])
+        method = environ['REQUEST_METHOD']
+        query = parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+        with self._lock:
+            self.requests += 1
+        if path == "/auth/v1.0":
+            return self.auth(environ, start_response)
+        if environ.get('HTTP_X_AUTH_TOKEN') != self.token:
+            return self.respond(start_response, "401 Unauthorized")
+        parts = path.lstrip("/").split("/", 3)
+        # v1/AUTH_test/container/object
+        container = parts[2] if len(parts) > 2 else None
+        obj = parts[3] if len(parts) > 3 else None
+        if container is None:
+            if method == "POST" and 'bulk-delete' in query:
+                return self.bulk_delete(environ, start_response)
+            return self.respond(start_response, "204 No Content")
+        if obj is None:
+            handler = getattr(self, "container_" + method.lower())
+            return handler(environ, start_response, container, query)
+        handler = getattr(self, "object_" + method.lower())
+        return handler(environ, start_response, container, obj, query)
+
+    @staticmethod
+    def respond(start_response, status, body=b"", headers=None):
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        start_response(status, list(headers.items()))
+        return [body]
+
+    def auth(self, environ, start_response):
+        if environ.get('HTTP_X_AUTH_USER') != self.user or \
+                environ.get('HTTP_X_AUTH_KEY') != self.key:
+            return self.respond(start_response, "401 Unauthorized")
+        with self._lock:
+            self.auth_requests += 1
+        host = "http://{}".format(environ['HTTP_HOST'])
+        return self.respond(start_response, "200 OK", headers={
+            'X-Storage-Url': "{}/v1/AUTH_test".format(host),
+            'X-Auth-Token': self.token,
+            'X-Storage-Token': self.token
+        })
+
+    def bulk_delete(self, environ, start_response):
+        deleted = not_found = 0
+        errors = []
+        for line in _read_body(environ).decode("utf-8").splitlines():
+            container, obj = unquote(line).lstrip("/").split("/", 1)
+            if obj in self.undeletable:
+                errors.append([line, "503 Service Unavailable"])
+                continue
+            with self._lock:
+                # Like swift, a manifest's segments are left behind
+                self.manifests.pop((container, obj), None)
+                if self.containers.get(container, {}).pop(obj, None) is None:
+                    not_found += 1
+                else:
+                    deleted += 1
+        body = json.dumps({
+            "Number Deleted": deleted, "Number Not Found": not_found,
+            "Response Status": "400 Bad Request" if errors else "200 OK", "Errors": errors
+        }).encode("utf-8")
+        return self.respond(start_response, "200 OK", body,
+                            headers={'Content-Type': 'application/json'})
+
+    def container_head(self, environ, start_response, container, query):
+        if container not in self.containers:
+            return self.respond(start_response, "404 Not Found")
+        return self.respond(start_response, "204 No Content", headers={
+            'X-Container-Object-Count': str(len(self.containers[container]))
+        })
+
+    def container_put(self, environ, start_response, container, query):
+        with self._lock:
+            self.containers.setdefault(container, {})
+        return self.respond(start_response, "201 Created")
+
+    def container_get(self, environ, start_response, container, query):
+        if container not in self.containers:
+            return self.respond(start_response, "404 Not Found")
+        marker = query.get('marker', [''])[0]
+        prefix = query.get('prefix', [''])[0]
+        limit = int(query.get('limit', ['10000'])[0])
+        with self._lock:
+            names = sorted(self.containers[container])
+        listing = []
+        for name in names:
+            if name <= marker or not name.startswith(prefix):
+                continue
+            data, headers, mtime = self.containers[container][name]
+            listing.append({
+                "name": name, "bytes": len(data), "hash": headers['Etag'],
+                "last_modified": http_date(mtime)
+            })
+            if len(listing) >= limit:
+                break
+        body = json.dumps(listing).encode("utf-8")
+        return self.respond(start_response, "200 OK", body,
+                            headers={'Content-Type': 'application/json'})
+
+    def object_put(self, environ, start_response, container, obj, query):
+        if container not in self.containers:
+            return self.respond(start_response, "404 Not Found")
+        data = _read_body(environ)
+        with self._lock:
+            remaining, match = self.failures.get(container, (0, ""))
+            failing = remaining > 0 and match in obj
+            if failing:
+                self.failures[container][0] -= 1
+            self.puts_in_flight += 1
+            self.max_puts_in_flight = max(self.max_puts_in_flight, self.puts_in_flight)
+        try:
+            sleep(self.put_delay)
+        finally:
+            with self._lock:
+                self.puts_in_flight -= 1
+        if failing:
+            return self.respond(start_response, "503 Service Unavailable")
+        if environ.get('HTTP_IF_NONE_MATCH') == "*" and \
+                obj in self.containers[container]:
+            return self.respond(start_response, "412 Precondition Failed")
+        headers = {'Etag': md5(data).hexdigest()}
+        segments = None
+        if 'multipart-manifest' in query and query['multipart-manifest'][0] == "put":
+            segments, data, etag = self.assemble(json.loads(data.decode("utf-8")))
+            if segments is None:
+                return self.respond(start_response, "400 Bad Request")
+            headers = {'Etag': '"{}"'.format(etag), 'X-Static-Large-Object': "True"}
+        for key, value in environ.items():
+            if key.startswith('HTTP_X_OBJECT_META_'):
+                headers[key[5:].replace("_", "-").title()] = value
+        with self._lock:
+            self.containers[container][obj] = (data, headers, time())
+            self.manifests.pop((container, obj), None)
+            if segments is not None:
+                self.manifests[(container, obj)] = segments
+        return self.respond(start_response, "201 Created",
+                            headers={'Etag': headers['Etag']})
+
+    def assemble(self, manifest):
+        # Out: the segments' (container, object)s + the large object's
+        # content + its etag, or Nones if the manifest doesn't match them
+        segments = []
+        chunks = []
+        etags = []
+        with self._lock:
+            for segment in manifest:
+                container, obj = segment['path'].lstrip("/").split("/", 1)
+                if obj not in self.containers.get(container, {}):
+                    return None, None, None
+                data, headers, mtime = self.containers[container][obj]
+                if segment.get('etag') not in (None, headers['Etag']) or \
+                        segment.get('size_bytes') not in (None, len(data)):
+                    return None, None, None
+                segments.append((container, obj))
+                chunks.append(data)
+                etags.append(headers['Etag'])
+        return segments, b"".join(chunks), md5("".join(etags).encode("utf-8")).hexdigest()
+
+    def object_post(self, environ, start_response, container, obj, query):
+        if obj not in self.containers.get(container, {}):
+            return self.respond(start_response, "404 Not Found")
+        with self._lock:
+            if self.failing_posts > 0:
+                self.failing_posts -= 1
+                return self.respond(start_response, "503 Service Unavailable")
+            data, headers, mtime = self.containers[container][obj]
+            # Replaces all existing user metadata, like swift does
+            headers = dict((k, v) for k, v in headers.items() if not k.startswith("X-Object-Meta-"))
+            for key, value in environ.items():
+                if key.startswith('HTTP_X_OBJECT_META_'):
+                    headers[key[5:].replace("_", "-").title()] = value
+            self.containers[container][obj] = (data, headers, mtime)
+        return self.respond(start_response, "202 Accepted")
+
+    def object_headers(self, container, obj):
+        data, headers, mtime = self.containers[container][obj]
+        headers = dict(headers)
+        headers['Last-Modified'] = http_date(mtime)
+        headers['Accept-Ranges'] = "bytes"
+        return data, headers
+
+    def object_get(self, environ, start_response, container, obj, query):
+        if obj not in self.containers.get(container, {}):
+            return self.respond(start_response, "404 Not Found")
+        data, headers = self.object_headers(container, obj)
+        byte_range = parse_range_header(environ.get('HTTP_RANGE'))
+        if byte_range is None:
+            return self.respond(start_response, "200 OK", data, headers)
+        bounds = byte_range.range_for_length(len(data))
+        if bounds is None:
+            headers['Content-Range'] = "bytes */{}".format(len(data))
+            return self.respond(start_response, "416 Requested Range Not Satisfiable",
+                                headers=headers)
+        start, stop = bounds
+        headers['Content-Range'] = "bytes {}-{}/{}".format(start, stop - 1, len(data))
+        return self.respond(start_response, "206 Partial Content", data[start:stop],
+                            headers)
+
+    def object_head(self, environ, start_response, container, obj, query):
+        if obj not in self.containers.get(container, {}):
+            return self.respond(start_response, "404 Not Found")
+        data, headers = self.object_headers(container, obj)
+        headers['Content-Length'] = str(len(data))
+        start_response("200 OK", list(headers.items()))
+        return [b""]
+
+    def object_delete(self, environ, start_response, container, obj, query):
+        if obj in self.undeletable:
+            return self.respond(start_response, "503 Service Unavailable")
+        with self._lock:
+            if self.containers.get(container, {}).pop(obj, None) is None:
+                return self.respond(start_response, "404 Not Found")
+            segments = self.manifests.pop((container, obj), [])
+            if 'multipart-manifest' in query and query['multipart-manifest'][0] == "delete":
+                for segment_container, segment in segments:
+                    self.containers.get(segment_container, {}).pop(segment, None)
+        return self.respond(start_response, "204 No Content")
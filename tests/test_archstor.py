@@ -1,16 +1,53 @@
 import unittest
 import json
-from os import environ
+import hashlib
+import sqlite3
+from base64 import b64encode
+import tarfile
+import zipfile
+from os import _exit, environ, fork, pread, read, waitpid, write, pipe
+import asyncio
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
 from tempfile import TemporaryDirectory
+from time import monotonic, sleep
+from threading import Barrier, Thread
+from pathlib import Path
 
+from flask import Flask
 from pymongo import MongoClient
+from bson.objectid import ObjectId
+from moto import mock_aws
+from swiftclient.exceptions import ClientException
 
 # Defer any configuration to the tests setUp()
 environ['ARCHSTOR_DEFER_CONFIG'] = "True"
 
 import archstor
+from archstor.blueprint.pool import ConnectionPool, PoolExhaustedError, ProcessLocal, SqliteFile
+from archstor.blueprint.cache import CachingStorageBackend
+from archstor.blueprint.replicated import ReplicatedStorageBackend
+from archstor.blueprint.ingest import WriteBehindStorageBackend
+from archstor.blueprint.membership import ChangeLog, CountingBloomFilter, \
+    MembershipFilteredStorageBackend
+from archstor.blueprint.fixity import DigestingReader, audit
+from archstor.blueprint.fsindex import IdentifierIndex
+from archstor.blueprint.migrate import Checkpoint, migrate, storage_from_config, storage_from_env
+from archstor.blueprint.exceptions import ObjectAlreadyExistsError, ServerError
+from archstor.blueprint.parallel import ParallelRangeReader, ReadAheadReader
+from archstor.blueprint.sizing import ChunkSizing
+from archstor.blueprint import metrics
+from archstor.blueprint.aio import AsyncStorageBackend
+from archstor.blueprint.asgi import ASGIApplication
+from prometheus_client import REGISTRY
+from pypairtree.utils import identifier_to_path
+
+from .asgiclient import ASGITestClient
+from .fakeswift import FakeSwift
 
 
 class PackageTests(unittest.TestCase):
@@ -63,6 +100,193 @@ class ArchstorTestCase:
         for x in comp_ids:
             self.assertIn(x, ids)
 
+    def test_rootPrefix(self):
+        prefixed = sorted("prefixed{}".format(uuid4().hex) for x in range(5))
+        for id in prefixed:
+            rv = self.app.put("/{}".format(id), data={"object": (BytesIO(b"x"), "test.txt")})
+            self.response_200_json(rv)
+        self.put_test_object()
+        rv = self.app.get("/", query_string={"prefix": "prefixed", "limit": 3})
+        rj = self.response_200_json(rv)
+        self.assertEqual([x['identifier'] for x in rj['objects']], prefixed[:3])
+        rv = self.app.get("/", query_string={
+            "prefix": "prefixed", "cursor": rj['pagination']['next_cursor']
+        })
+        rj = self.response_200_json(rv)
+        self.assertEqual([x['identifier'] for x in rj['objects']], prefixed[3:])
+
+    def test_rootLimitTooSmall(self):
+        self.put_test_object()
+        for limit in (0, -1):
+            rv = self.app.get("/", query_string={"limit": limit})
+            self.assertEqual(rv.status_code, 400)
+        rv = self.app.get("/_archive", query_string={"limit": 0})
+        self.assertEqual(rv.status_code, 400)
+
+    def inventory(self, **query):
+        rv = self.app.get("/_inventory", query_string=query)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, "application/x-ndjson")
+        return [json.loads(x) for x in rv.data.decode().splitlines()]
+
+    def test_inventory(self):
+        prefixed = sorted("inventoried{}".format(uuid4().hex) for x in range(5))
+        for id in prefixed:
+            self.put_test_object(id=id)
+        other = self.put_test_object()
+        listed = [x['identifier'] for x in self.inventory()]
+        self.assertEqual(listed, sorted(listed))
+        self.assertTrue(set(prefixed + [other]) <= set(listed))
+        self.assertEqual(self.inventory(prefix="inventoried"),
+                         [{"identifier": x} for x in prefixed])
+        rj = self.inventory(prefix="inventoried", start_after=prefixed[1])
+        self.assertEqual([x['identifier'] for x in rj], prefixed[2:])
+        rj = self.inventory(prefix="inventoried", stat="true")
+        self.assertEqual([x['identifier'] for x in rj], prefixed)
+        self.assertEqual(rj[0]['size'], 21)
+        self.assertEqual(rj[0]['digests']['md5'],
+                         hashlib.md5(b"this is a test object").hexdigest())
+        self.assertEqual(self.inventory(prefix="notinventoried"), [])
+
+    def test_iterObjectIds(self):
+        prefixed = sorted("iterated{}".format(uuid4().hex) for x in range(5))
+        for id in prefixed:
+            self.put_test_object(id=id)
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        # Several pages of the backend's listing
+        self.assertEqual(list(storage.iter_object_ids(prefix="iterated", page_size=2)), prefixed)
+        self.assertEqual(
+            list(storage.iter_object_ids(prefix="iterated", start_after=prefixed[2], page_size=2)),
+            prefixed[3:]
+        )
+
+    def test_batchExists(self):
+        ids = [self.put_test_object() for x in range(3)]
+        missing = uuid4().hex
+        rv = self.app.post("/_batch/exists", json={"identifiers": ids + [missing]})
+        rj = self.response_200_json(rv)
+        self.assertEqual(
+            [(x['identifier'], x['exists']) for x in rj['objects']],
+            [(x, True) for x in ids] + [(missing, False)]
+        )
+
+    def test_batchStat(self):
+        id = self.put_test_object()
+        missing = uuid4().hex
+        rv = self.app.post("/_batch/stat", json={"identifiers": [id, missing]})
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['objects'][0]['identifier'], id)
+        self.assertEqual(rj['objects'][0]['size'], 21)
+        self.assertEqual(rj['objects'][1], {"identifier": missing, "exists": False})
+
+    def test_batchDelete(self):
+        ids = [self.put_test_object() for x in range(3)]
+        rv = self.app.post("/_batch/delete", json={"identifiers": ids + [uuid4().hex]})
+        rj = self.response_200_json(rv)
+        self.assertTrue(all(x['deleted'] for x in rj['objects']))
+        for id in ids:
+            self.assertEqual(self.app.get("/{}".format(id)).status_code, 404)
+
+    def test_batchTooBig(self):
+        archstor.blueprint.BLUEPRINT.config['BATCH_MAX'] = 2
+        try:
+            rv = self.app.post("/_batch/exists", json={"identifiers": ["a", "b", "c"]})
+            self.assertEqual(rv.status_code, 400)
+        finally:
+            del archstor.blueprint.BLUEPRINT.config['BATCH_MAX']
+
+    def test_batchUnsafeIdentifier(self):
+        rv = self.app.post("/_batch/delete", json={"identifiers": ["../etc"]})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_archiveTar(self):
+        contents = [b"this is a test object", bytes(range(256)) * 5, b""]
+        ids = [self.put_test_object(x) for x in contents]
+        rv = self.app.post("/_archive", json={"identifiers": ids})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(int(rv.headers['Content-Length']), len(rv.data))
+        with tarfile.open(fileobj=BytesIO(rv.data)) as tf:
+            self.assertEqual(tf.getnames(), ids)
+            for id, content in zip(ids, contents):
+                self.assertEqual(tf.extractfile(id).read(), content)
+
+    def test_archiveZip(self):
+        contents = [b"this is a test object", bytes(range(256)) * 5]
+        ids = [self.put_test_object(x) for x in contents]
+        rv = self.app.post("/_archive", json={"identifiers": ids, "format": "zip"})
+        self.assertEqual(rv.status_code, 200)
+        with zipfile.ZipFile(BytesIO(rv.data)) as zf:
+            self.assertEqual(zf.namelist(), ids)
+            for id, content in zip(ids, contents):
+                self.assertEqual(zf.read(id), content)
+
+    def test_archiveMissingObject(self):
+        ids = [self.put_test_object(), uuid4().hex]
+        rv = self.app.post("/_archive", json={"identifiers": ids})
+        self.assertEqual(rv.status_code, 404)
+
+    def test_archiveListing(self):
+        ids = sorted(
+            "archived{}".format(uuid4().hex) for x in range(3)
+        )
+        for id in ids:
+            rv = self.app.put("/{}".format(id), data={"object": (BytesIO(b"x"), "test.txt")})
+            self.response_200_json(rv)
+        rv = self.app.get("/_archive", query_string={"prefix": "archived", "limit": 2})
+        self.assertEqual(rv.status_code, 200)
+        with tarfile.open(fileobj=BytesIO(rv.data)) as tf:
+            self.assertEqual(tf.getnames(), ids[:2])
+        self.assertIn('X-Next-Cursor', rv.headers)
+
+    def test_putObjectDigests(self):
+        id = uuid4().hex
+        content = b"this is a test object"
+        rv = self.app.put("/{}".format(id), data=content,
+                          content_type="application/octet-stream")
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['digests']['md5'], hashlib.md5(content).hexdigest())
+        self.assertEqual(rj['digests']['sha256'], hashlib.sha256(content).hexdigest())
+        rv = self.app.post("/_batch/stat", json={"identifiers": [id]})
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['objects'][0]['digests']['sha256'],
+                         hashlib.sha256(content).hexdigest())
+
+    def test_putObjectVerifiesDigest(self):
+        id = uuid4().hex
+        content = b"this is a test object"
+        rv = self.app.put(
+            "/{}".format(id), data=content, content_type="application/octet-stream",
+            headers={
+                "Content-MD5": b64encode(hashlib.md5(content).digest()).decode(),
+                "Digest": "SHA-256={}".format(
+                    b64encode(hashlib.sha256(content).digest()).decode()
+                )
+            }
+        )
+        self.response_200_json(rv)
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+
+    def test_putObjectDigestMismatch(self):
+        id = uuid4().hex
+        rv = self.app.put(
+            "/{}".format(id), data=b"this is a test object",
+            content_type="application/octet-stream",
+            headers={"Content-MD5": b64encode(hashlib.md5(b"nope").digest()).decode()}
+        )
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.app.get("/{}".format(id)).status_code, 404)
+        # The failed upload doesn't stand in the way of a good one
+        rv = self.app.put("/{}".format(id), data=b"this is a test object",
+                          content_type="application/octet-stream")
+        self.response_200_json(rv)
+
+    def test_fixityAudit(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        ids = [self.put_test_object() for x in range(3)]
+        results = list(audit(storage, ids, workers=2))
+        self.assertEqual(sorted(x['identifier'] for x in results), sorted(ids))
+        self.assertTrue(all(x['status'] == "ok" for x in results))
+
     def test_putObject(self):
         id = uuid4().hex
         obj = BytesIO(b"this is a test object")
@@ -70,6 +294,36 @@ class ArchstorTestCase:
         rj = self.response_200_json(rv)
         self.assertEqual(rj['added'], True)
 
+    def test_putRawObject(self):
+        id = uuid4().hex
+        rv = self.app.put(
+            "/{}".format(id), data=b"this is a raw object",
+            content_type="application/octet-stream"
+        )
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['added'], True)
+        grv = self.app.get("/{}".format(id))
+        self.assertEqual(grv.data, b"this is a raw object")
+
+    def test_putRawObjectChunked(self):
+        id = uuid4().hex
+        content = bytes(range(256)) * 10000
+        rv = self.app.put(
+            "/{}".format(id), input_stream=BytesIO(content),
+            headers={"Transfer-Encoding": "chunked"},
+            environ_overrides={"wsgi.input_terminated": True},
+            content_type="application/octet-stream"
+        )
+        self.response_200_json(rv)
+        grv = self.app.get("/{}".format(id))
+        self.assertEqual(grv.data, content)
+
+    def test_putRawObjectOverwrite(self):
+        id = self.put_test_object()
+        rv = self.app.put("/{}".format(id), data=b"another object",
+                          content_type="application/octet-stream")
+        self.assertEqual(rv.status_code, 400)
+
     def test_getObject(self):
         # Put the object into the db
         id = uuid4().hex
@@ -81,6 +335,100 @@ class ArchstorTestCase:
         grv = self.app.get("/{}".format(id))
         self.assertEqual(grv.data, b"this is a test object")
 
+    def put_test_object(self, content=b"this is a test object", id=None):
+        if id is None:
+            id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data={"object": (BytesIO(content), "test.txt")})
+        self.response_200_json(rv)
+        return id
+
+    def test_getObjectRange(self):
+        id = self.put_test_object()
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=5-8"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, b"is a")
+        self.assertEqual(rv.headers['Content-Range'], "bytes 5-8/21")
+        self.assertEqual(rv.headers['Content-Length'], "4")
+
+    def test_getObjectOpenEndedRange(self):
+        id = self.put_test_object()
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=10-"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, b"test object")
+        self.assertEqual(rv.headers['Content-Range'], "bytes 10-20/21")
+
+    def test_getObjectSuffixRange(self):
+        id = self.put_test_object()
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=-6"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, b"object")
+        self.assertEqual(rv.headers['Content-Range'], "bytes 15-20/21")
+
+    def test_getObjectUnsatisfiableRange(self):
+        id = self.put_test_object()
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=100-200"})
+        self.assertEqual(rv.status_code, 416)
+        self.assertEqual(rv.headers['Content-Range'], "bytes */21")
+
+    def test_getObjectMultipleRanges(self):
+        id = self.put_test_object()
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=0-3,15-20"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertTrue(rv.mimetype == "multipart/byteranges")
+        self.assertIn(b"Content-Range: bytes 0-3/21\r\n\r\nthis\r\n", rv.data)
+        self.assertIn(b"Content-Range: bytes 15-20/21\r\n\r\nobject\r\n", rv.data)
+
+    def test_getNonexistantObjectRange(self):
+        rv = self.app.get("/{}".format(uuid4().hex), headers={"Range": "bytes=0-3"})
+        self.assertEqual(rv.status_code, 404)
+
+    def test_headObject(self):
+        id = self.put_test_object()
+        rv = self.app.head("/{}".format(id))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Length'], "21")
+        self.assertIn('ETag', rv.headers)
+        self.assertIn('Last-Modified', rv.headers)
+        self.assertEqual(rv.data, b"")
+
+    def test_headNonexistantObject(self):
+        rv = self.app.head("/{}".format(uuid4().hex))
+        self.assertEqual(rv.status_code, 404)
+
+    def test_getObjectHeaders(self):
+        id = self.put_test_object()
+        rv = self.app.get("/{}".format(id))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Length'], "21")
+        self.assertEqual(rv.headers['ETag'], self.app.head("/{}".format(id)).headers['ETag'])
+
+    def test_getObjectIfNoneMatch(self):
+        id = self.put_test_object()
+        etag = self.app.head("/{}".format(id)).headers['ETag']
+        rv = self.app.get("/{}".format(id), headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b"")
+        rv = self.app.get("/{}".format(id), headers={"If-None-Match": '"nope"'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, b"this is a test object")
+
+    def test_getObjectIfModifiedSince(self):
+        id = self.put_test_object()
+        last_modified = self.app.head("/{}".format(id)).headers['Last-Modified']
+        rv = self.app.get("/{}".format(id), headers={"If-Modified-Since": last_modified})
+        self.assertEqual(rv.status_code, 304)
+        rv = self.app.get(
+            "/{}".format(id),
+            headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}
+        )
+        self.assertEqual(rv.status_code, 200)
+
+    def test_getBinaryObject(self):
+        content = bytes(range(256)) * 10
+        id = self.put_test_object(content)
+        rv = self.app.get("/{}".format(id))
+        self.assertEqual(rv.data, content)
+
     def test_getNonexistantObject(self):
         rv = self.app.get("/{}".format(uuid4().hex))
         self.assertEqual(rv.status_code, 404)
@@ -126,6 +474,32 @@ class ArchstorTestCase:
         rv2 = self.app.put("/{}".format(id), data={"object": (obj2, "test.txt")})
         self.assertEqual(rv2.status_code, 400)
 
+    def test_concurrentCreate(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = uuid4().hex
+
+        def put(x):
+            try:
+                storage.set_object(id, BytesIO("object {}".format(x).encode("utf-8")))
+                return x
+            except ObjectAlreadyExistsError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            winners = [x for x in executor.map(put, range(8)) if x is not None]
+        self.assertEqual(len(winners), 1)
+        rv = self.app.get("/{}".format(id))
+        self.assertEqual(rv.data, "object {}".format(winners[0]).encode("utf-8"))
+
+    def test_emptyObjectOverwrite(self):
+        id = self.put_test_object(b"")
+        rv = self.app.put("/{}".format(id), data=b"another object",
+                          content_type="application/octet-stream")
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get("/{}".format(id))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, b"")
+
     def test_Version(self):
         rv = self.app.get("/version")
         rj = self.response_200_json(rv)
@@ -149,6 +523,78 @@ class MongoStorageTestCases(ArchstorTestCase, unittest.TestCase):
         )
         c.drop_database("testing")
 
+    def test_rootLegacyCursor(self):
+        ids = []
+        for x in range(25):
+            id = uuid4().hex
+            obj = BytesIO(bytes("this is a test object ({})".format(str(x)), encoding="utf-8"))
+            rv = self.app.put("/{}".format(id), data={"object": (obj, "test.txt")})
+            self.response_200_json(rv)
+            ids.append(id)
+        ids.sort()
+        # Numeric cursors are still interpreted as offsets
+        rv = self.app.get("/", query_string={"cursor": "10", "limit": 5})
+        rj = self.response_200_json(rv)
+        self.assertEqual([x['identifier'] for x in rj['objects']], ids[10:15])
+        # ...but continue as opaque keyset cursors
+        next_cursor = rj['pagination']['next_cursor']
+        self.assertFalse(next_cursor.isdigit())
+        rv = self.app.get("/", query_string={"cursor": next_cursor, "limit": 5})
+        rj = self.response_200_json(rv)
+        self.assertEqual([x['identifier'] for x in rj['objects']], ids[15:20])
+
+    def test_rootMalformedCursor(self):
+        rv = self.app.get("/", query_string={"cursor": "notacursor"})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_getObjectReadAhead(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        storage.read_ahead = 3
+        content = bytes(range(256)) * 100
+        id = self.put_test_object(content)
+        archstor.blueprint.BLUEPRINT.config['BUFF'], buff = \
+            1024, archstor.blueprint.BLUEPRINT.config['BUFF']
+        try:
+            rv = self.app.get("/{}".format(id))
+            self.assertEqual(rv.data, content)
+            rv = self.app.get("/{}".format(id), headers={"Range": "bytes=100-5099"})
+            self.assertEqual(rv.data, content[100:5100])
+        finally:
+            archstor.blueprint.BLUEPRINT.config['BUFF'] = buff
+
+    def orphan_chunk(self, id, **fields):
+        # As if an upload died after claiming id, before writing its files
+        # document
+        chunk = {"files_id": id, "n": 0, "data": b"half written"}
+        chunk.update(fields)
+        MongoClient('localhost', 27017)["testing"].fs.chunks.insert_one(chunk)
+
+    def test_putReclaimsOrphanedChunks(self):
+        id = uuid4().hex
+        self.orphan_chunk(id)
+        self.assertEqual(self.app.get("/{}".format(id)).status_code, 404)
+        content = b"this is a test object"
+        self.put_test_object(content, id=id)
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+
+    def test_putReclaimsStaleClaim(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = uuid4().hex
+        self.orphan_chunk(id, upload=ObjectId(), claimedAt=datetime.now(timezone.utc) -
+                          timedelta(seconds=storage.CLAIM_TIMEOUT + 60))
+        storage.set_object(id, BytesIO(b"this is a test object"))
+        self.assertEqual(storage.get_object(id).read(), b"this is a test object")
+
+    def test_putLeavesLiveClaim(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = uuid4().hex
+        # An upload still in progress
+        self.orphan_chunk(id, upload=ObjectId(), claimedAt=datetime.now(timezone.utc))
+        with self.assertRaises(ObjectAlreadyExistsError):
+            storage.set_object(id, BytesIO(b"this is a test object"))
+        chunks = MongoClient('localhost', 27017)["testing"].fs.chunks
+        self.assertEqual(chunks.find_one({"files_id": id})['data'], b"half written")
+
 
 class FileSystemStrorageTestCase(ArchstorTestCase, unittest.TestCase):
     def setUp(self):
@@ -164,35 +610,1861 @@ class FileSystemStrorageTestCase(ArchstorTestCase, unittest.TestCase):
     def tearDown(self):
         del self.tmpdir
 
-    def test_getRoot(self):
+    def test_getRootWithoutIndex(self):
+        archstor.blueprint.BLUEPRINT.config['storage'] = \
+            archstor.blueprint.FileSystemStorageBackend(
+                self.tmpdir.name, use_index=False
+        )
         rv = self.app.get("/")
         self.assertEqual(rv.status_code, 501)
+        self.assertEqual(self.app.get("/_inventory").status_code, 501)
 
-    def test_rootPagination(self):
-        pass
-
-
-# class SwiftStorageTestCase(ArchstorTestCase, unittest.TestCase):
-#    def setUp(self):
-#        archstor.app.config['TESTING'] = True
-#        self.app = archstor.app.test_client()
-#        archstor.blueprint.BLUEPRINT.config['storage'] = \
-#            archstor.blueprint.SwiftStorageBackend(
-#                "http://127.0.0.1:12345/auth/v1.0",
-#                '1',
-#                "test:tester",
-#                "RANDOMLYGENERATEDPASSWORDHERE",
-#                'test',
-#                container_name='testing'
-#            )
-#
-#    def tearDown(self):
-#        cursor = True
-#        while cursor:
-#            cursor, objs = archstor.blueprint.BLUEPRINT.config['storage']\
-#                .get_object_id_list("0", None)
-#            for x in objs:
-#                archstor.blueprint.BLUEPRINT.config['storage'].del_object(x)
+    def test_indexJournalMode(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        self.put_test_object()
+        self.assertEqual(storage.index.conn.execute("PRAGMA journal_mode").fetchone()[0],
+                         "delete")
+        # Indexes made in write ahead log mode are taken out of it
+        path = Path(self.tmpdir.name, "wal.sqlite3")
+        conn = sqlite3.connect(str(path))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+        index = IdentifierIndex(path)
+        self.assertEqual(index.conn.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+
+    def test_rebuildCommandTakesLock(self):
+        ids = sorted(self.put_test_object() for x in range(3))
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        with storage.index.locked():
+            rebuild = subprocess.Popen(
+                [sys.executable, "-m", "archstor.blueprint.fsindex", self.tmpdir.name],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            sleep(1)
+            # Waiting on the server's build
+            self.assertIsNone(rebuild.poll())
+        self.assertEqual(rebuild.wait(timeout=30), 0)
+        self.assertEqual(storage.index.list(), ids)
+
+    def test_indexRebuild(self):
+        ids = sorted(self.put_test_object() for x in range(20))
+        self.app.delete("/{}".format(ids.pop()))
+        # A fresh index has to be bootstrapped from the pairtree itself
+        archstor.blueprint.BLUEPRINT.config['storage'] = \
+            archstor.blueprint.FileSystemStorageBackend(
+                self.tmpdir.name,
+                index_path=Path(self.tmpdir.name, "other_index.sqlite3")
+        )
+        rv = self.app.get("/")
+        rj = self.response_200_json(rv)
+        self.assertEqual([x['identifier'] for x in rj['objects']], ids)
+
+    def test_fixityAuditMismatch(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = self.put_test_object()
+        content_path = Path(
+            self.tmpdir.name, identifier_to_path(id), "arf", "content.file"
+        )
+        with open(str(content_path), "wb") as f:
+            f.write(b"this is a rotten object")
+        results = list(audit(storage, [id]))
+        self.assertEqual(results[0]['status'], "mismatch")
+
+    def test_getObjectFileWrapper(self):
+        content = bytes(range(256)) * 10
+        id = self.put_test_object(content)
+        wrapped = []
+
+        def file_wrapper(f, buffer_size):
+            wrapped.append(f)
+            return iter(lambda: f.read(buffer_size), b"")
+
+        rv = self.app.get(
+            "/{}".format(id), environ_overrides={"wsgi.file_wrapper": file_wrapper}
+        )
+        self.assertEqual(rv.data, content)
+        self.assertEqual(rv.headers['Content-Length'], str(len(content)))
+        self.assertEqual(len(wrapped), 1)
+
+    def test_adaptiveChunkSizes(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        storage.read_chunks = ChunkSizing(adaptive=True, minimum=1024, maximum=64 * 1024)
+        storage.upload_chunks = ChunkSizing(adaptive=True, minimum=1024, maximum=64 * 1024)
+        content = bytes(range(256)) * 400
+        reads = []
+
+        class Upload(BytesIO):
+            content_length = len(content)
+
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+
+        storage.set_object("adaptive", Upload(content))
+        # ~16 chunks, rounded up to a power of two
+        self.assertEqual(set(reads), {8192})
+        buffer_sizes = []
+
+        def file_wrapper(f, buffer_size):
+            buffer_sizes.append(buffer_size)
+            return iter(lambda: f.read(buffer_size), b"")
+
+        rv = self.app.get(
+            "/adaptive", environ_overrides={"wsgi.file_wrapper": file_wrapper}
+        )
+        self.assertEqual(rv.data, content)
+        self.assertEqual(buffer_sizes, [8192])
+
+
+class SwiftStorageTestCase(ArchstorTestCase, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.swift = FakeSwift().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.swift.stop()
+
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.app = archstor.app.test_client()
+        self.swift.reset()
+        archstor.blueprint.BLUEPRINT.config['storage'] = \
+            archstor.blueprint.SwiftStorageBackend(
+                self.swift.auth_url,
+                '1',
+                self.swift.user,
+                self.swift.key,
+                'test',
+                container_name='testing',
+                pool_size=4
+        )
+
+    def test_connectionReuse(self):
+        for x in range(10):
+            id = self.put_test_object()
+            self.app.get("/{}".format(id))
+            self.app.head("/{}".format(id))
+            self.app.delete("/{}".format(id))
+        # One authentication, shared by every pooled connection
+        self.assertEqual(self.swift.auth_requests, 1)
+
+    def test_batchDeleteIsBulk(self):
+        ids = [self.put_test_object() for x in range(5)]
+        requests = self.swift.requests
+        self.app.post("/_batch/delete", json={"identifiers": ids})
+        # A check for large objects (deleted one at a time), and the bulk delete
+        self.assertEqual(self.swift.requests, requests + 2)
+        self.assertEqual(self.swift.containers['testing'], {})
+
+    def test_connectsLazily(self):
+        storage = archstor.blueprint.SwiftStorageBackend(
+            self.swift.auth_url, '1', self.swift.user, self.swift.key, 'test',
+            container_name='lazy'
+        )
+        self.assertEqual((self.swift.auth_requests, self.swift.requests), (0, 0))
+        self.assertNotIn('lazy', self.swift.containers)
+        self.assertFalse(storage.check_object_exists(uuid4().hex))
+        # The container is made by the first connection
+        self.assertEqual(self.swift.containers['lazy'], {})
+        self.assertEqual(self.swift.auth_requests, 1)
+
+    def test_putSkipsExistenceCheck(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        # Connected, so only the upload's own requests are counted
+        storage.check_object_exists(uuid4().hex)
+        requests = self.swift.requests
+        storage.set_object(uuid4().hex, BytesIO(b"this is a test object"))
+        # Of unknown length, so it's staged, after which the digests can go
+        # along with the PUT
+        self.assertEqual(self.swift.requests, requests + 1)
+        content = BytesIO(b"this is a test object")
+        content.content_length = 21
+        requests = self.swift.requests
+        storage.set_object(uuid4().hex, content)
+        # Streamed, so the PUT itself, and the POST attaching its digests
+        self.assertEqual(self.swift.requests, requests + 2)
+
+    def test_putStreamingDeclaredDigests(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        storage.check_object_exists(uuid4().hex)
+        content = b"this is a test object"
+        src = BytesIO(content)
+        src.content_length = len(content)
+        reader = DigestingReader(src, expected={
+            "md5": hashlib.md5(content).hexdigest(),
+            "sha256": hashlib.sha256(content).hexdigest()
+        })
+        id = uuid4().hex
+        requests = self.swift.requests
+        storage.set_object(id, reader)
+        # Known before the upload, so sent with it, no POST
+        self.assertEqual(self.swift.requests, requests + 1)
+        self.assertEqual(storage.stat_object(id)['digests']['sha256'],
+                         hashlib.sha256(content).hexdigest())
+
+    def test_putStreamingDigestPostFails(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        content = BytesIO(b"this is a test object")
+        content.content_length = 21
+        id = uuid4().hex
+        self.swift.failing_posts = 10
+        with self.assertLogs("archstor.blueprint.swift", "WARNING"):
+            digests = storage.set_object(id, content)
+        # Stored all the same, just without its digests
+        self.assertEqual(digests['md5'], hashlib.md5(b"this is a test object").hexdigest())
+        self.assertEqual(storage.get_object(id).read(), b"this is a test object")
+        self.assertEqual(storage.stat_object(id)['digests'], {})
+
+    def segmented_storage(self, **kwargs):
+        storage = archstor.blueprint.SwiftStorageBackend(
+            self.swift.auth_url, '1', self.swift.user, self.swift.key, 'test',
+            container_name='testing', segment_size=1024, retries=0, **kwargs
+        )
+        storage.RETRY_BACKOFF = 0
+        archstor.blueprint.BLUEPRINT.config['storage'] = storage
+        return storage
+
+    def large_content(self):
+        # Five segments, the last one short
+        return bytes(range(256)) * 18
+
+    def test_segmentedUpload(self):
+        self.segmented_storage()
+        content = self.large_content()
+        id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data=content,
+                          content_type="application/octet-stream")
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['digests']['sha256'], hashlib.sha256(content).hexdigest())
+        segments = self.swift.containers['testing_segments']
+        self.assertEqual(len(segments), 5)
+        self.assertTrue(all(x.startswith(id + "/") for x in segments))
+        self.assertEqual(self.swift.manifests[('testing', id)],
+                         [('testing_segments', x) for x in sorted(segments)])
+        rv = self.app.get("/{}".format(id))
+        self.assertEqual(rv.data, content)
+        rv = self.app.head("/{}".format(id))
+        self.assertEqual(rv.headers['Content-Length'], str(len(content)))
+
+    def test_segmentedUploadUnknownLength(self):
+        storage = self.segmented_storage()
+        content = self.large_content()
+        id = uuid4().hex
+        storage.set_object(id, BytesIO(content))
+        self.assertEqual(len(self.swift.containers['testing_segments']), 5)
+        self.assertEqual(storage.get_object(id).read(), content)
+        self.assertEqual(storage.stat_object(id)['digests']['md5'],
+                         hashlib.md5(content).hexdigest())
+
+    def test_segmentedUploadIsConcurrent(self):
+        self.segmented_storage(workers=4)
+        self.swift.put_delay = 0.1
+        self.put_test_object(self.large_content())
+        self.assertGreater(self.swift.max_puts_in_flight, 1)
+
+    def test_segmentedUploadRetriesSegments(self):
+        self.segmented_storage(segment_retries=2)
+        self.swift.fail_puts('testing_segments', 2)
+        content = self.large_content()
+        id = self.put_test_object(content)
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+        self.assertEqual(len(self.swift.containers['testing_segments']), 5)
+
+    def test_segmentedUploadCleansUp(self):
+        storage = self.segmented_storage(segment_retries=1)
+        # The third segment fails for good, after the others are uploaded
+        self.swift.fail_puts('testing_segments', 2, match="/00000003")
+        self.swift.put_delay = 0.05
+        id = uuid4().hex
+        with self.assertRaises(ClientException):
+            storage.set_object(id, BytesIO(self.large_content()))
+        self.assertGreater(self.swift.requests, 5)
+        self.assertFalse(storage.check_object_exists(id))
+        self.assertEqual(self.swift.containers['testing_segments'], {})
+
+    def test_segmentedUploadExisting(self):
+        self.segmented_storage()
+        id = self.put_test_object()
+        rv = self.app.put("/{}".format(id), data=self.large_content(),
+                          content_type="application/octet-stream")
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.swift.containers['testing_segments'], {})
+        self.assertEqual(self.app.get("/{}".format(id)).data, b"this is a test object")
+
+    def test_segmentedDelete(self):
+        self.segmented_storage()
+        id = self.put_test_object(self.large_content())
+        self.response_200_json(self.app.delete("/{}".format(id)))
+        self.assertEqual(self.swift.containers['testing_segments'], {})
+        ids = [self.put_test_object(self.large_content()) for x in range(2)]
+        keep = self.put_test_object(self.large_content())
+        self.app.post("/_batch/delete", json={"identifiers": ids})
+        segments = self.swift.containers['testing_segments']
+        self.assertEqual(len(segments), 5)
+        self.assertTrue(all(x.startswith(keep + "/") for x in segments))
+        self.assertEqual(self.app.get("/{}".format(keep)).data, self.large_content())
+
+    def test_batchDeleteFailures(self):
+        storage = self.segmented_storage()
+        small = [self.put_test_object() for x in range(2)]
+        large = [self.put_test_object(self.large_content()) for x in range(2)]
+        # An upload of another copy of the first large object, still in
+        # progress
+        in_progress = "{}/{}/00000000".format(large[0], uuid4().hex)
+        self.swift.containers['testing_segments'][in_progress] = (b"x", {'Etag': "x"}, 0)
+        self.swift.undeletable = {small[1], large[1]}
+        results = storage.del_objects(small + large)
+        self.assertEqual(results, {small[0]: True, small[1]: False,
+                                   large[0]: True, large[1]: False})
+        self.assertFalse(storage.check_object_exists(small[0]))
+        self.assertFalse(storage.check_object_exists(large[0]))
+        # What failed to delete is intact, segments and all
+        self.assertEqual(storage.get_object(small[1]).read(), b"this is a test object")
+        self.assertEqual(storage.get_object(large[1]).read(), self.large_content())
+        self.assertIn(in_progress, self.swift.containers['testing_segments'])
+        self.assertEqual(len(self.swift.containers['testing_segments']), 6)
+
+    def test_streamReleasesConnection(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = self.put_test_object()
+        idle = len(storage.pool._idle)
+        body = storage.get_object(id)
+        self.assertEqual(len(storage.pool._idle), idle - 1)
+        self.assertEqual(body.read(), b"this is a test object")
+        body.read()
+        self.assertEqual(len(storage.pool._idle), idle)
+
+
+class S3StorageTestCase(ArchstorTestCase, unittest.TestCase):
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.app = archstor.app.test_client()
+        self.aws = mock_aws()
+        self.aws.start()
+        # The smallest part size S3 allows
+        archstor.blueprint.BLUEPRINT.config['storage'] = \
+            archstor.blueprint.S3StorageBackend(
+                'testing', region_name='us-east-1', part_size=5 * 1024 * 1024
+        )
+
+    def tearDown(self):
+        self.aws.stop()
+
+    def large_content(self):
+        # Three parts, the last one short
+        return bytes(range(256)) * (11 * 1024 * 4)
+
+    def test_multipartUpload(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        content = self.large_content()
+        parts = []
+        upload_part = storage.s3.upload_part
+
+        def counting_upload_part(**kwargs):
+            parts.append(kwargs['PartNumber'])
+            return upload_part(**kwargs)
+
+        storage.s3.upload_part = counting_upload_part
+        # The object isn't copied to attach its digests
+        storage.s3.copy_object = storage.s3.upload_part_copy = None
+        id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data=content,
+                          content_type="application/octet-stream")
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['digests']['sha256'], hashlib.sha256(content).hexdigest())
+        self.assertEqual(sorted(parts), [1, 2, 3])
+        self.assertEqual(storage.get_object_digests(id), rj['digests'])
+        self.assertEqual(
+            storage.s3.list_multipart_uploads(Bucket='testing').get('Uploads', []), []
+        )
+
+    def test_multipartUploadDeclaredDigests(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        content = self.large_content()
+        storage.s3.put_object_tagging = None
+        id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data=content,
+                          content_type="application/octet-stream",
+                          headers={"Digest": "md5={},sha-256={}".format(
+                              b64encode(hashlib.md5(content).digest()).decode(),
+                              b64encode(hashlib.sha256(content).digest()).decode()
+                          )})
+        self.response_200_json(rv)
+        # Known before the upload, so sent with it
+        head = storage.s3.head_object(Bucket='testing', Key=id)
+        self.assertEqual(head['Metadata']['digest-md5'], hashlib.md5(content).hexdigest())
+        self.assertEqual(storage.stat_object(id)['digests']['sha256'],
+                         hashlib.sha256(content).hexdigest())
+
+    def test_tagsOfAnotherUploadIgnored(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = self.put_test_object(self.large_content())
+        self.assertTrue(storage.get_object_digests(id))
+        # As if the object had been replaced since it was tagged
+        tags = storage.s3.get_object_tagging(Bucket='testing', Key=id)['TagSet']
+        for tag in tags:
+            if tag['Key'] == "etag":
+                tag['Value'] = "0" * 32
+        storage.s3.put_object_tagging(Bucket='testing', Key=id, Tagging={"TagSet": tags})
+        self.assertEqual(storage.get_object_digests(id), {})
+
+    def test_readsDontFetchTags(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        content = self.large_content()
+        id = self.put_test_object(content)
+        get_object_tagging = storage.s3.get_object_tagging
+        storage.s3.get_object_tagging = None
+        rv = self.app.head("/{}".format(id))
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+        self.assertEqual(storage.stat_object(id)['digests'], {})
+        # Those asking for digests still get them, with the same ETag
+        storage.s3.get_object_tagging = get_object_tagging
+        rv = self.app.post("/_batch/stat", json={"identifiers": [id]})
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['objects'][0]['digests']['sha256'],
+                         hashlib.sha256(content).hexdigest())
+        self.assertEqual('"{}"'.format(rj['objects'][0]['digest']), etag)
+        result, = audit(storage, [id])
+        self.assertEqual(result['status'], "ok")
+
+    def test_multipartUploadAborted(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        content = self.large_content()
+        id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data=content,
+                          content_type="application/octet-stream",
+                          headers={"Digest": "md5=" + b64encode(b"0" * 16).decode()})
+        self.assertEqual(rv.status_code, 400)
+        self.assertFalse(storage.check_object_exists(id))
+        self.assertEqual(
+            storage.s3.list_multipart_uploads(Bucket='testing').get('Uploads', []), []
+        )
+
+    def test_parallelDownload(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        content = self.large_content()
+        id = self.put_test_object(content)
+        e = storage.get_object(id)
+        self.assertIsInstance(e, ParallelRangeReader)
+        self.assertEqual(e.read(), content)
+        e.close()
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=100-7000000"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, content[100:7000001])
+
+    def test_listingContinuation(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        ids = sorted("{:05}".format(x) for x in range(1100))
+        for id in ids:
+            storage.s3.put_object(Bucket='testing', Key=id, Body=b"")
+        # More than one page of S3's listing
+        self.assertEqual(storage.get_object_id_list(None, None), (None, ids))
+        cursor, page = storage.get_object_id_list("1050", 1000)
+        self.assertEqual((cursor, page), (None, ids[1050:]))
+        cursor, page = storage.get_object_id_list(None, 1050)
+        self.assertEqual(page, ids[:1050])
+        self.assertEqual(storage.get_object_id_list(cursor, 1000), (None, ids[1050:]))
+
+
+class CachingStorageTestCase(ArchstorTestCase, unittest.TestCase):
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.tmpdir = TemporaryDirectory()
+        self.app = archstor.app.test_client()
+        self.backend = archstor.blueprint.FileSystemStorageBackend(
+            str(Path(self.tmpdir.name, "lts"))
+        )
+        archstor.blueprint.BLUEPRINT.config['storage'] = CachingStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "cache")), 4096,
+            memory_max_bytes=1024, memory_max_object_size=64
+        )
+
+    def tearDown(self):
+        del self.tmpdir
+
+    def test_cacheHit(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        content = bytes(range(256)) * 4
+        id = self.put_test_object(content)
+        self.assertIsNotNone(storage.disk.size(storage._key(id)))
+        # Warm the stat cache too, then remove it from underneath the cache
+        self.app.head("/{}".format(id))
+        self.backend.del_object(id)
+        rv = self.app.get("/{}".format(id))
+        self.assertEqual(rv.data, content)
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=0-9"})
+        self.assertEqual(rv.data, content[:10])
+
+    def test_readThrough(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = self.put_test_object()
+        storage.invalidate(id)
+        self.assertEqual(self.app.get("/{}".format(id)).data, b"this is a test object")
+        self.assertIsNotNone(storage.memory.get(storage._key(id)))
+        self.app.head("/{}".format(id))
+        self.backend.del_object(id)
+        self.assertEqual(self.app.get("/{}".format(id)).data, b"this is a test object")
+
+    def test_eviction(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        ids = [self.put_test_object(bytes(1000)) for x in range(8)]
+        self.assertLessEqual(storage.disk.total, 4096)
+        self.assertIsNone(storage.disk.size(storage._key(ids[0])))
+        self.assertIsNotNone(storage.disk.size(storage._key(ids[-1])))
+        self.assertEqual(len(self.cached_files()), 4)
+        # Evicted objects are still there, just not cached
+        self.assertEqual(self.app.get("/{}".format(ids[0])).data, bytes(1000))
+
+    def test_deleteInvalidates(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = self.put_test_object()
+        self.app.delete("/{}".format(id))
+        self.assertIsNone(storage.memory.get(storage._key(id)))
+        self.assertIsNone(storage.disk.size(storage._key(id)))
+
+    def test_abandonedStreamNotCached(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = self.put_test_object(bytes(2000))
+        storage.invalidate(id)
+        e = storage.get_object(id)
+        e.read(10)
+        e.close()
+        self.assertIsNone(storage.disk.size(storage._key(id)))
+        self.assertEqual(len(self.cached_files()), 0)
+
+    def cached_files(self):
+        # Leaving out the cache's own database
+        return [x for x in Path(self.tmpdir.name, "cache").iterdir()
+                if not x.name.startswith(".")]
+
+    def test_budgetShared(self):
+        # As if another process were using the same cache directory
+        other = CachingStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "cache")), 4096,
+            memory_max_bytes=1024, memory_max_object_size=64
+        )
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        ids = [self.put_test_object(bytes(1000)) for x in range(3)]
+        other.set_object("other", BytesIO(bytes(1000)))
+        other.set_object("another", BytesIO(bytes(1000)))
+        self.assertLessEqual(storage.disk.total, 4096)
+        self.assertEqual(len(self.cached_files()), 4)
+        # Ours was the least recently used
+        self.assertIsNone(other.disk.size(other._key(ids[0])))
+        self.assertIsNotNone(storage.disk.size(storage._key("another")))
+
+    def test_budgetReconciled(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        ids = [self.put_test_object(bytes(1000)) for x in range(2)]
+        # Removed behind the database's back
+        storage.disk.entry_path(storage._key(ids[0])).unlink()
+        Path(storage.cache_dir, "0" * 64).write_bytes(bytes(500))
+        restarted = CachingStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "cache")), 4096
+        )
+        self.assertEqual(restarted.disk.total, 1500)
+        self.assertIsNone(restarted.disk.size(restarted._key(ids[0])))
+
+    def test_deleteDuringReadNotCached(self):
+        storage = archstor.blueprint.BLUEPRINT.config['storage']
+        id = self.put_test_object(bytes(2000))
+        storage.invalidate(id)
+        e = storage.get_object(id)
+        e.read(10)
+        # Deleted by another request while this one's still reading
+        self.app.delete("/{}".format(id))
+        self.assertEqual(len(e.read()), 1990)
+        e.read()
+        e.close()
+        self.assertIsNone(storage.disk.size(storage._key(id)))
+        self.assertEqual(len(self.cached_files()), 0)
+        self.assertEqual(self.app.get("/{}".format(id)).status_code, 404)
+
+
+class FlakyFileSystemStorageBackend(archstor.blueprint.FileSystemStorageBackend):
+    # Reads which take delay seconds to start, writes which take
+    # write_delay, and writes which fail part way through if fail_writes is
+    # set
+    delay = 0
+    write_delay = 0
+    fail_writes = False
+
+    def get_object(self, id):
+        sleep(self.delay)
+        return super().get_object(id)
+
+    def set_object(self, id, content):
+        if self.fail_writes:
+            content.read(10)
+            raise ServerError("Write failed")
+        sleep(self.write_delay)
+        return super().set_object(id, content)
+
+
+class ReplicatedStorageTestCase(ArchstorTestCase, unittest.TestCase):
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.tmpdir = TemporaryDirectory()
+        self.app = archstor.app.test_client()
+        self.primary = archstor.blueprint.FileSystemStorageBackend(
+            str(Path(self.tmpdir.name, "primary"))
+        )
+        self.secondary = FlakyFileSystemStorageBackend(str(Path(self.tmpdir.name, "secondary")))
+        self.replicated(write_quorum=None)
+
+    def tearDown(self):
+        del self.tmpdir
+
+    def replicated(self, **kwargs):
+        kwargs.setdefault('buffer_chunks', 2)
+        storage = ReplicatedStorageBackend([self.primary, self.secondary], **kwargs)
+        archstor.blueprint.BLUEPRINT.config['storage'] = storage
+        return storage
+
+    def test_writesEveryReplica(self):
+        content = bytes(range(256)) * 40
+        buff = archstor.blueprint.BLUEPRINT.config['BUFF']
+        # Many more chunks than are buffered
+        archstor.blueprint.BLUEPRINT.config['BUFF'] = 256
+        try:
+            id = self.put_test_object(content)
+        finally:
+            archstor.blueprint.BLUEPRINT.config['BUFF'] = buff
+        for backend in (self.primary, self.secondary):
+            self.assertEqual(backend.get_object(id).read(), content)
+            self.assertEqual(backend.stat_object(id)['digests']['sha256'],
+                             hashlib.sha256(content).hexdigest())
+
+    def test_writeBelowQuorum(self):
+        self.secondary.fail_writes = True
+        id = uuid4().hex
+        with self.assertRaises(ServerError):
+            archstor.blueprint.BLUEPRINT.config['storage'].set_object(
+                id, BytesIO(bytes(range(256)) * 40)
+            )
+        # Backed out of the replica that did write it
+        self.assertFalse(self.primary.check_object_exists(id))
+
+    def test_writeMeetsQuorum(self):
+        self.replicated(write_quorum=1)
+        self.secondary.fail_writes = True
+        content = bytes(range(256)) * 40
+        id = self.put_test_object(content)
+        self.assertTrue(self.primary.check_object_exists(id))
+        self.assertFalse(self.secondary.check_object_exists(id))
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+
+    def test_existingOnOneReplicaRefusedBelowQuorum(self):
+        storage = self.replicated(write_quorum=1)
+        id = uuid4().hex
+        self.primary.set_object(id, BytesIO(b"old content"))
+        with self.assertRaises(ObjectAlreadyExistsError):
+            storage.set_object(id, BytesIO(b"NEW content"))
+        # Left as it was, and nothing written to the other replica
+        self.assertEqual(self.primary.get_object(id).read(), b"old content")
+        self.assertFalse(self.secondary.check_object_exists(id))
+        rv = self.app.put("/{}".format(id), data=b"NEW content",
+                          content_type="application/octet-stream")
+        self.assertEqual(rv.status_code, 400)
+        self.assertFalse(self.secondary.check_object_exists(id))
+
+    def test_digestMismatchWritesNothing(self):
+        id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data=b"this is a test object",
+                          content_type="application/octet-stream",
+                          headers={"Digest": "md5=" + b64encode(b"0" * 16).decode()})
+        self.assertEqual(rv.status_code, 400)
+        self.assertFalse(self.primary.check_object_exists(id))
+        self.assertFalse(self.secondary.check_object_exists(id))
+
+    def test_readFallsBackToReplica(self):
+        id = self.put_test_object()
+        self.primary.del_object(id)
+        self.assertEqual(self.app.get("/{}".format(id)).data, b"this is a test object")
+        self.assertEqual(self.app.head("/{}".format(id)).status_code, 200)
+        self.secondary.del_object(id)
+        self.assertEqual(self.app.get("/{}".format(id)).status_code, 404)
+
+    def test_hedgedRead(self):
+        storage = self.replicated(hedge_after=0.05)
+        id = self.put_test_object()
+        # The secondary is ranked first (not having been timed yet), but is
+        # slow to answer
+        storage.replicas[0].latency = 0.2
+        self.secondary.delay = 0.5
+        start = monotonic()
+        self.assertEqual(storage.get_object(id).read(), b"this is a test object")
+        self.assertLess(monotonic() - start, 0.4)
+        sleep(0.6)
+        # Which is noted, so the primary is now asked first
+        self.assertIs(storage._ranked()[0].backend, self.primary)
+
+    def test_failingReplicaRankedLast(self):
+        storage = self.replicated()
+        id = self.put_test_object()
+        self.secondary.get_object = lambda id: 1 / 0
+        storage.replicas[0].latency = 1
+        self.assertEqual(storage.get_object(id).read(), b"this is a test object")
+        self.assertIs(storage._ranked()[0].backend, self.primary)
+        self.assertIs(storage._ranked()[1].backend, self.secondary)
+
+
+class WriteBehindStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.tmpdir = TemporaryDirectory()
+        self.app = archstor.app.test_client()
+        self.backend = FlakyFileSystemStorageBackend(str(Path(self.tmpdir.name, "lts")))
+        # No workers, flush() flushes
+        self.storage = self.write_behind(workers=0)
+
+    def tearDown(self):
+        self.storage.stop()
+        archstor.blueprint.BLUEPRINT.config.pop('ingest', None)
+        archstor.blueprint.BLUEPRINT.config.pop('metrics', None)
+        del self.tmpdir
+
+    def write_behind(self, **kwargs):
+        kwargs.setdefault('retry_backoff', 0)
+        storage = WriteBehindStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "staging")), **kwargs
+        )
+        archstor.blueprint.BLUEPRINT.config['storage'] = storage
+        archstor.blueprint.BLUEPRINT.config['ingest'] = storage
+        return storage
+
+    def flush(self):
+        job = self.storage.journal.claim("test", 60)
+        self.assertIsNotNone(job)
+        self.storage.flush(job)
+
+    def put(self, content=b"this is a test object", **kwargs):
+        id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data=content,
+                          content_type="application/octet-stream", **kwargs)
+        return id, rv
+
+    def staged_files(self):
+        return [x for x in Path(self.tmpdir.name, "staging").iterdir()
+                if not x.name.startswith(".journal")]
+
+    def test_leaseRenewedWhileFlushing(self):
+        self.storage = self.write_behind(workers=0, lease=0.3)
+        id, rv = self.put()
+        job = self.storage.journal.claim("test", self.storage.lease)
+        self.backend.write_delay = 1
+        flushing = Thread(target=self.storage.flush, args=(job,))
+        flushing.start()
+        sleep(0.6)
+        # Well past the lease it was claimed for, but still being written
+        self.assertIsNone(self.storage.journal.claim("other", 60))
+        flushing.join()
+        self.assertIsNone(self.storage.journal.get(id))
+        self.assertTrue(self.backend.check_object_exists(id))
+
+    def test_putAccepted(self):
+        content = bytes(range(256)) * 4
+        id, rv = self.put(content)
+        self.assertEqual(rv.status_code, 202)
+        rj = json.loads(rv.data.decode())
+        self.assertTrue(rj['queued'])
+        self.assertEqual(rj['digests']['md5'], hashlib.md5(content).hexdigest())
+        self.assertEqual(rj['_link'], "/_ingest/{}".format(id))
+        rj = json.loads(self.app.get(rj['_link']).data.decode())
+        self.assertEqual(rj['state'], "queued")
+        self.assertEqual(rj['size'], len(content))
+        self.assertFalse(self.backend.check_object_exists(id))
+        # Served from the staging area meanwhile
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+        rv = self.app.get("/{}".format(id), headers={"Range": "bytes=10-19"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, content[10:20])
+        rv = self.app.head("/{}".format(id))
+        self.assertEqual(rv.headers['Content-Length'], str(len(content)))
+        self.assertTrue(self.storage.check_object_exists(id))
+
+    def test_flush(self):
+        content = bytes(range(256)) * 4
+        id, rv = self.put(content)
+        self.flush()
+        self.assertEqual(self.backend.get_object(id).read(), content)
+        self.assertEqual(self.backend.stat_object(id)['digests']['sha256'],
+                         hashlib.sha256(content).hexdigest())
+        self.assertEqual(self.staged_files(), [])
+        rj = json.loads(self.app.get("/_ingest/{}".format(id)).data.decode())
+        self.assertEqual(rj['state'], "stored")
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+        self.assertEqual(self.app.get("/_ingest/{}".format(uuid4().hex)).status_code, 404)
+
+    def test_flushRetries(self):
+        archstor.blueprint.BLUEPRINT.config['metrics'] = metrics
+        retries = REGISTRY.get_sample_value("archstor_ingest_retries_total") or 0
+        self.backend.fail_writes = True
+        id, rv = self.put()
+        self.flush()
+        rj = json.loads(self.app.get("/_ingest/{}".format(id)).data.decode())
+        self.assertEqual(rj['state'], "queued")
+        self.assertEqual(rj['attempts'], 1)
+        self.assertIn("Write failed", rj['error'])
+        self.assertEqual(REGISTRY.get_sample_value("archstor_ingest_retries_total"),
+                         retries + 1)
+        self.backend.fail_writes = False
+        self.flush()
+        self.assertEqual(self.backend.get_object(id).read(), b"this is a test object")
+
+    def test_flushGivesUp(self):
+        self.storage = self.write_behind(workers=0, max_retries=0)
+        self.backend.fail_writes = True
+        id, rv = self.put()
+        self.flush()
+        rj = json.loads(self.app.get("/_ingest/{}".format(id)).data.decode())
+        self.assertEqual(rj['state'], "failed")
+        self.assertIsNone(self.storage.journal.claim("test", 60))
+        rj = json.loads(self.app.get("/_ingest").data.decode())
+        self.assertEqual(rj['failed'], 1)
+        # Still there to be read, and retried
+        self.assertEqual(self.app.get("/{}".format(id)).data, b"this is a test object")
+        self.backend.fail_writes = False
+        self.assertEqual(self.app.post("/_ingest/{}".format(id)).status_code, 202)
+        self.flush()
+        self.assertTrue(self.backend.check_object_exists(id))
+        self.assertEqual(self.app.post("/_ingest/{}".format(id)).status_code, 400)
+
+    def test_stagedCorruption(self):
+        id, rv = self.put()
+        staged, = self.staged_files()
+        staged.write_bytes(b"this is a test objecT")
+        self.flush()
+        self.assertFalse(self.backend.check_object_exists(id))
+        rj = json.loads(self.app.get("/_ingest/{}".format(id)).data.decode())
+        self.assertIn("DigestMismatchError", rj['error'])
+
+    def test_putExisting(self):
+        id, rv = self.put()
+        rv = self.app.put("/{}".format(id), data=b"again",
+                          content_type="application/octet-stream")
+        self.assertEqual(rv.status_code, 400)
+        self.flush()
+        rv = self.app.put("/{}".format(id), data=b"again",
+                          content_type="application/octet-stream")
+        self.assertEqual(rv.status_code, 400)
+
+    def test_alreadyFlushed(self):
+        # As if a worker died after writing it, before the journal knew
+        id, rv = self.put()
+        self.backend.set_object(id, BytesIO(b"this is a test object"))
+        self.flush()
+        self.assertIsNone(self.storage.status(id))
+        self.assertEqual(self.staged_files(), [])
+
+    def test_digestMismatch(self):
+        id, rv = self.put(headers={"Digest": "md5=" + b64encode(b"0" * 16).decode()})
+        self.assertEqual(rv.status_code, 400)
+        self.assertIsNone(self.storage.status(id))
+        self.assertEqual(self.staged_files(), [])
+
+    def test_deleteStaged(self):
+        id, rv = self.put()
+        rv = self.app.delete("/{}".format(id))
+        self.assertEqual(rv.status_code, 200)
+        self.assertIsNone(self.storage.journal.claim("test", 60))
+        self.assertEqual(self.staged_files(), [])
+        self.assertEqual(self.app.get("/{}".format(id)).status_code, 404)
+
+    def test_deletedWhileFlushing(self):
+        id, rv = self.put()
+        job = self.storage.journal.claim("test", 60)
+        self.app.delete("/{}".format(id))
+        self.storage.flush(job)
+        self.assertFalse(self.backend.check_object_exists(id))
+
+    def test_recovery(self):
+        # Staged by a process which then died, one of them mid flush
+        ids = [self.put()[0] for x in range(3)]
+        self.storage.journal.claim("dead", -1)
+        self.storage = self.write_behind(workers=2, poll_interval=0.05)
+        self.assertTrue(self.storage.wait(10))
+        for id in ids:
+            self.assertEqual(self.backend.get_object(id).read(), b"this is a test object")
+        self.assertEqual(self.staged_files(), [])
+
+    def test_batch(self):
+        staged, rv = self.put()
+        self.flush()
+        queued, rv = self.put()
+        missing = uuid4().hex
+        rv = self.app.post("/_batch/exists", json={"identifiers": [staged, queued, missing]})
+        rj = json.loads(rv.data.decode())
+        self.assertEqual([x['exists'] for x in rj['objects']], [True, True, False])
+        self.app.post("/_batch/delete", json={"identifiers": [staged, queued]})
+        self.assertFalse(self.storage.check_object_exists(staged))
+        self.assertFalse(self.storage.check_object_exists(queued))
+
+    def test_asgiPutAccepted(self):
+        asgi = ASGIApplication(archstor.app)
+        try:
+            id = uuid4().hex
+            rv = ASGITestClient(asgi).put("/{}".format(id), data=b"this is a test object",
+                                          content_type="application/octet-stream")
+            self.assertEqual(rv.status_code, 202)
+            self.assertEqual(json.loads(rv.data.decode())['_link'], "/_ingest/{}".format(id))
+            self.assertEqual(self.storage.status(id)['state'], "queued")
+        finally:
+            asgi.executor.shutdown()
+
+    def test_ingestDisabled(self):
+        archstor.blueprint.BLUEPRINT.config.pop('ingest')
+        self.assertEqual(self.app.get("/_ingest").status_code, 501)
+
+
+class CountingFileSystemStorageBackend(archstor.blueprint.FileSystemStorageBackend):
+    # Counts the calls that would be round trips to a remote backend
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def check_object_exists(self, id):
+        self.calls += 1
+        return super().check_object_exists(id)
+
+    def get_object(self, id):
+        self.calls += 1
+        return super().get_object(id)
+
+    def stat_object(self, id):
+        self.calls += 1
+        return super().stat_object(id)
+
+
+class MembershipFilterTestCase(ArchstorTestCase, unittest.TestCase):
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.tmpdir = TemporaryDirectory()
+        self.app = archstor.app.test_client()
+        self.backend = CountingFileSystemStorageBackend(str(Path(self.tmpdir.name, "lts")))
+        self.storage = self.filtered()
+        archstor.blueprint.BLUEPRINT.config['storage'] = self.storage
+
+    def tearDown(self):
+        del self.tmpdir
+
+    def filtered(self, **kwargs):
+        kwargs.setdefault('capacity', 1000)
+        storage = MembershipFilteredStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "filter")), **kwargs
+        )
+        self.wait_ready(storage)
+        return storage
+
+    def wait_ready(self, storage):
+        for _ in range(100):
+            if storage.ready and not storage._building:
+                return
+            sleep(0.05)
+        self.fail("The membership filter wasn't built")
+
+    def test_negativesSkipBackend(self):
+        self.backend.calls = 0
+        self.assertEqual(self.app.get("/{}".format(uuid4().hex)).status_code, 404)
+        self.assertEqual(self.app.head("/{}".format(uuid4().hex)).status_code, 404)
+        self.assertFalse(self.storage.check_object_exists(uuid4().hex))
+        rv = self.app.post("/_batch/exists", json={"identifiers": [uuid4().hex, uuid4().hex]})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.backend.calls, 0)
+
+    def test_builtFromListing(self):
+        ids = [uuid4().hex for _ in range(5)]
+        for id in ids:
+            self.backend.set_object(id, BytesIO(b"written around the filter"))
+        storage = MembershipFilteredStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "other")), capacity=1000
+        )
+        storage.rebuild()
+        for id in ids:
+            self.assertTrue(storage.check_object_exists(id))
+        self.assertEqual(storage.filter.count, 5)
+
+    def test_setAndDelete(self):
+        id = self.put_test_object()
+        self.assertIn(id, self.storage.filter)
+        self.assertEqual(self.app.get("/{}".format(id)).data, b"this is a test object")
+        self.assertEqual(self.app.delete("/{}".format(id)).status_code, 200)
+        self.assertNotIn(id, self.storage.filter)
+        self.backend.calls = 0
+        self.assertEqual(self.app.get("/{}".format(id)).status_code, 404)
+        self.assertEqual(self.backend.calls, 0)
+
+    def test_failedSetRemoved(self):
+        id = uuid4().hex
+        with self.assertRaises(ObjectAlreadyExistsError):
+            self.storage.set_object(id, BytesIO(b"abc"))
+            self.storage.set_object(id, BytesIO(b"abc"))
+        # Still there, only counted once
+        self.assertIn(id, self.storage.filter)
+        self.storage.del_object(id)
+        self.assertNotIn(id, self.storage.filter)
+
+    def test_overlappingDeletesRemoveOnce(self):
+        storage = self.filtered(capacity=40, error_rate=0.05)
+        ids = ["obj{:03d}".format(x) for x in range(40)]
+        for id in ids:
+            storage.set_object(id, BytesIO(b"abc"))
+        # Both deletes see the object before either deletes it
+        barrier = Barrier(2)
+        delete = self.backend.del_object
+
+        def del_object(id):
+            barrier.wait()
+            return delete(id)
+
+        self.backend.del_object = del_object
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(storage.del_object, ["obj010", "obj010"]))
+        removals = [x for x in storage.changes.since(0) if x[2] < 0]
+        self.assertEqual(removals, [(removals[0][0], "obj010", -1)])
+        self.assertEqual(storage.filter.count, 39)
+        for id in ids:
+            if id != "obj010":
+                self.assertIn(id, storage.filter)
+                self.assertTrue(storage.check_object_exists(id))
+        # Deleted again, and it's already gone
+        storage.del_objects(["obj010", "obj011"])
+        self.assertEqual(len([x for x in storage.changes.since(0) if x[2] < 0]), 2)
+
+    def test_failedSetKeptIfCommitted(self):
+        set_object = self.backend.set_object
+
+        def commit_then_fail(id, content):
+            set_object(id, content)
+            raise ServerError("Recording the digests failed")
+
+        self.backend.set_object = commit_then_fail
+        id = uuid4().hex
+        with self.assertRaises(ServerError):
+            self.storage.set_object(id, BytesIO(b"abc"))
+        self.assertIn(id, self.storage.filter)
+        self.assertTrue(self.storage.check_object_exists(id))
+        # Whereas a write that never got there is taken out again
+        self.backend.set_object = set_object
+        other = uuid4().hex
+        with self.assertRaises(ValueError):
+            self.storage.set_object(other, SlowReader(b"abc" * 10, fail_at=1))
+        self.assertNotIn(other, self.storage.filter)
+
+    def test_deleteDoesntAskBackend(self):
+        ids = [self.put_test_object() for _ in range(3)]
+        self.backend.calls = 0
+        self.storage.del_object(ids[0])
+        self.storage.del_objects(ids[1:])
+        self.assertEqual(self.backend.calls, 0)
+        for id in ids:
+            self.assertNotIn(id, self.storage.filter)
+
+    def test_writeDuringDeleteKept(self):
+        id = self.put_test_object()
+        delete = self.backend.del_object
+
+        def del_object(id):
+            delete(id)
+            # Written again before the delete's removal is recorded
+            self.storage.set_object(id, BytesIO(b"abc"))
+
+        self.backend.del_object = del_object
+        self.storage.del_object(id)
+        self.assertIn(id, self.storage.filter)
+        self.assertTrue(self.storage.check_object_exists(id))
+
+    def test_failedSetAsksBackendOutsideTransaction(self):
+        asking = Barrier(2)
+        check_object_exists = self.backend.check_object_exists
+
+        def slow_check(id):
+            asking.wait()
+            sleep(0.2)
+            return check_object_exists(id)
+
+        self.backend.check_object_exists = slow_check
+        id = uuid4().hex
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            failing = executor.submit(self.storage.set_object, id,
+                                      SlowReader(b"abc" * 10, fail_at=1))
+            asking.wait()
+            # Another process' change isn't held up by the backend
+            other = ChangeLog(self.storage.changes.path)
+            start = monotonic()
+            other.writing(uuid4().hex)
+            self.assertLess(monotonic() - start, 0.15)
+            with self.assertRaises(ValueError):
+                failing.result()
+        self.assertNotIn(id, self.storage.filter)
+
+    def test_buildOutgrowsCapacity(self):
+        for _ in range(30):
+            self.backend.set_object(uuid4().hex, BytesIO(b"written around the filter"))
+        storage = MembershipFilteredStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "other")), capacity=10, error_rate=0.05
+        )
+        storage.rebuild()
+        self.assertEqual(storage.filter.count, 30)
+        self.assertEqual(storage.filter.size, CountingBloomFilter.for_capacity(60, 0.05).size)
+
+    def test_deleteMissingRemovesNothing(self):
+        id = self.put_test_object()
+        other = uuid4().hex
+        self.storage.del_objects([other, uuid4().hex])
+        self.assertTrue(self.storage.check_object_exists(id))
+
+    def test_warmStartFromSnapshot(self):
+        id = self.put_test_object()
+        self.assertTrue(self.storage.snapshot())
+        self.backend.calls = 0
+        other = MembershipFilteredStorageBackend(
+            self.backend, str(Path(self.tmpdir.name, "filter")), capacity=1000
+        )
+        # Loaded, not rebuilt
+        self.assertTrue(other.ready)
+        self.assertFalse(other._building)
+        self.assertIn(id, other.filter)
+        self.assertFalse(other.check_object_exists(uuid4().hex))
+        self.assertEqual(self.backend.calls, 0)
+
+    def test_changesSeenByOtherProcesses(self):
+        other = self.filtered()
+        id = self.put_test_object()
+        # Not something the other instance has looked at yet, but it
+        # catches up before answering that it isn't there
+        self.assertTrue(other.check_object_exists(id))
+        self.storage.del_object(id)
+        # A stale positive is only passed through to the backend
+        self.assertFalse(other.check_object_exists(id))
+        other._catch_up()
+        self.assertNotIn(id, other.filter)
+
+    def test_reloadsWhenTruncated(self):
+        other = self.filtered()
+        ids = [self.put_test_object() for _ in range(3)]
+        self.storage.snapshot()
+        self.assertEqual(self.storage.changes.since(0), [])
+        # The other instance missed changes that are only in the snapshot
+        self.assertLess(other.seq, self.storage.seq)
+        for id in ids:
+            self.assertTrue(other.check_object_exists(id))
+        self.assertEqual(other.seq, self.storage.seq)
+
+    def test_snapshotEvery(self):
+        storage = self.filtered(snapshot_every=2)
+        archstor.blueprint.BLUEPRINT.config['storage'] = storage
+        self.put_test_object()
+        self.put_test_object()
+        self.assertEqual(storage.changes.since(0), [])
+        self.assertEqual(storage.unsaved, 0)
+
+    def test_rebuildInterval(self):
+        id = self.put_test_object()
+        self.storage.snapshot()
+        sleep(0.1)
+        self.backend.set_object(uuid4().hex, BytesIO(b"written around the filter"))
+        other = self.filtered(rebuild_interval=0.05)
+        self.wait_ready(other)
+        self.assertEqual(other.filter.count, 2)
+        self.assertIn(id, other.filter)
+
+
+class CountingBloomFilterTestCase(unittest.TestCase):
+    def test_addRemove(self):
+        bloom = CountingBloomFilter.for_capacity(1000, 0.01)
+        ids = [uuid4().hex for _ in range(1000)]
+        for id in ids:
+            bloom.add(id)
+        for id in ids:
+            self.assertIn(id, bloom)
+        for id in ids[:500]:
+            bloom.remove(id)
+        for id in ids[500:]:
+            self.assertIn(id, bloom)
+        self.assertEqual(bloom.count, 500)
+
+    def test_falsePositiveRate(self):
+        bloom = CountingBloomFilter.for_capacity(1000, 0.01)
+        for _ in range(1000):
+            bloom.add(uuid4().hex)
+        false_positives = sum(uuid4().hex in bloom for _ in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_saveLoad(self):
+        bloom = CountingBloomFilter.for_capacity(100, 0.01)
+        bloom.add("foo")
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, "snapshot")
+            self.assertIsNone(CountingBloomFilter.load(path))
+            bloom.save(path, 42)
+            loaded, header = CountingBloomFilter.load(path)
+            self.assertEqual(header['seq'], 42)
+            self.assertIn("foo", loaded)
+            self.assertNotIn("bar", loaded)
+            self.assertEqual(loaded.counters, bloom.counters)
+            path.write_bytes(path.read_bytes()[:-1])
+            self.assertIsNone(CountingBloomFilter.load(path))
+
+
+class MetricsStorageTestCase(ArchstorTestCase, unittest.TestCase):
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.tmpdir = TemporaryDirectory()
+        self.app = archstor.app.test_client()
+        archstor.blueprint.BLUEPRINT.config['metrics'] = metrics
+        archstor.blueprint.BLUEPRINT.config['storage'] = metrics.MetricsStorageBackend(
+            archstor.blueprint.FileSystemStorageBackend(self.tmpdir.name)
+        )
+
+    def tearDown(self):
+        del archstor.blueprint.BLUEPRINT.config['metrics']
+        del self.tmpdir
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_metricsEndpoint(self):
+        self.app.get("/version")
+        rv = self.app.get("/_metrics")
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.content_type.startswith("text/plain"))
+        self.assertIn(
+            'archstor_requests_total{method="GET",resource="Version",status="200"}',
+            rv.data.decode("utf-8")
+        )
+
+    def test_metricsDisabled(self):
+        del archstor.blueprint.BLUEPRINT.config['metrics']
+        rv = self.app.get("/_metrics")
+        self.assertEqual(rv.status_code, 501)
+        archstor.blueprint.BLUEPRINT.config['metrics'] = metrics
+
+    def test_metricsIsAnIdentifier(self):
+        # The endpoint doesn't take over an object of that name
+        self.put_test_object(b"not the metrics", id="metrics")
+        self.assertEqual(self.app.get("/metrics").data, b"not the metrics")
+        self.assertEqual(self.app.delete("/metrics").status_code, 200)
+        self.assertEqual(self.app.get("/metrics").status_code, 404)
+        self.assertEqual(self.app.get("/_metrics").status_code, 200)
+
+    def test_objectMetrics(self):
+        content = bytes(range(256)) * 10
+        bytes_in = self.sample("archstor_bytes_total", direction="in")
+        bytes_out = self.sample("archstor_bytes_total", direction="out")
+        first_bytes = self.sample("archstor_object_get_first_byte_seconds_count")
+        in_flight = self.sample("archstor_streams_in_flight", direction="out")
+        gets = self.sample(
+            "archstor_backend_duration_seconds_count",
+            backend="FileSystemStorageBackend", operation="get_object"
+        )
+        id = self.put_test_object(content)
+        self.assertEqual(self.app.get("/{}".format(id)).data, content)
+        self.assertEqual(
+            self.sample("archstor_bytes_total", direction="in"), bytes_in + len(content)
+        )
+        self.assertEqual(
+            self.sample("archstor_bytes_total", direction="out"), bytes_out + len(content)
+        )
+        self.assertEqual(
+            self.sample("archstor_object_get_first_byte_seconds_count"), first_bytes + 1
+        )
+        self.assertEqual(self.sample(
+            "archstor_backend_duration_seconds_count",
+            backend="FileSystemStorageBackend", operation="get_object"
+        ), gets + 1)
+        self.assertEqual(self.sample("archstor_streams_in_flight", direction="out"), in_flight)
+
+    def test_fileWrapperBytesCounted(self):
+        content = bytes(range(256)) * 10
+        id = self.put_test_object(content)
+        bytes_out = self.sample("archstor_bytes_total", direction="out")
+
+        class Sendfile:
+            # Stands in for sendfile(2), which never calls read()
+            def __init__(self, f, buffer_size):
+                self.f = f
+
+            def __iter__(self):
+                yield pread(self.f.fileno(), 1024 * 1024, self.f.tell())
+
+            def close(self):
+                self.f.close()
+
+        rv = self.app.get(
+            "/{}".format(id), environ_overrides={"wsgi.file_wrapper": Sendfile}
+        )
+        self.assertEqual(rv.data, content)
+        rv.close()
+        self.assertEqual(
+            self.sample("archstor_bytes_total", direction="out"), bytes_out + len(content)
+        )
+
+    def test_errorsCounted(self):
+        errors = self.sample("archstor_errors_total", error="ObjectNotFoundError")
+        self.app.get("/{}".format(uuid4().hex))
+        self.assertEqual(
+            self.sample("archstor_errors_total", error="ObjectNotFoundError"), errors + 1
+        )
+
+    def test_multiprocessAggregation(self):
+        with TemporaryDirectory() as multiproc_dir:
+            env = dict(environ, PROMETHEUS_MULTIPROC_DIR=multiproc_dir)
+            for x in range(2):
+                subprocess.check_call([
+                    sys.executable, "-c",
+                    "from archstor.blueprint import metrics; " +
+                    "metrics.BYTES.labels('in').inc(5)"
+                ], env=env)
+            output = subprocess.check_output([
+                sys.executable, "-c",
+                "from archstor.blueprint import metrics; " +
+                "print(metrics.exposition()[0].decode('utf-8'))"
+            ], env=env).decode("utf-8")
+        self.assertIn('archstor_bytes_total{direction="in"} 10.0', output)
+
+
+class MemoryAsyncStorageBackend(AsyncStorageBackend):
+    # A natively async backend, standing in for the likes of async GridFS
+    def __init__(self):
+        self.objects = {}
+
+    async def get_object_id_list(self, cursor, limit, prefix=None):
+        return None, sorted(self.objects)[:limit]
+
+    async def check_object_exists(self, id):
+        return id in self.objects
+
+    async def get_object(self, id):
+        if id not in self.objects:
+            raise archstor.blueprint.ObjectNotFoundError(id)
+        return MemoryAsyncReader(self.objects[id])
+
+    async def set_object(self, id, content):
+        chunks = []
+        data = await content.read(7)
+        while data:
+            chunks.append(data)
+            data = await content.read(7)
+        self.objects[id] = b"".join(chunks)
+        return content.hexdigests()
+
+    async def del_object(self, id):
+        del self.objects[id]
+        return True
+
+
+class MemoryAsyncReader:
+    def __init__(self, data):
+        self.f = BytesIO(data)
+
+    async def read(self, size=-1):
+        return self.f.read(size)
+
+    async def close(self):
+        self.f.close()
+
+
+class ASGIStorageTestCase(ArchstorTestCase, unittest.TestCase):
+    def setUp(self):
+        archstor.app.config['TESTING'] = True
+        self.tmpdir = TemporaryDirectory()
+        self.asgi = ASGIApplication(archstor.app)
+        self.app = ASGITestClient(self.asgi)
+        archstor.blueprint.BLUEPRINT.config['storage'] = \
+            archstor.blueprint.FileSystemStorageBackend(
+                self.tmpdir.name
+        )
+
+    def tearDown(self):
+        archstor.blueprint.BLUEPRINT.config.pop('async_storage', None)
+        self.asgi.executor.shutdown()
+        del self.tmpdir
+
+    def test_streamsDontHoldThreads(self):
+        # Far more responses in flight than threads to serve them
+        asgi = ASGIApplication(archstor.app, workers=2)
+        content = b"x" * 1024 * 1024
+        id = self.put_test_object(content)
+        archstor.blueprint.BLUEPRINT.config['BUFF'], buff = \
+            1024 * 64, archstor.blueprint.BLUEPRINT.config['BUFF']
+        clients = 20
+
+        async def main():
+            all_started = asyncio.Event()
+            started = []
+            received = []
+
+            async def get():
+                body = []
+
+                async def receive():
+                    await asyncio.Event().wait()
+
+                async def send(message):
+                    if message["type"] == "http.response.start":
+                        started.append(message["status"])
+                        if len(started) == clients:
+                            all_started.set()
+                    else:
+                        # A client which doesn't read until everyone's begun
+                        await all_started.wait()
+                        body.append(message.get("body", b""))
+                scope = {
+                    "type": "http", "method": "GET", "path": "/{}".format(id),
+                    "query_string": b"", "headers": []
+                }
+                await asgi(scope, receive, send)
+                received.append(b"".join(body))
+
+            await asyncio.wait_for(asyncio.gather(*(get() for x in range(clients))), 30)
+            return started, received
+
+        try:
+            started, received = asyncio.run(main())
+        finally:
+            archstor.blueprint.BLUEPRINT.config['BUFF'] = buff
+            asgi.executor.shutdown()
+        self.assertEqual(started, [200] * clients)
+        self.assertEqual(received, [content] * clients)
+
+    def test_nativeAsyncBackend(self):
+        storage = MemoryAsyncStorageBackend()
+        archstor.blueprint.BLUEPRINT.config['async_storage'] = storage
+        id = uuid4().hex
+        rv = self.app.put("/{}".format(id), data=b"this is a test object",
+                          content_type="application/octet-stream")
+        rj = self.response_200_json(rv)
+        self.assertEqual(
+            rj['digests']['sha256'], hashlib.sha256(b"this is a test object").hexdigest()
+        )
+        self.assertEqual(storage.objects[id], b"this is a test object")
+        rv = self.app.get("/{}".format(id))
+        self.assertEqual(rv.data, b"this is a test object")
+        rv = self.app.get("/")
+        rj = self.response_200_json(rv)
+        self.assertEqual(rj['objects'], [{"identifier": id, "_link": "/{}".format(id)}])
+        rv = self.app.delete("/{}".format(id))
+        self.response_200_json(rv)
+        self.assertEqual(storage.objects, {})
+
+    def test_asgiMetrics(self):
+        archstor.blueprint.BLUEPRINT.config['metrics'] = metrics
+        try:
+            before = REGISTRY.get_sample_value(
+                "archstor_requests_total",
+                {"resource": "Version", "method": "GET", "status": "200"}
+            ) or 0
+            self.app.get("/version")
+            rv = self.app.get("/_metrics")
+        finally:
+            del archstor.blueprint.BLUEPRINT.config['metrics']
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                "archstor_requests_total",
+                {"resource": "Version", "method": "GET", "status": "200"}
+            ), before + 1
+        )
+
+    def test_lifespan(self):
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        asyncio.run(self.asgi({"type": "lifespan"}, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_benchmarkSmoke(self):
+        from benchmarks import bench
+        args = bench.build_parser().parse_args([
+            "--backend", "filesystem", "--objects", "5", "--sizes", "1KiB:1,64KiB:1",
+            "--range-size", "1KiB", "--concurrency", "2"
+        ])
+        report = bench.run(args)
+        self.assertEqual(
+            [x['workload'] for x in report['results']], list(bench.WORKLOADS)
+        )
+        for summary in report['results']:
+            self.assertEqual(summary['errors'], 0, summary['error_samples'])
+            self.assertIsNotNone(summary['latency_ms']['p99'])
+        json.dumps(report)
+        self.assertEqual(bench.compare(report, report, 10), [])
+
+
+class StartupTestCase(unittest.TestCase):
+    def test_startupBenchmark(self):
+        from benchmarks import startup
+        args = startup.build_parser().parse_args([
+            "--backend", "filesystem", "--runs", "1", "--max-seconds", "60"
+        ])
+        report = startup.run(args)
+        summary = report['results'][0]
+        self.assertEqual(summary['storage'], "FileSystemStorageBackend")
+        self.assertEqual(summary['unexpected_drivers'], [])
+        self.assertEqual(startup.failures(report), [])
+        json.dumps(report)
+
+    def test_onlyConfiguredBackendImported(self):
+        rv = subprocess.run([sys.executable, "-c", """
+import sys
+before = set(sys.modules)
+import archstor
+print(" ".join(sorted(set(sys.modules) - before)))
+"""], stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        imported = set(x.split(".")[0] for x in rv.stdout.split())
+        self.assertFalse(imported & {"boto3", "botocore", "swiftclient", "gridfs"})
+        self.assertTrue(hasattr(archstor.blueprint, "S3StorageBackend"))
+        with self.assertRaises(AttributeError):
+            archstor.blueprint.NoSuchStorageBackend
+
+    def test_entryPointBackend(self):
+        with TemporaryDirectory() as tmpdir:
+            Path(tmpdir, "archstor_test_plugin.py").write_text(
+                "from archstor.blueprint.filesystem import FileSystemStorageBackend\n"
+                "def configure(config):\n"
+                "    return FileSystemStorageBackend(config['PLUGIN_ROOT'])\n"
+            )
+            dist_info = Path(tmpdir, "archstor_test_plugin-1.0.dist-info")
+            dist_info.mkdir()
+            Path(dist_info, "METADATA").write_text(
+                "Metadata-Version: 2.1\nName: archstor-test-plugin\nVersion: 1.0\n"
+            )
+            Path(dist_info, "entry_points.txt").write_text(
+                "[archstor.storage_backends]\nplugged = archstor_test_plugin:configure\n"
+            )
+            config = dict(archstor.blueprint.BLUEPRINT.config)
+            sys.path.insert(0, tmpdir)
+            try:
+                app = Flask("plugged")
+                app.config.update(STORAGE_BACKEND="plugged", PLUGIN_ROOT=tmpdir, DEFER_CONFIG=False)
+                app.register_blueprint(archstor.blueprint.BLUEPRINT)
+                storage = archstor.blueprint.BLUEPRINT.config['storage']
+                self.assertIsInstance(storage, archstor.blueprint.FileSystemStorageBackend)
+                self.assertEqual(str(storage.lts_root), tmpdir)
+                app = Flask("unknown")
+                app.config.update(STORAGE_BACKEND="unknown", DEFER_CONFIG=False)
+                with self.assertRaises(ValueError):
+                    app.register_blueprint(archstor.blueprint.BLUEPRINT)
+            finally:
+                sys.path.remove(tmpdir)
+                sys.modules.pop("archstor_test_plugin", None)
+                archstor.blueprint.BLUEPRINT.config.clear()
+                archstor.blueprint.BLUEPRINT.config.update(config)
+
+
+class MigrateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.db = uuid4().hex
+        self.source = storage_from_config({
+            "STORAGE_BACKEND": "mongo", "MONGO_HOST": "localhost", "MONGO_DB": self.db
+        })
+        self.dest = storage_from_config({
+            "STORAGE_BACKEND": "filesystem", "LTS_ROOT": self.tmpdir.name
+        })
+        self.contents = {}
+        for i in range(23):
+            id = uuid4().hex
+            self.contents[id] = "object {}".format(i).encode("utf-8") * (i + 1)
+            self.source.set_object(id, BytesIO(self.contents[id]))
+        self.checkpoint_path = str(Path(self.tmpdir.name, "checkpoint.json"))
+
+    def tearDown(self):
+        MongoClient('localhost', 27017).drop_database(self.db)
+        del self.tmpdir
+
+    def assertMigrated(self):
+        for id, content in self.contents.items():
+            self.assertEqual(self.dest.get_object(id).read(), content)
+
+    def test_storageFromConfig(self):
+        self.assertIsInstance(self.source, archstor.blueprint.MongoStorageBackend)
+        self.assertIsInstance(self.dest, archstor.blueprint.FileSystemStorageBackend)
+        with self.assertRaises(ValueError):
+            storage_from_config({"LTS_ROOT": self.tmpdir.name})
+        environ['ARCHSTOR_TESTMIGRATE_STORAGE_BACKEND'] = "filesystem"
+        environ['ARCHSTOR_TESTMIGRATE_LTS_ROOT'] = self.tmpdir.name
+        environ['ARCHSTOR_TESTMIGRATE_LTS_NO_INDEX'] = "true"
+        try:
+            storage = storage_from_env("ARCHSTOR_TESTMIGRATE_")
+        finally:
+            for name in ("STORAGE_BACKEND", "LTS_ROOT", "LTS_NO_INDEX"):
+                del environ['ARCHSTOR_TESTMIGRATE_' + name]
+        self.assertIsInstance(storage, archstor.blueprint.FileSystemStorageBackend)
+        self.assertIsNone(storage.index)
+
+    def test_migrate(self):
+        checkpoint = Checkpoint(self.checkpoint_path)
+        results = list(migrate(self.source, self.dest, checkpoint, workers=3,
+                               verify=True, page_size=5))
+        self.assertEqual(sorted(x['identifier'] for x in results), sorted(self.contents))
+        self.assertTrue(all(x['status'] == "copied" for x in results), results)
+        self.assertMigrated()
+        self.assertEqual(self.dest.stat_object(results[0]['identifier'])['digests'],
+                         self.source.stat_object(results[0]['identifier'])['digests'])
+        with open(self.checkpoint_path) as f:
+            self.assertEqual(json.load(f), {"prefix": None, "cursor": None, "failed": []})
+        # A finished migration has nothing left to do
+        self.assertEqual(list(migrate(self.source, self.dest,
+                                      Checkpoint(self.checkpoint_path))), [])
+
+    def test_migratePrefix(self):
+        prefix = sorted(self.contents)[0][0]
+        results = list(migrate(self.source, self.dest, prefix=prefix, page_size=2))
+        self.assertEqual(sorted(x['identifier'] for x in results),
+                         sorted(x for x in self.contents if x.startswith(prefix)))
+        # A checkpoint is only resumed by a migration of the same prefix
+        Checkpoint(self.checkpoint_path).save()
+        with self.assertRaises(ValueError):
+            Checkpoint(self.checkpoint_path, prefix=prefix)
+
+    def test_resume(self):
+        results = migrate(self.source, self.dest, Checkpoint(self.checkpoint_path),
+                          workers=1, page_size=5)
+        first = [next(results) for _ in range(12)]
+        # Interrupted, once whatever was in flight has finished
+        results.close()
+        with open(self.checkpoint_path) as f:
+            self.assertIsNotNone(json.load(f)['cursor'])
+        second = list(migrate(self.source, self.dest, Checkpoint(self.checkpoint_path),
+                              workers=1, page_size=5))
+        self.assertMigrated()
+        self.assertTrue(all(x['status'] == "copied" for x in first))
+        # Only the pages not finished before the interruption are listed again
+        self.assertLess(len(second), len(self.contents) - 5)
+        # Those in flight when it was interrupted were copied all the same
+        copied = [x['identifier'] for x in first + second if x['status'] == "copied"]
+        skipped = [x['identifier'] for x in second if x['status'] == "skipped"]
+        self.assertEqual(len(copied), len(set(copied)))
+        self.assertEqual(set(copied) | set(skipped), set(self.contents))
+
+    def test_skipExisting(self):
+        ids = sorted(self.contents)
+        self.dest.set_object(ids[0], BytesIO(self.contents[ids[0]]))
+        self.dest.set_object(ids[1], BytesIO(b"something else entirely"))
+        statuses = dict((x['identifier'], x['status'])
+                        for x in migrate(self.source, self.dest))
+        self.assertEqual(statuses[ids[0]], "skipped")
+        self.assertEqual(statuses[ids[1]], "skipped")
+        self.assertEqual(self.dest.get_object(ids[1]).read(), b"something else entirely")
+        statuses = dict((x['identifier'], x['status'])
+                        for x in migrate(self.source, self.dest, verify=True))
+        self.assertEqual(statuses[ids[0]], "skipped")
+        self.assertEqual(statuses[ids[1]], "mismatch")
+
+    def test_verifyRottenSource(self):
+        # Copying back the other way, from a filesystem whose content rotted
+        source, self.dest = self.dest, storage_from_config({
+            "STORAGE_BACKEND": "mongo", "MONGO_HOST": "localhost", "MONGO_DB": self.db + "_dest"
+        })
+        self.addCleanup(MongoClient('localhost', 27017).drop_database, self.db + "_dest")
+        for id, content in self.contents.items():
+            source.set_object(id, BytesIO(content))
+        id = sorted(self.contents)[3]
+        content_path = Path(self.tmpdir.name, identifier_to_path(id), "arf", "content.file")
+        content_path.write_bytes(b"this is a rotten object")
+        checkpoint = Checkpoint(self.checkpoint_path)
+        results = dict((x['identifier'], x) for x in migrate(
+            source, self.dest, checkpoint, verify=True, page_size=4
+        ))
+        self.assertEqual(results[id]['status'], "mismatch")
+        self.assertFalse(self.dest.check_object_exists(id))
+        self.assertEqual(list(checkpoint.failed), [id])
+        # Repaired, then retried when the migration is resumed
+        content_path.write_bytes(self.contents[id])
+        checkpoint = Checkpoint(self.checkpoint_path)
+        results = list(migrate(source, self.dest, checkpoint, verify=True))
+        self.assertEqual(results, [{"identifier": id, "status": "copied",
+                                    "size": len(self.contents[id])}])
+        self.assertEqual(list(checkpoint.failed), [])
+        self.assertMigrated()
+
+    def test_rateLimited(self):
+        size = sum(len(x) for x in self.contents.values())
+        start = monotonic()
+        results = list(migrate(self.source, self.dest, workers=4, bytes_per_second=size / 2))
+        self.assertEqual(len(results), len(self.contents))
+        # The bucket starts with half a second's worth, the rest waits
+        self.assertGreater(monotonic() - start, 0.5)
+
+
+class SlowReader:
+    # Counts reads, and can be made to fail part way
+    def __init__(self, data, fail_at=None):
+        self.f = BytesIO(data)
+        self.reads = 0
+        self.fail_at = fail_at
+        self.closed = False
+
+    def read(self, size=-1):
+        self.reads += 1
+        if self.reads == self.fail_at:
+            raise ValueError("backend went away")
+        sleep(0.001)
+        return self.f.read(size)
+
+    def close(self):
+        self.closed = True
+
+
+class ReadAheadReaderTestCase(unittest.TestCase):
+    def test_readAhead(self):
+        content = bytes(range(256)) * 40
+        src = SlowReader(content)
+        reader = ReadAheadReader(src, 100, 4)
+        chunks = iter(lambda: reader.read(64), b"")
+        self.assertEqual(b"".join(chunks), content)
+        reader.thread.join(1)
+        self.assertTrue(src.closed)
+        self.assertEqual(reader.read(), b"")
+
+    def test_bounded(self):
+        src = SlowReader(b"x" * 10000)
+        reader = ReadAheadReader(src, 100, 2)
+        self.assertEqual(reader.read(100), b"x" * 100)
+        sleep(0.1)
+        # The chunk handed out, two queued and one waiting for room
+        self.assertLessEqual(src.reads, 4)
+        reader.close()
+
+    def test_error(self):
+        src = SlowReader(b"x" * 1000, fail_at=3)
+        reader = ReadAheadReader(src, 100, 4)
+        self.assertEqual(reader.read(200), b"x" * 100)
+        self.assertEqual(reader.read(200), b"x" * 100)
+        self.assertRaises(ValueError, reader.read, 200)
+        reader.thread.join(1)
+        self.assertTrue(src.closed)
+
+    def test_closeEarly(self):
+        src = SlowReader(b"x" * 100000)
+        reader = ReadAheadReader(src, 100, 2)
+        reader.read(100)
+        reader.close()
+        reader.thread.join(1)
+        self.assertFalse(reader.thread.is_alive())
+        self.assertTrue(src.closed)
+        self.assertLess(src.reads, 1000)
+
+
+class ChunkSizingTestCase(unittest.TestCase):
+    def test_fixed(self):
+        sizing = ChunkSizing(4096)
+        self.assertEqual(sizing.size_for(None), 4096)
+        self.assertEqual(sizing.size_for(10 * 1024 * 1024 * 1024), 4096)
+
+    def test_adaptive(self):
+        sizing = ChunkSizing(
+            4096, adaptive=True, minimum=1024, maximum=1024 * 1024, target_chunks=16
+        )
+        # Unknown lengths get the fixed size
+        self.assertEqual(sizing.size_for(None), 4096)
+        self.assertEqual(sizing.size_for(10), 1024)
+        self.assertEqual(sizing.size_for(16 * 4096), 4096)
+        self.assertEqual(sizing.size_for(16 * 4096 + 1), 8192)
+        self.assertEqual(sizing.size_for(1024 * 1024 * 1024), 1024 * 1024)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def test_bounded(self):
+        pool = ConnectionPool(object, size=2, timeout=0.01)
+        pool.acquire()
+        pool.acquire()
+        self.assertRaises(PoolExhaustedError, pool.acquire)
+
+    def test_reuse(self):
+        pool = ConnectionPool(object, size=2)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+
+    def test_idleEviction(self):
+        closed = []
+        pool = ConnectionPool(object, size=2, max_idle=0, close=closed.append)
+        conn = pool.acquire()
+        pool.release(conn)
+        sleep(0.01)
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(closed, [conn])
+
+    def test_healthCheck(self):
+        pool = ConnectionPool(object, size=2, check=lambda conn: False)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_discardOnError(self):
+        pool = ConnectionPool(object, size=1)
+        with self.assertRaises(ValueError):
+            with pool.connection() as conn:
+                raise ValueError()
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_keepOnError(self):
+        pool = ConnectionPool(object, size=1)
+        with self.assertRaises(KeyError):
+            with pool.connection(keep_on=(KeyError,)) as conn:
+                raise KeyError()
+        self.assertIs(pool.acquire(), conn)
+
+    def in_child(self, func):
+        # Out: func's (short, bytes) result, run in a forked child
+        r, w = pipe()
+        pid = fork()
+        if pid == 0:
+            try:
+                write(w, func())
+            finally:
+                _exit(0)
+        waitpid(pid, 0)
+        return read(r, 1024)
+
+    def test_forgottenAfterFork(self):
+        made = []
+        pool = ConnectionPool(lambda: made.append(1) or len(made), size=1, timeout=0.01)
+        pool.release(pool.acquire())
+        # The parent's idle connection isn't handed out in a child, which
+        # has its own slots
+        self.assertEqual(self.in_child(lambda: str(pool.acquire()).encode()), b"2")
+        self.assertEqual(pool.acquire(), 1)
+
+    def test_processLocal(self):
+        made = []
+        client = ProcessLocal(lambda: made.append(1) or len(made))
+        self.assertEqual(made, [])
+        self.assertEqual(client.get(), 1)
+        self.assertEqual(client.get(), 1)
+        self.assertEqual(self.in_child(lambda: str(client.get()).encode()), b"2")
+        self.assertEqual(client.get(), 1)
+
+    def test_sqliteFile(self):
+        with TemporaryDirectory() as tmpdir:
+            db = SqliteFile(Path(tmpdir, "test.sqlite3"))
+            db.conn.execute("CREATE TABLE t (x INTEGER)")
+            conn = db.conn
+            self.assertIs(db.conn, conn)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                self.assertIsNot(executor.submit(lambda: db.conn).result(), conn)
+            self.assertEqual(self.in_child(lambda: str(db.conn is conn).encode()), b"False")
+            with self.assertRaises(ValueError):
+                with db.transaction() as conn:
+                    conn.execute("INSERT INTO t VALUES (1)")
+                    raise ValueError()
+            with db.transaction() as conn:
+                conn.execute("INSERT INTO t VALUES (2)")
+            self.assertEqual(db.conn.execute("SELECT x FROM t").fetchall(), [(2,)])
 
 
 if __name__ == "__main__":